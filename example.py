@@ -4,6 +4,7 @@ from mcparser.event_parser import *  # noqas
 from mcparser.glpk_parser import *  # noqas
 from mcparser.item_parser import *  # noqas
 from mcparser.packer import *  # noqas
+from mcparser.pipeline import *  # noqas
 from mcparser.quest_parser import *  # noqas
 from mcparser.svt_parser import *  # noqas
 from mcparser.svt_parser import *  # noqas
@@ -12,104 +13,121 @@ from mcparser.wiki_getter import *  # noqas
 
 t0 = time.time()
 # logger.setLevel(logging.INFO)
-tasks = ['csv', 'icon', 'item', 'svt', 'craft', 'cmd', 'event', 'quest', 'glpk', 'dicon', 'pack']
+tasks = ['csv_svt', 'csv_craft', 'csv_cmd', 'csv_event', 'icon', 'item', 'svt', 'craft', 'cmd', 'event', 'quest',
+         'glpk', 'dicon', 'pack']
 # tasks = [ 'icon', 'dicon']
 # tasks = ['icon', 'item', 'svt', 'craft', 'cmd', 'event', 'quest', 'glpk', 'dicon', 'pack']
+
+
 # %% 1-CSV
-if 'csv' in tasks:
+def down_svt(r):
     # override = pd.DataFrame(index=[289, 290, 291],
     #                         columns=['name_link', 'name_cn', 'avatar', 'get', 'np_type'],
     #                         data=[['阿比盖尔·威廉姆斯〔夏〕', '阿比盖尔·威廉姆斯〔夏〕', 'Servant289.jpg', '期间限定', '全体']])
     override = None
     WikiGetter.get_servant_data(override=override, )
-    WikiGetter.get_craft_data()
-    WikiGetter.get_cmd_data()
-    EventWikiGetter.get_event_data(start_from=None)  # {'Event': '狩猎关卡 第6'})
-else:
-    print('skip csv')
+
 
 # %% 2-set ICONS first
-if 'icon' in tasks:
+def load_icons(r):
     ICONS.load(config.paths.icon_des)
     # ICONS.add_common_icons()
-else:
-    print('skip icon')
+
 
 # %% 3-then items
-if 'item' in tasks:
+def parse_items(r):
     ip = ItemParser()
     ip.parse()
     ip.dump(config.paths.item_des)
-else:
-    print('skip item')
+    return ip
+
+
+def load_items(r):
+    ip = ItemParser()
+    ip.load(config.paths.item_des)
+    return ip
+
 
 # %% 4-Servants
-if 'svt' in tasks:
+def parse_svt(r):
     sp = ServantParser(config.paths.svt_src)
     sp.parse()
     sp.dump(config.paths.svt_des)
-else:
-    print('skip svt')
+    return sp
+
+
+def load_svt(r):
+    sp = ServantParser(config.paths.svt_src)
+    sp.load(config.paths.svt_des)
+    return sp
+
 
 # %% 5-Crafts
-if 'craft' in tasks:
+def parse_craft(r):
     # logger.setLevel(logging.INFO)
-    sp = globals().get('sp', None)
+    sp = r.get('svt')
     cep = CraftParser(config.paths.craft_src, sp)
     cep.parse(range(0, 2000))
     cep.dump(config.paths.craft_des)
     if sp:
         sp.dump(config.paths.svt_des)
-else:
-    print('skip craft')
+    return cep
+
 
 # %% 6-CmdCodes
-if 'cmd' in tasks:
+def parse_cmd(r):
     ccp = CmdParser(config.paths.cmd_src)
     ccp.parse(range(0, 500))
     ccp.dump(config.paths.cmd_des)
-else:
-    print('skip cmd')
+    return ccp
+
 
 # %% 7-Event
-if 'event' in tasks:
-    ip = globals().get('ip', None)
-    ep = EventParser(config.paths.event_src, ip)
+def parse_event(r):
+    ep = EventParser(config.paths.event_src, r.get('item'))
     ep.parse()
     ep.dump(config.paths.event_des)
-else:
-    print('skip event')
+    return ep
+
 
 # %% 8-quest
-if 'quest' in tasks:
-    ip = globals().get('ip', None)
-    qp = QuestParser(ip)
+def parse_quest(r):
+    ep = r.get('event')
+    # reuse quest pages parsed by EventParser
+    qp = QuestParser(r.get('item'), ep.quest_pages if ep else None)
     qp.parse(config.paths.event_src, config.paths.svt_src)
     qp.dump(config.paths.quest_des)
-else:
-    print('skip quest')
+    return qp
+
+
+def load_quest(r):
+    qp = QuestParser(r.get('item'))
+    qp.load(config.paths.quest_des)
+    return qp
+
 
 # %% 9-glpk
-if 'glpk' in tasks:
-    qp = globals().get('qp', None)
+def parse_glpk(r):
+    qp = r.get('quest')
     gp = GLPKParser()
     gp.parse(cn_columns=189)
-    gp.check_quest(qp)
+    if qp:
+        gp.check_quest(qp)
     gp.add_special_drops()
     gp.dump(config.paths.glpk_des)
-else:
-    print('skip glpk')
+    return gp
+
 
 # %% 10-save icons
-if 'dicon' in tasks:
+def download_icons(r):
     ICONS.download_icons(config.paths.icons_folder, workers=config.default_workers * 2)
     ICONS.dump(config.paths.icon_des)
-else:
-    print('skip dicon')
+
 
 # %% 11-pack
-if 'pack' in tasks:
-    # make_dataset(config.paths.dataset_des, sp, cep, ccp, ep, ip, ICONS, qp, gp)
+def pack(r):
+    # make_dataset(config.paths.dataset_des, r.get('svt'), r.get('craft'), r.get('cmd'), r.get('event'),
+    #              r.get('item'), ICONS, r.get('quest'), r.get('glpk'))
     make_dataset(config.paths.dataset_des)
     make_zip('output/releases/')
     make_zip('output/releases/', text_only=True)
@@ -119,8 +137,34 @@ if 'pack' in tasks:
         make_zip(r'D:/Projects/AndroidStudioProjects/chaldea/res/data/', 'dataset.zip')
     if is_macos():
         make_zip(r'/Users/narumi/Projects/chaldea/res/data/', 'dataset.zip')
-else:
-    print('skip pack')
+
+
+# %% run stages, independent stages are run concurrently
+# icons are registered by item/svt/craft/cmd parsers, so icons must be downloaded after them
+# parsers of process backend and image post-processing of icons fork, they must run alone
+fork = config.parse_backend == 'process'
+pipeline = Pipeline([
+    Stage('csv_svt', down_svt, outputs=[config.paths.svt_src]),
+    Stage('csv_craft', lambda r: WikiGetter.get_craft_data(), outputs=[config.paths.craft_src]),
+    Stage('csv_cmd', lambda r: WikiGetter.get_cmd_data(), outputs=[config.paths.cmd_src]),
+    Stage('csv_event', lambda r: EventWikiGetter.get_event_data(start_from=None),  # {'Event': '狩猎关卡 第6'})
+          outputs=[config.paths.event_src]),
+    Stage('icon', load_icons),
+    Stage('item', parse_items, ['icon'], outputs=[config.paths.item_des], load=load_items),
+    Stage('svt', parse_svt, ['csv_svt', 'icon'], [config.paths.svt_src], [config.paths.svt_des], load_svt,
+          exclusive=fork),
+    Stage('craft', parse_craft, ['csv_craft', 'svt'], [config.paths.craft_src], [config.paths.craft_des],
+          exclusive=fork),
+    Stage('cmd', parse_cmd, ['csv_cmd', 'icon'], [config.paths.cmd_src], [config.paths.cmd_des], exclusive=fork),
+    Stage('event', parse_event, ['csv_event', 'item'], [config.paths.event_src], [config.paths.event_des]),
+    Stage('quest', parse_quest, ['event', 'item', 'csv_svt'], [config.paths.event_src, config.paths.svt_src],
+          [config.paths.quest_des], load_quest),
+    Stage('glpk', parse_glpk, ['quest'], outputs=[config.paths.glpk_des]),
+    Stage('dicon', download_icons, ['item', 'svt', 'craft', 'cmd'], outputs=[config.paths.icon_des],
+          exclusive=True),
+    Stage('pack', pack, ['svt', 'craft', 'cmd', 'event', 'item', 'quest', 'glpk', 'dicon']),
+])
+pipeline.run(tasks)
 
 # %%
 dt = time.time() - t0
@@ -1,55 +1,189 @@
 import abc
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
 
+from .utils import datatypes, templates
+from .utils.datatypes import Jsonable
+from .utils.icons import ICONS
 from .utils.util import *
 
+# parser of current worker process, inherited from parent by fork
+_worker_parser: Optional['BaseParser'] = None
+
+
+def _init_parse_worker(parser: 'BaseParser'):
+    global _worker_parser
+    _worker_parser = parser
+    # pending icons are copied from parent, they are merged by parent itself
+    ICONS.pop_pending()
+    # template results are buffered and written in batches, the rest is written when worker exits
+    Finalize(None, TEMPLATE_RESULTS.flush, exitpriority=10)
+
+
+def _parse_in_worker(key: Any, record: Dict[str, Any]) -> Tuple[Optional[MapEntry], List[tuple]]:
+    """Run in worker process, return parsed result and icon registrations to be merged in parent"""
+    threading.current_thread().name = f'{_worker_parser.__class__.__name__}-{key}'
+    result, icons = _worker_parser._parse_record(key, record)
+    ICONS.pop_pending()
+    return result, icons
+
 
 # noinspection PyMethodMayBeStatic
 class BaseParser(metaclass=abc.ABCMeta):
     """For Svt/Craft/CmdCode parser"""
+    # bump to invalidate incremental parse results even if source code is unchanged
+    version = 1
+    value_type: Type[Jsonable] = None  # override to support incremental parsing
 
     def __init__(self):
         self.data: Dict = {}  # override to specify type
+        self.src_data: Optional[WikitextStore] = None  # override if records are not from wikitext store
 
     @abc.abstractmethod
     def get_keys(self):
         pass
 
+    def get_record(self, key: Any) -> Dict[str, Any]:
+        """Record(dict of column - value) of key passed to `_parse_one`"""
+        return self.src_data[key]
+
+    def parser_version(self) -> str:
+        """Hash of `version` and source code of parser and template modules"""
+        modules = [sys.modules[cls.__module__] for cls in type(self).__mro__ if cls is not object]
+        return source_hash(modules + [templates, datatypes, sys.modules[remove_tag.__module__]], str(self.version))
+
+    def _cache_context(self) -> Any:
+        """Extra json serializable inputs which affect parsed results, e.g. data of other parsers"""
+        return None
+
+    def _input_hash(self, record: Dict[str, Any], version: str) -> str:
+        data = json.dumps([version, self._cache_context(), record], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+    def _prepare(self, keys: List[Any]):
+        """Called before parsing `keys`, e.g. to resolve shared data in batches"""
+        pass
+
     @count_time
-    def parse(self, _range: Iterable = None, workers: int = None):
+    def parse(self, _range: Iterable = None, workers: int = None, backend: str = None, incremental: bool = None):
+        """Parse all records in `_range`.
+
+        :param workers: max workers, default `config.default_workers` threads or
+            `config.parse_workers`(cpu count) processes.
+        :param backend: "thread" or "process", default `config.parse_backend`.
+            Processes are forked from current process, they only receive the records and
+            return parsed results and icon registrations to current process.
+            Thread backend is used if other `Pipeline` stages are running, see `FORK_GUARD`.
+        :param incremental: default `config.parse_incremental`. If True, records whose content and
+            parser version are unchanged since last run are loaded from `PARSED_CACHE` rather than parsed.
+        """
         cls_name = self.__class__.__name__
-        executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
+        backend = backend or config.parse_backend
+        if backend == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+            logger.warning(f'{cls_name}: process backend requires fork, use thread backend instead')
+            backend = 'thread'
+        incremental = config.parse_incremental if incremental is None else incremental
+        if incremental and self.value_type is None:
+            logger.warning(f'{cls_name}: incremental parsing is not supported')
+            incremental = False
         all_keys = [k for k in self.get_keys() if _range is None or k in _range]
         success_keys, error_keys = [], []
         finish_num, all_num = 0, len(all_keys)
 
-        tasks = [executor.submit(self._parse_one, key) for key in all_keys]
+        records, hashes = {}, {}
+        if incremental:
+            version = self.parser_version()
+            for key in all_keys:
+                records[key] = self.get_record(key)
+                hashes[key] = self._input_hash(records[key], version)
+                cached = PARSED_CACHE.get(cls_name, key, hashes[key])
+                if cached is not None:
+                    data, icons = cached
+                    self.data[key] = self.value_type().from_json(data)
+                    ICONS.extend_pending(icons)
+                    success_keys.append(key)
+            logger.info(f'{cls_name}: {len(success_keys)}/{all_num} records unchanged')
+        cached_keys = set(success_keys)
+        parse_keys = [k for k in all_keys if k not in cached_keys]
+        finish_num = len(cached_keys)
+        self._prepare(parse_keys)
+
+        if backend == 'process':
+            TEMPLATE_RESULTS.flush()  # otherwise buffered results are copied to and written by every worker
+            with FORK_GUARD.forking() as safe:
+                if safe:
+                    # all workers are forked at the first submit
+                    executor = ProcessPoolExecutor(max_workers=workers or config.parse_workers or os.cpu_count(),
+                                                   mp_context=multiprocessing.get_context('fork'),
+                                                   initializer=_init_parse_worker, initargs=(self,))
+                    tasks = [executor.submit(_parse_in_worker, key, records.get(key) or self.get_record(key))
+                             for key in parse_keys]
+            if not safe:
+                logger.warning(f'{cls_name}: forking alongside other pipeline stages may deadlock, '
+                               f'use thread backend instead. Mark the stage exclusive to use process backend')
+                backend = 'thread'
+        if backend != 'process':
+            executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
+            tasks = [executor.submit(lambda k: self._parse_record(k, records.get(k) or self.get_record(k)), key)
+                     for key in parse_keys]
+        cache_entries = []
         for future in as_completed(tasks):
             finish_num += 1
-            result = future.result()
+            try:
+                result, icons = future.result()
+            except Exception as e:  # worker process died
+                logger.error(f'{cls_name}: worker failed: {e!r}')
+                result, icons = None, []
+            if backend == 'process':
+                ICONS.extend_pending(icons)
             if result is None:
                 logger.warning(f'======= {cls_name} {finish_num}/{all_num}: FAILED ========')
             else:
                 key, value = result
                 success_keys.append(key)
                 self.data[key] = value
+                if incremental:
+                    cache_entries.append((key, hashes[key], value.to_json(False, 'json'), icons))
                 logger.debug(f'======= {cls_name} {finish_num}/{all_num} success:'
                              f' No.{key} {getattr(value, "mcLink", None) or ""}')
+        executor.shutdown()
+        TEMPLATE_RESULTS.flush()
+        if cache_entries:
+            PARSED_CACHE.put_many(cls_name, cache_entries)
         error_keys = [k for k in all_keys if k not in success_keys]
         logger.info(f'{cls_name}: all {all_num} wikitext parsed. {len(error_keys)} errors: {error_keys}',
                     extra=color_extra('red') if error_keys else None)
+        logger.debug(f'{cls_name}: memo caches {memo_cache_info()}')
         self.data = sort_dict(self.data)
         return self.data
 
+    def _parse_record(self, key: Any, record: Dict[str, Any]) -> Tuple[Optional[MapEntry], List[tuple]]:
+        """Parse one record in current thread, return result and icons registered by it"""
+        with ICONS.recording() as icons:
+            result = self._parse_one(key, record)
+        return result, icons
+
     @abc.abstractmethod
     @catch_exception
-    def _parse_one(self, key: Any) -> MapEntry:
+    def _parse_one(self, key: Any, record: Dict[str, Any]) -> MapEntry:
         """One job for one record. Return (key, result) tuple.
 
-        If works > 1, jobs are run in multi-threading, decorate method with `@catch_exception` and
-        set friendly thread name at the start, so that decorator will know which thread went wrong.
+        If works > 1, jobs are run in multi-threading or multi-processing, decorate method with
+        `@catch_exception` and set friendly thread name at the start, so that decorator will know
+        which thread went wrong.
+        In process backend, the parser is a forked copy, so don't modify shared state other than
+        registering icons by `ICONS.add`, link related data after `parse` in parent instead.
+        The result must be picklable.
         """
         return key, "value"
 
     def dump(self, fp: str):
         dump_json(self.data, fp, default=lambda o: o.to_json())
         logger.info(f'{self.__class__.__name__}: dump parsed data at "{fp}"')
+
+    def load(self, fp: str):
+        """Load data dumped by `dump`, requires `value_type`"""
+        self.data = Jsonable.convert_map(load_json(fp), self.value_type, int)
+        logger.info(f'{self.__class__.__name__}: load parsed data from "{fp}"')
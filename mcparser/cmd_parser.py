@@ -19,31 +19,32 @@ def check_equal(hint: str, a, b, stop=True):
 
 
 class CmdParser(BaseParser):
-    def __init__(self, pkl_fn: str):
+    value_type = CmdCode
+
+    def __init__(self, src_fp: str):
         super().__init__()
-        self.src_data: pd.DataFrame = load_pickle(pkl_fn, pd.DataFrame())
+        self.src_data = WikitextStore(src_fp)
         self.data: Dict[int, CmdCode] = {}
 
     def dump(self, fp: str = None):
         super().dump(fp or config.paths.cmd_des)
 
     def get_keys(self):
-        return self.src_data.index
+        return self.src_data.keys()
 
     @catch_exception
-    def _parse_one(self, index: int) -> MapEntry[int, CmdCode]:
-        mc_link = self.src_data.loc[index, 'name_link']
+    def _parse_one(self, index: int, record: Dict[str, Any]) -> MapEntry[int, CmdCode]:
+        mc_link = record['name_link']
         if threading.current_thread() != threading.main_thread():
             threading.current_thread().setName(f'CmdCode-{index}-{mc_link}')
 
-        code = mwp.parse(self.src_data.loc[index, 'wikitext'])
+        code = mwp.parse(record['wikitext'])
         cmd_code = t_cmd_code(parse_template(code, r'^{{指令纹章'))
         check_equal('index', index, cmd_code.no)
 
         name_link, name, name_other, des, method, method_text, icon, _type = \
-            self.src_data.loc[index,
-                              ['name_link', 'name', 'name_other', 'des', 'method', 'method_link_text',
-                               'icon', 'type']]
+            [record[k] for k in ('name_link', 'name', 'name_other', 'des', 'method', 'method_link_text',
+                                 'icon', 'type')]
 
         check_equal('mcLink', name_link, cmd_code.mcLink, False)
         check_equal('name', name, cmd_code.name, False)
@@ -25,9 +25,11 @@ def check_equal(hint: str, a, b, stop=True):
 
 
 class CraftParser(BaseParser):
-    def __init__(self, pkl_fn: str, svt_parser: ServantParser = None):
+    value_type = CraftEssential
+
+    def __init__(self, src_fp: str, svt_parser: ServantParser = None):
         super().__init__()
-        self.src_data: pd.DataFrame = load_pickle(pkl_fn, pd.DataFrame())
+        self.src_data = WikitextStore(src_fp)
         self.data: Dict[int, CraftEssential] = {}
 
         self._svt_parser = svt_parser
@@ -40,22 +42,53 @@ class CraftParser(BaseParser):
         super().dump(fp or config.paths.craft_des)
 
     def get_keys(self):
-        return self.src_data.index
+        return self.src_data.keys()
+
+    def parse(self, _range: Iterable = None, workers: int = None, backend: str = None, incremental: bool = None):
+        super().parse(_range, workers, backend, incremental)
+        self._link_svt()
+        return self.data
+
+    def _link_svt(self):
+        """Set bond/valentine craft of servants, done in parent rather than in worker"""
+        if not self._svt_parser:
+            return
+        for index, craft in self.data.items():
+            if craft.bond > 0:
+                self._svt_parser.data[craft.bond].bondCraft = index
+            if craft.valentine > 0:
+                svt = self._svt_parser.data[craft.valentine]
+                if index not in svt.valentineCraft:
+                    svt.valentineCraft.append(index)
+
+    def _cache_context(self) -> Any:
+        # bond/valentine svt are found by svt names
+        return sorted(self.svt_name_id_map.items())
+
+    def _prepare(self, keys: List[int]):
+        """Resolve redirects of unknown svt names in bond/valentine crafts in batches before parsing"""
+        if not self.svt_name_id_map:
+            return
+        names = []
+        for _, record in self.src_data.items(keys):
+            for name in re.findall(r'{{(?:羁绊礼装|情人节礼装)\s*\|\s*([^|}]+?)\s*[|}]', record['wikitext']):
+                if name not in self.svt_name_id_map:
+                    names.append(name)
+        REDIRECTS.resolve(names)
 
     @catch_exception
-    def _parse_one(self, index: int) -> MapEntry[int, CraftEssential]:
-        mc_link = self.src_data.loc[index, 'name_link']
+    def _parse_one(self, index: int, record: Dict[str, Any]) -> MapEntry[int, CraftEssential]:
+        mc_link = record['name_link']
         if threading.current_thread() != threading.main_thread():
             threading.current_thread().setName(f'Craft-{index}-{mc_link}')
 
-        code = mwp.parse(self.src_data.loc[index, 'wikitext'])
+        code = mwp.parse(record['wikitext'])
         craft = t_craft_essential(parse_template(code, r'^{{概念礼装'))
         check_equal('index', index, craft.no)
 
         name_link, name, name_other, icon, hp1, hp_max, atk1, atk_max, des, des_max, _type = \
-            self.src_data.loc[index,
-                              ['name_link', 'name', 'name_other', 'icon', 'hp1', 'hpmax', 'atk1', 'atkmax',
-                               'des', 'des_max', 'type']]
+            [record[k] for k in ('name_link', 'name', 'name_other', 'icon', 'hp1', 'hpmax', 'atk1', 'atkmax',
+                                 'des', 'des_max', 'type')]
 
         check_equal('mcLink', name_link, craft.mcLink, False)
         check_equal('name', name, craft.name, False)
@@ -76,13 +109,7 @@ class CraftParser(BaseParser):
 
         # bond craft & valentine craft
         craft.bond = self._which_svt(code, 0)
-        if craft.bond > 0 and self._svt_parser:
-            svt = self._svt_parser.data[craft.bond]
-            svt.bondCraft = index
         craft.valentine = self._which_svt(code, 1)
-        if craft.valentine > 0 and self._svt_parser:
-            svt = self._svt_parser.data[craft.valentine]
-            svt.valentineCraft.append(index)
         return index, craft
 
     def _which_svt(self, code: Wikicode, kind=0) -> int:
@@ -100,9 +127,11 @@ class CraftParser(BaseParser):
         if index > 0:
             return index
 
-        new_name = redirect_page(get_site_page(svt_name), svt_name)
-        if new_name != svt_name:
+        # resolved in `_prepare`
+        new_name = REDIRECTS.get(svt_name)
+        if new_name and new_name != svt_name:
             index = self.svt_name_id_map.get(new_name, -1)
             if index > 0:
                 return index
         logger.warning(f'CANNOT found svt "{svt_name}" for bond/valentine craft:\n{code}')
+        return -1
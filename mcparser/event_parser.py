@@ -6,6 +6,7 @@
 import calendar
 
 from .item_parser import ItemParser
+from .quest_pages import QuestPages
 from .utils.templates import *
 
 
@@ -14,8 +15,10 @@ class EventParser:
 
     def __init__(self, src_fp: str, item_parser: ItemParser = None):
         super().__init__()
+        # quest pages are shared with `QuestParser`
+        self.quest_pages = QuestPages(src_fp)
         # src_data: key - event_name, value - event_info(wikitext of home/quests/subpages)
-        self.src_data: Dict[str, Any] = load_json(src_fp)
+        self.src_data: Dict[str, Any] = self.quest_pages.src_data
         self.data = Events()
         self._item_parser = item_parser
 
@@ -52,6 +55,7 @@ class EventParser:
         self.data.mainRecords = sort_dict(self.data.mainRecords, lambda k, v: v.startTimeJp)
         self.data.limitEvents = sort_dict(self.data.limitEvents, lambda k, v: v.startTimeJp)
         self._parse_tickets()
+        TEMPLATE_RESULTS.flush()
         return self.data
 
     @catch_exception
@@ -60,7 +64,7 @@ class EventParser:
         event = MainRecord()
 
         home_wikitext = mwp.parse(src_data['event_page'])
-        quest_wikitext = mwp.parse(src_data['quest_page'])
+        quest_page = self.quest_pages.page('MainStory', key)
 
         params = parse_template(home_wikitext, '^{{活动信息')
         event.name = src_data['name']
@@ -73,9 +77,9 @@ class EventParser:
             event.chapter, event.title = event.name.split(maxsplit=1)
 
         t_event_info(params, event)
-        main_quests = quest_wikitext.get_sections(matches='主线关卡')
+        main_quests = quest_page.sections('主线关卡')
         if main_quests:
-            event.rewards, event.drops = p_quest_reward_drop(main_quests[0])
+            event.rewards, event.drops = sum_quest_reward_drop(quest_page.quests(main_quests[0]))
         # check valid items
         self.check_valid_item(event.drops)
         self.check_valid_item(event.rewards)
@@ -88,7 +92,8 @@ class EventParser:
         event = LimitEvent()
 
         home_wikitext = mwp.parse(event_src_data['event_page'])
-        quest_wikitext = mwp.parse(event_src_data['quest_page'])
+        # sub pages are merged into main quest page
+        quest_page = self.quest_pages.page('Event', key)
 
         params_event_info = parse_template(home_wikitext, '^{{活动信息')
         event.name = event_src_data['name']
@@ -101,16 +106,13 @@ class EventParser:
             add_dict(event.itemPoint, t_event_point(parse_template(template)))
 
         # ====== quests drop & rewards ======
-        # merge sub pages into main quest page
-        for page in event_src_data['sub_pages'].values():
-            quest_wikitext.append(page)
         # not 高难 or repeatable ? rewards : rewards+drops
-        hard_quest_sections = quest_wikitext.get_sections(matches='高难度关卡')
-        if hard_quest_sections:
-            reward_drop = p_quest_reward_drop(hard_quest_sections[0], False)
+        hard_quest_sections = quest_page.sections('高难度关卡')
+        hard_quest_section = hard_quest_sections[0] if hard_quest_sections else None
+        if hard_quest_section:
+            reward_drop = sum_quest_reward_drop(quest_page.quests(hard_quest_section), False)
             add_dict(event.itemRewardDrop, *reward_drop)
-            quest_wikitext.remove(hard_quest_sections[0])
-        reward_drop = p_quest_reward_drop(quest_wikitext)
+        reward_drop = sum_quest_reward_drop(quest_page.quests(exclude=hard_quest_section))
         add_dict(event.itemRewardDrop, *reward_drop)
 
         add_dict(event.items, event.itemShop, event.itemTask, event.itemPoint, event.itemRewardDrop)
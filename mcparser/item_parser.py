@@ -1,4 +1,4 @@
-from .utils.datatypes import Item
+from .utils.datatypes import Item, Jsonable
 from .utils.icons import ICONS
 from .utils.util import *
 
@@ -68,3 +68,8 @@ class ItemParser:
         fp = fp or config.paths.item_des
         dump_json(self.data, fp, default=lambda o: o.to_json())
         logger.info(f'{self.__class__.__name__}: dump parsed data at "{fp}"')
+
+    def load(self, fp: str = None):
+        fp = fp or config.paths.item_des
+        self.data = Jsonable.convert_map(load_json(fp), Item)
+        logger.info(f'{self.__class__.__name__}: load parsed data from "{fp}"')
@@ -0,0 +1,196 @@
+"""Pipeline of stages with dependencies.
+
+Every stage runs in a thread as soon as all its dependencies finished, so independent stages overlap,
+e.g. downloading event pages while parsing servants.
+
+Stage with both `inputs` and `outputs` files is skipped if its input files, the artifacts(outputs) of its
+dependencies and the source code of mcparser are unchanged since its last successful run, and all its
+outputs exist. The result of skipped stage is restored from its outputs by `load`.
+Digests of last runs are saved at `config.paths.pipeline_state`.
+
+Forking while other threads hold locks deadlocks the child process, so stages which fork should be `exclusive`:
+`BaseParser.parse` with process backend and `Icons.download_icons`(image post-processing in `process_images`).
+Otherwise they fall back to threads when other stages are running, see `FORK_GUARD`.
+"""
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from .utils.util import *
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable[[Dict[str, Any]], Any], deps: Sequence[str] = (),
+                 inputs: Sequence[str] = (), outputs: Sequence[str] = (),
+                 load: Callable[[Dict[str, Any]], Any] = None, exclusive=False):
+        """
+        :param name: unique stage name.
+        :param func: called with dict of stage name - result of finished stages, return the result of this stage.
+        :param deps: names of stages which must be finished before this stage.
+        :param inputs: files read by this stage, stage without inputs(e.g. downloading) is never skipped.
+        :param outputs: artifact files written by this stage.
+        :param load: called like `func` to restore result from outputs if stage is skipped or not selected,
+            result is None if not provided.
+        :param exclusive: if True, no other stage runs at the same time, e.g. stage which forks processes.
+        """
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.load = load
+        self.exclusive = exclusive
+
+    def __repr__(self):
+        return f'Stage({self.name})'
+
+
+class Pipeline:
+    def __init__(self, stages: Iterable[Stage], state_fp: str = None):
+        """:param state_fp: json file of digests of last runs, default `config.paths.pipeline_state`."""
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            assert stage.name not in self.stages, f'duplicated stage "{stage.name}"'
+            self.stages[stage.name] = stage
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                assert dep in self.stages, f'unknown dependency "{dep}" of stage "{stage.name}"'
+        self.order = self._sort()
+        self.results: Dict[str, Any] = {}
+        self._state_fp = state_fp
+        self._state: Dict[str, Dict[str, Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def _run_counted(self, name: str, code_version: str, force: bool):
+        try:
+            self._run_stage(name, code_version, force)
+        finally:
+            FORK_GUARD.exit()
+
+    @property
+    def state_fp(self):
+        return self._state_fp or config.paths.pipeline_state
+
+    def _sort(self) -> List[str]:
+        """Stage names in topological order, raise if dependencies have cycle"""
+        order, visiting = [], set()
+
+        def _visit(name):
+            if name in order:
+                return
+            assert name not in visiting, f'dependency cycle at stage "{name}"'
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                _visit(dep)
+            visiting.remove(name)
+            order.append(name)
+
+        for stage_name in self.stages:
+            _visit(stage_name)
+        return order
+
+    @staticmethod
+    def file_digest(fp: str) -> Optional[str]:
+        if not os.path.exists(fp):
+            return None
+        sha1 = hashlib.sha1()
+        with open(fp, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _digest(self, fps: Sequence[str]) -> Optional[str]:
+        if not fps:
+            return None
+        data = json.dumps([(fp, self.file_digest(fp)) for fp in fps], ensure_ascii=False)
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+    def _input_key(self, stage: Stage, code_version: str) -> Optional[str]:
+        """Hash of all inputs of stage, None if stage can't be skipped"""
+        if not stage.inputs or not stage.outputs:
+            return None
+        # dependencies without outputs only decide the order
+        dep_digests = [(self._state.get(dep) or {}).get('digest') for dep in stage.deps]
+        data = json.dumps([code_version, self._digest(stage.inputs), dep_digests])
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+    def _restore(self, stage: Stage) -> Any:
+        if stage.load and all(os.path.exists(fp) for fp in stage.outputs):
+            return stage.load(self.results)
+        return None
+
+    def _run_stage(self, name: str, code_version: str, force: bool):
+        stage = self.stages[name]
+        key = self._input_key(stage, code_version)
+        last = self._state.get(name) or {}
+        if not force and key is not None and last.get('key') == key and \
+                all(os.path.exists(fp) for fp in stage.outputs):
+            self.results[name] = self._restore(stage)
+            logger.info(f'stage "{name}": inputs unchanged, skipped')
+            return
+        logger.info(f'stage "{name}": start')
+        t0 = time.time()
+        self.results[name] = stage.func(self.results)
+        with self._lock:
+            # digest is recorded when the stage finished, later changes of outputs by other stages are ignored
+            self._state[name] = {'key': key, 'digest': self._digest(stage.outputs)}
+            dump_json(self._state, self.state_fp)
+        logger.info(f'stage "{name}": finished in {time.time() - t0:.1f} secs')
+
+    @count_time
+    def run(self, stages: Iterable[str] = None, workers: int = None, force=False) -> Dict[str, Any]:
+        """Run stages concurrently in dependency order, exclusive stages run alone.
+
+        :param stages: names of stages to run, default all. Dependencies not selected are not run,
+            their results are restored by `load`.
+        :param workers: max stages run at the same time, default number of selected stages.
+        :param force: if True, run stages even if inputs are unchanged.
+        :return: dict of stage name - result, also saved in `self.results`.
+        """
+        selected = self.order if stages is None else [name for name in self.order if name in stages]
+        unknown = [name for name in (stages or []) if name not in self.stages]
+        assert not unknown, f'unknown stages: {unknown}'
+        self._state = load_json(self.state_fp) if os.path.exists(self.state_fp) else {}
+        modules = [m for name, m in sorted(sys.modules.items())
+                   if name.split('.')[0] == __name__.split('.')[0] and getattr(m, '__file__', None)]
+        code_version = source_hash(modules)
+
+        finished, failed = set(), set()
+        for name in self.order:
+            if name not in selected:
+                stage = self.stages[name]
+                self.results[name] = self._restore(stage)
+                self._state.setdefault(name, {'key': None, 'digest': self._digest(stage.outputs)})
+                finished.add(name)
+        pending = list(selected)
+        running: Dict[Future, str] = {}
+        executor = ThreadPoolExecutor(max_workers=workers or len(selected) or 1)
+        while pending or running:
+            for name in list(pending):
+                deps = self.stages[name].deps
+                if any([dep in failed for dep in deps]):
+                    pending.remove(name)
+                    failed.add(name)
+                    logger.error(f'stage "{name}": dependency failed, not run')
+                elif all([dep in finished for dep in deps]):
+                    if (self.stages[name].exclusive and running) or \
+                            any([self.stages[n].exclusive for n in running.values()]):
+                        continue
+                    pending.remove(name)
+                    FORK_GUARD.enter()
+                    running[executor.submit(self._run_counted, name, code_version, force)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    finished.add(name)
+                except Exception:  # noqas
+                    failed.add(name)
+                    logger.error(f'stage "{name}": failed', exc_info=sys.exc_info())
+        executor.shutdown()
+        error_stages = [name for name in selected if name in failed]
+        logger.info(f'Pipeline: {len(selected)} stages run. {len(error_stages)} errors: {error_stages}',
+                    extra=color_extra('red') if error_stages else None)
+        return self.results
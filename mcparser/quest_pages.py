@@ -0,0 +1,61 @@
+from .utils.templates import *
+
+
+class QuestPage:
+    """Quest page of one event, parsed once. Its {{关卡配置}} quests are parsed on first query"""
+
+    def __init__(self, code: Wikitext):
+        self.index = PageIndex(code)
+        self._templates = self.index.templates('关卡配置')
+        # id of template - parsed quest, only templates in queried spans are parsed
+        self._quests: Dict[int, Quest] = {}
+        self._lock = threading.Lock()
+
+    def sections(self, matches: str) -> List[Tuple[int, int]]:
+        return self.index.sections(matches)
+
+    def _quest(self, template: Template) -> Quest:
+        with self._lock:
+            quest = self._quests.get(id(template))
+        if quest is None:
+            quest = t_quest(parse_template(template))
+            with self._lock:
+                quest = self._quests.setdefault(id(template), quest)
+        return quest
+
+    def quests(self, within: Tuple[int, int] = None, exclude: Tuple[int, int] = None) -> List[Quest]:
+        """Quests in page order, optionally inside section span `within` and outside span `exclude`.
+
+        Quests are shared by all callers, copy them before modifying.
+        """
+        templates = self.index.templates('关卡配置', within) if within else self._templates
+        excluded = set(id(t) for t in self.index.templates('关卡配置', exclude)) if exclude else set()
+        return [self._quest(t) for t in templates if id(t) not in excluded]
+
+
+class QuestPages:
+    """Quest pages of event source(`EventWikiGetter`), shared by `EventParser` and `QuestParser`.
+
+    Source json is loaded once and each quest page(with its sub pages) is parsed on first use.
+    """
+
+    def __init__(self, src_fp: str = None):
+        self.src_fp = src_fp or config.paths.event_src
+        self.src_data: Dict[str, Any] = load_json(self.src_fp)
+        self._pages: Dict[Tuple[str, Optional[str]], QuestPage] = {}
+        self._lock = threading.Lock()
+
+    def page(self, event_type: str, key: str = None) -> QuestPage:
+        """:param event_type: "MainStory", "Event" or "DailyQuest" which has no key."""
+        with self._lock:
+            page = self._pages.get((event_type, key))
+        if page is None:
+            src_data = self.src_data[event_type] if key is None else self.src_data[event_type][key]
+            code = mwp.parse(src_data['quest_page'])
+            # merge sub pages into main quest page
+            for sub_page in src_data.get('sub_pages', {}).values():
+                code.append(sub_page)
+            page = QuestPage(code)
+            with self._lock:
+                page = self._pages.setdefault((event_type, key), page)
+        return page
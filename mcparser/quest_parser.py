@@ -1,27 +1,33 @@
+import copy
+
 from .item_parser import ItemParser
+from .quest_pages import QuestPages
 from .utils.datatypes import *
 from .utils.templates import t_quest
 from .utils.util import *
 
 
 class QuestParser:
-    def __init__(self, item_parser: ItemParser = None):
+    def __init__(self, item_parser: ItemParser = None, quest_pages: QuestPages = None):
+        """
+        :param quest_pages: quest pages already parsed by `EventParser`, loaded from `event_src_fp` if None.
+        """
         self.free_quest_data: Dict[str, Quest] = {}  # placeCn as key
         self.svt_quest_data: Dict[str, List[Quest]] = {}
         self._item_parser = item_parser
+        self._quest_pages = quest_pages
 
     def parse(self, event_src_fp: str, svt_src_fp: str, workers: int = None):
         executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
 
         # free quests of main story
-        src_data = load_json(event_src_fp)
-        event_data: Dict = src_data['MainStory']
+        quest_pages = self._quest_pages or QuestPages(event_src_fp)
         daily_key = '迦勒底之门/每日任务'
-        event_data[daily_key] = src_data['DailyQuest']
-        all_keys, success_keys, error_keys = list(event_data.keys()), [], []
+        all_keys = list(quest_pages.src_data['MainStory'].keys()) + [daily_key]
+        success_keys, error_keys = [], []
 
         finish_num, all_num = 0, len(all_keys)
-        tasks = [executor.submit(self._parse_free_quest, chapter, event_data) for chapter in event_data]
+        tasks = [executor.submit(self._parse_free_quest, chapter, quest_pages) for chapter in all_keys]
         for future in as_completed(tasks):
             finish_num += 1
             key = future.result()
@@ -36,10 +42,11 @@ class QuestParser:
         self.free_quest_data = sort_dict(self.free_quest_data, lambda k, v: all_keys.index(v.chapter))
 
         # svt quests
-        svt_pd: pd.DataFrame = load_pickle(svt_src_fp)
-        all_keys, success_keys, error_keys = list(svt_pd.index), [], []
+        svt_store = WikitextStore(svt_src_fp)
+        name_links = svt_store.name_links()
+        all_keys, success_keys, error_keys = svt_store.keys(), [], []
         finish_num, all_num = 0, len(all_keys)
-        tasks = [executor.submit(self._parse_svt_quest, index, svt_pd) for index in svt_pd.index]
+        tasks = [executor.submit(self._parse_svt_quest, index, svt_store) for index in all_keys]
         for future in as_completed(tasks):
             finish_num += 1
             key = future.result()
@@ -48,26 +55,28 @@ class QuestParser:
             else:
                 success_keys.append(key)
                 logger.debug(f'======= parse svt quest {finish_num}/{all_num} success:'
-                             f' No.{key} {svt_pd.loc[key, "name_link"]}')
+                             f' No.{key} {name_links.get(key)}')
         error_keys = [k for k in all_keys if k not in success_keys]
         logger.info(f'All quests of {all_num} servants parsed. {len(error_keys)} errors: {error_keys}',
                     extra=color_extra('red') if error_keys else None)
-        names = svt_pd['name_link'].tolist()
+        names = list(name_links.values())
         self.svt_quest_data = sort_dict(self.svt_quest_data, lambda k: names.index(k))
+        TEMPLATE_RESULTS.flush()
 
     @catch_exception
-    def _parse_free_quest(self, chapter: str, event_data: Dict) -> str:
-        quest_wikitext = mwp.parse(event_data[chapter]['quest_page'])
+    def _parse_free_quest(self, chapter: str, quest_pages: QuestPages) -> str:
         is_daily = '迦勒底之门/每日任务' == chapter
         if is_daily:
-            section = quest_wikitext
+            quests = quest_pages.page('DailyQuest').quests()
         else:
-            sections = quest_wikitext.get_sections(matches='自由关卡')
-            section = sections[0] if sections else mwp.parse('')
-        for template in section.filter_templates(matches='^{{关卡配置'):
-            quest = t_quest(parse_template(template))
+            quest_page = quest_pages.page('MainStory', chapter)
+            sections = quest_page.sections('自由关卡')
+            quests = quest_page.quests(sections[0]) if sections else []
+        for quest in quests:
             if not quest.isFree:
                 continue
+            # shared with `EventParser`
+            quest = copy.deepcopy(quest)
             quest.chapter = chapter
             self.check_valid_item(quest)
             key = quest.indexKey = quest.name if is_daily else quest.get_place()
@@ -84,9 +93,10 @@ class QuestParser:
         return chapter
 
     @catch_exception
-    def _parse_svt_quest(self, index: int, svt_pd: pd.DataFrame) -> int:
-        svt_name = svt_pd.loc[index, 'name_link']
-        quest_text = svt_pd.loc[index, 'wikitext_quest']
+    def _parse_svt_quest(self, index: int, svt_store: WikitextStore) -> int:
+        record = svt_store[index]
+        svt_name = record['name_link']
+        quest_text = record['wikitext_quest']
         if quest_text:
             for section_title in ('幕间物语', '强化任务'):
                 for section in mwp.parse(quest_text).get_sections(matches=f'^{section_title}$'):
@@ -116,3 +126,10 @@ class QuestParser:
             "svtQuests": self.svt_quest_data
         }, fp, default=lambda o: o.to_json())
         logger.info(f'{self.__class__.__name__}: dump parsed data at "{fp}"')
+
+    def load(self, fp: str = None):
+        fp = fp or config.paths.quest_des
+        data = load_json(fp)
+        self.free_quest_data = Jsonable.convert_map(data['freeQuests'], Quest)
+        self.svt_quest_data = dict([(k, Jsonable.convert_list(v, Quest)) for k, v in data['svtQuests'].items()])
+        logger.info(f'{self.__class__.__name__}: load parsed data from "{fp}"')
@@ -5,54 +5,55 @@ from .utils.templates import *
 
 # noinspection PyMethodMayBeStatic
 class ServantParser(BaseParser):
-    def __init__(self, pkl_fn: str):
+    value_type = Servant
+
+    def __init__(self, src_fp: str):
         super().__init__()
-        self.src_data: pd.DataFrame = load_pickle(pkl_fn, pd.DataFrame())
+        self.src_data = WikitextStore(src_fp)
         self.data: Dict[int, Servant] = {}
 
     def dump(self, fp: str = None):
         super().dump(fp or config.paths.svt_des)
 
     def get_keys(self):
-        return self.src_data.index
+        return self.src_data.keys()
 
     @catch_exception
-    def _parse_one(self, index: int) -> MapEntry[int, Servant]:
-        mc_link = self.src_data.loc[index, 'name_link']
+    def _parse_one(self, index: int, record: Dict[str, Any]) -> MapEntry[int, Servant]:
+        mc_link = record['name_link']
         if threading.current_thread() != threading.main_thread():
             threading.current_thread().setName(f'Servant-{index}-{mc_link}')
-        code = mwp.parse(self.src_data.loc[index, 'wikitext'])
+        page = PageIndex(record['wikitext'])
         servant = Servant()
         servant.no = index
         servant.mcLink = mc_link
-        servant.icon = os.path.basename(self.src_data.loc[index, 'icon'])
+        servant.icon = os.path.basename(record['icon'])
         ICONS.add(servant.icon)
 
-        self._base_info(index, code, servant)
-        self._treasure_device(index, code, servant)
-        self._active_skill(index, code, servant)
-        self._passive_skill(index, code, servant)
-        self._item_cost(index, code, servant)
-        self._bond_points(index, code, servant)
-        self._profiles(index, code, servant)
-        wikicode_voice = mwp.parse(self.src_data.loc[index, 'wikitext_voice'])
-        self._voices(index, wikicode_voice, servant)
+        self._base_info(index, page, servant, record)
+        self._treasure_device(index, page, servant)
+        self._active_skill(index, page, servant)
+        self._passive_skill(index, page, servant)
+        self._item_cost(index, page, servant)
+        self._bond_points(index, page, servant)
+        self._profiles(index, page, servant)
+        self._voices(index, PageIndex(record['wikitext_voice']), servant)
         return index, servant
 
-    def _base_info(self, index: int, code: Wikicode, servant: Servant):
-        servant.info = t_base_info(parse_template(code, r'^{{基础数值'))
-        nicknames = [s for s in self.src_data.loc[index, 'name_other'].split('&') if s]
+    def _base_info(self, index: int, page: PageIndex, servant: Servant, record: Dict[str, Any]):
+        servant.info = t_base_info(page.template_params(r'基础数值'))
+        nicknames = [s for s in record['name_other'].split('&') if s]
         servant.info.nicknames.extend(nicknames)
         servant.info.nicknames = list(set(servant.info.nicknames))
-        servant.info.obtains = re.split(r'\s*[\n|&]\s*', remove_tag(self.src_data.loc[index, 'obtain'], ['br']))
+        servant.info.obtains = re.split(r'\s*[\n|&]\s*', remove_tag(record['obtain'], ['br']))
         for illust in servant.info.illustrations.values():
             ICONS.add(illust, save=False)
 
-    def _treasure_device(self, index: int, code: Wikicode, servant: Servant):
-        td_sections = code.get_sections(matches='宝具')
+    def _treasure_device(self, index: int, page: PageIndex, servant: Servant):
+        td_sections = page.sections('宝具')
         if len(td_sections) <= 0:
             return
-        for state, td_text in split_tabber(td_sections[0]):
+        for state, td_text in split_tabber(page.code_of(td_sections[0])):
             td_params = parse_template(remove_tag(td_text), r'^{{宝具')
             td = t_treasure_device(td_params)
             td.state = state
@@ -79,21 +80,21 @@ class ServantParser(BaseParser):
                 for td in servant.treasureDevice:
                     td.state = '强化后' if '强化后' in td.state else '强化前'
 
-    def _active_skill(self, index: int, code: Wikicode, servant: Servant):
+    def _active_skill(self, index: int, page: PageIndex, servant: Servant):
         if index == 1:  # 玛修 只用第一部技能
-            section = parse_template(code.get_sections(matches=r'持有技能')[0], '复合标签')['2']
+            section = parse_template(page.code_of(page.sections(r'持有技能')[0]), '复合标签')['2']
         else:
-            sections = code.get_sections(matches=r'^持有技能$')
+            sections = page.sections(r'^持有技能$')
             if len(sections) == 0:
                 return
-            section = str(sections[0])
+            section = str(page.code_of(sections[0]))
         left_section = section
-        tabber_skills: List[Tag] = mwp.parse(left_section).filter_tags(recursive=False, matches='tabber')
+        tabber_skills: List[Tag] = parse_wikitext(left_section).filter_tags(recursive=False, matches='tabber')
         for _tabber in tabber_skills:
             left_section = left_section.replace(str(_tabber), '')
             if "'''技能" in str(_tabber):
                 logger.error(f"No.{index}-active skill: '''技能x''' inside tabber!!!")
-        standalone_skills = mwp.parse(left_section).filter_templates(matches='{{持有技能')
+        standalone_skills = parse_wikitext(left_section).filter_templates(matches='{{持有技能')
         split_skills = [str(c) for c in tabber_skills + standalone_skills]
         split_skills.sort(key=lambda x: section.index(x))
 
@@ -128,66 +129,63 @@ class ServantParser(BaseParser):
             active_skill.cnState = skills_sorted.index(skills_unsorted[0])
             servant.activeSkills.append(active_skill)
 
-    def _passive_skill(self, index: int, code: Wikicode, servant: Servant):
-        sections = code.get_sections(matches='职阶技能')
+    def _passive_skill(self, index: int, page: PageIndex, servant: Servant):
+        sections = page.sections('职阶技能')
         if len(sections) == 0:
             return
-        params = parse_template(remove_tag(str(sections[0])), r'^{{职阶技能')
+        params = parse_template(remove_tag(str(page.code_of(sections[0]))), r'^{{职阶技能')
         servant.passiveSkills = t_passive_skill(params)
         for skill in servant.passiveSkills:
             ICONS.add(skill.icon)
         if len(servant.passiveSkills) == 0:
             logger.info(f'No passive skills: No.{index}-{servant.mcLink}')
 
-    def _item_cost(self, index: int, code: Wikicode, servant: Servant):
-        sections = code.get_sections(matches='素材需求')
+    def _item_cost(self, index: int, page: PageIndex, servant: Servant):
+        sections = page.sections('素材需求')
         if not sections:
             return
-        code: Wikicode = sections[0]
+        cost_section = sections[0]
         # ascension
-        sections = code.get_sections(matches='灵基再临')
+        sections = page.sections('灵基再临', cost_section)
         if sections:
-            section: Wikicode = sections[0]
-            servant.itemCost.ascension = t_ascension_cost(parse_template(section, r'^{{灵基再临素材'))
+            servant.itemCost.ascension = t_ascension_cost(page.template_params(r'灵基再临素材', sections[0]))
         else:
             logger.warning(f'No.{index}-{servant.mcLink} has no ascension items', end='')
 
         # skill
-        sections = code.get_sections(matches='技能强化')
+        sections = page.sections('技能强化', cost_section)
         if sections:
-            section: Wikicode = sections[0]
-            servant.itemCost.skill = t_skill_cost(parse_template(section, r'^{{技能升级素材'))
+            servant.itemCost.skill = t_skill_cost(page.template_params(r'技能升级素材', sections[0]))
         else:
             logger.warning(f'No.{index}-{servant.mcLink} has no skill up items', end='')
 
         # dress
-        sections = code.get_sections(matches='灵衣开放')
+        sections = page.sections('灵衣开放', cost_section)
         if sections:
-            section: Wikicode = sections[0]
-            for template in section.filter_templates(matches=r'^{{灵衣开放素材'):
+            for template in page.templates(r'灵衣开放素材', sections[0]):
                 dress_result = t_dress_cost(parse_template(template))
                 servant.itemCost.dress.extend(dress_result[0])
                 servant.itemCost.dressName.extend(dress_result[1])
                 servant.itemCost.dressNameJp.extend(dress_result[2])
         return
 
-    def _bond_points(self, index: int, code: Wikicode, servant: Servant):
-        params = parse_template(code, r'^{{羁绊点数')
+    def _bond_points(self, index: int, page: PageIndex, servant: Servant):
+        params = page.template_params(r'羁绊点数')
         if index != 1 and index not in kUnavailableSvt:
             # 玛修 has no bond points
             for i in range(10):
                 servant.bondPoints.append(params.get(str(i + 1), cast=int))
             servant.bondPoints.extend([1090000, 1230000, 1360000, 1500000, 1640000])
 
-    def _profiles(self, index: int, code: Wikicode, servant: Servant):  # noqas
-        section = code.get_sections(matches='资料')[0]
+    def _profiles(self, index: int, page: PageIndex, servant: Servant):  # noqas
+        section = page.code_of(page.sections('资料')[0])
         params_profile = parse_template(remove_tag(str(section)), r'^{{个人资料')
         servant.profiles = t_profiles(params_profile)
-        params_fool = parse_template(code, r'^{{愚人节资料')
+        params_fool = page.template_params(r'愚人节资料')
         servant.profiles.extend(t_fool_profiles(params_fool))
 
-    def _voices(self, index: int, code: Wikicode, servant: Servant):  # noqas
-        for template in code.filter_templates(matches=r'^{{#invoke:VoiceTable'):
+    def _voices(self, index: int, page: PageIndex, servant: Servant):  # noqas
+        for template in page.templates(r'#invoke:VoiceTable'):
             params = parse_template(remove_tag(str(template)), r'^{{#invoke:VoiceTable')
             table = t_voice_table(params)
             # # resolve real url in client
@@ -0,0 +1,151 @@
+"""asyncio download engine, alternative backend of thread pool downloaders.
+
+All requests share one keep-alive connection pool and at most `config.async_workers` requests are in flight.
+aiohttp doesn't support HTTP/1.1 pipelining, each connection carries one request at a time. Reusing
+keep-alive connections of the pool saves the connect and TLS handshakes instead.
+"""
+import asyncio
+
+import aiohttp
+
+from .util import *
+
+
+class AsyncFetcher:
+    def __init__(self, limit: int = None):
+        self.limit = limit or config.async_workers
+        self.api_url = f'https://{config.domain}/api.php'
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self):
+        # reuse keep-alive connections for all requests to the same host, no pipelining in aiohttp
+        connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60, ttl_dns_cache=600)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120),
+                                              headers={'User-Agent': 'mcparser'})
+        self._semaphore = asyncio.Semaphore(self.limit)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._session.close()
+
+    @staticmethod
+    def run(func: Callable[['AsyncFetcher'], Any], limit: int = None):
+        """Run coroutine `func(fetcher)` in a new event loop and return its result.
+
+        If an event loop is already running in current thread(e.g. jupyter), run it in another thread.
+        """
+
+        async def _main():
+            async with AsyncFetcher(limit) as fetcher:
+                return await func(fetcher)
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(_main())
+        executor = ThreadPoolExecutor(max_workers=1)
+        result = executor.submit(asyncio.run, _main()).result()
+        executor.shutdown()
+        return result
+
+    async def get(self, url: str, params: Dict = None, n: int = None) -> Optional[bytes]:
+        """GET url throttled by `RATE_LIMITER` with backoff retry, return None if failed after `n` retry."""
+        if n is None:
+            n = config.net_retry_times
+        async with self._semaphore:
+            for retry_no in range(n):
+                await RATE_LIMITER.acquire_async()
+                if config.net_mode == 'replay':
+                    # throttled like live requests, so that replay reproduces the timing of live runs
+                    content = await self._replay(url, params)
+                    RATE_LIMITER.release(True)
+                    return content
+                retry_after = 0
+                try:
+                    async with self._session.get(url, params=params) as response:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        if response.status in (404, 410):
+                            # not found is not transient, don't retry
+                            RATE_LIMITER.release(True)
+                            logger.warning(f'not found: "{url}"')
+                            return None
+                        response.raise_for_status()
+                        content = await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    RATE_LIMITER.release(False)
+                    if retry_after > 0:
+                        RATE_LIMITER.pause(retry_after)
+                    await asyncio.sleep(max(retry_after, backoff_delay(retry_no)))
+                    continue
+                RATE_LIMITER.release(True)
+                if config.net_mode == 'record':
+                    FIXTURES.save(request_key('GET', url, params), 'GET', url, response.status,
+                                  dict(response.headers), content)
+                return content
+        logger.error(f'Error download "{url}" {str(params):.200s} after {n} retry.')
+        return None
+
+    @staticmethod
+    async def _replay(url: str, params: Dict = None) -> Optional[bytes]:
+        record = FIXTURES.load(request_key('GET', url, params))
+        await asyncio.sleep(config.replay_latency)
+        if record is None:
+            logger.error(f'"{url}" {str(params):.200s} not recorded')
+            return None
+        return record[2]
+
+    async def api(self, action: str, n: int = None, **kwargs) -> Optional[Dict]:
+        """Call API, wait and retry if database lag exceeds maxlag"""
+        if n is None:
+            n = config.net_retry_times
+        params = {'action': action, 'format': 'json', 'utf8': 1, 'maxlag': config.max_lag}
+        params.update(kwargs)
+        for _ in range(n):
+            content = await self.get(self.api_url, params, n)
+            if content is None:
+                return None
+            response = json.loads(content)
+            if response.get('error', {}).get('code') != 'maxlag':
+                return response
+            RATE_LIMITER.pause(config.max_lag)
+        logger.error(f'Error API {action} {str(kwargs):.200s}: database lagged')
+        return None
+
+    async def query_pages(self, titles: Sequence[str], n: int = None, **kwargs) -> Dict[str, Optional[Dict]]:
+        """Async version of `query_site_pages`"""
+        kwargs['titles'] = '|'.join(titles)
+        kwargs.setdefault('continue', '')
+        pages: Dict[str, Dict] = {}
+        aliases: Dict[str, str] = {}
+        while True:
+            response = await self.api('query', n, **kwargs)
+            if response is None:
+                return {}
+            if 'error' in response:
+                logger.error(f'API error: {response["error"]}')
+                return {}
+            merge_query_response(response, pages, aliases)
+            if 'continue' not in response:
+                break
+            kwargs.update(response['continue'])
+        return map_query_titles(titles, pages, aliases)
+
+    async def query_in_batches(self, batches: List[Sequence[str]], **kwargs) -> Dict[str, Optional[Dict]]:
+        result: Dict[str, Optional[Dict]] = {}
+        for batch_result in await asyncio.gather(*[self.query_pages(batch, **kwargs) for batch in batches]):
+            result.update(batch_result)
+        logger.debug(f'queried {len(result)} pages in {len(batches)} batches (async)')
+        return result
+
+    async def download(self, url: str, fp: str, n: int = None) -> bool:
+        """Download file to `fp`, file is written to a temp file then renamed"""
+        content = await self.get(url, n=n)
+        if content is None:
+            return False
+        os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+        temp_fp = fp + '.tmp'
+        with open(temp_fp, 'wb') as fd:
+            fd.write(content)
+        os.replace(temp_fp, fp)
+        return True
@@ -7,6 +7,7 @@ import threading
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed  # noqas
+from contextlib import contextmanager
 from inspect import signature
 from pprint import pprint  # noqas
 from typing import Any, List, Dict, Type, Union, Iterable, Optional, Sequence, Tuple, Callable, T, KT, VT  # noqas
@@ -110,7 +111,7 @@ def dump_pickle(obj, fp: str):
 def catch_exception(func):
     """Catch exception then print error and traceback to logger.
 
-    Decorator can be applied to multi-threading but multi-processing
+    Decorator can be applied to multi-threading and forked worker processes
     """
 
     def catch_exception_wrapper(*args, **kwargs):
@@ -140,6 +141,39 @@ def count_time(func):
     return count_time_wrapper
 
 
+class ForkGuard:
+    """Number of running pipeline stages(threads).
+
+    Forking while other threads hold locks(logging, sqlite, rate limiter) deadlocks the child process,
+    so process pools using fork are only created inside `forking()` when at most one stage is running.
+    """
+
+    def __init__(self):
+        self._running_num = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Called before stage thread starts, so that `forking` never misses a starting stage"""
+        with self._lock:
+            self._running_num += 1
+
+    def exit(self):
+        with self._lock:
+            self._running_num -= 1
+
+    @contextmanager
+    def forking(self):
+        """Yield whether it is safe to fork, i.e. at most one stage(the caller) is running.
+
+        No stage is started inside the context, fork(e.g. create and submit to process pool) inside it.
+        """
+        with self._lock:
+            yield self._running_num <= 1
+
+
+FORK_GUARD = ForkGuard()
+
+
 def is_windows():
     return platform.system().lower() == 'windows'
 
@@ -0,0 +1,340 @@
+"""Persistent on-disk cache of wiki pages, parsed records and template results, and in-memory memo caches"""
+import hashlib
+import sqlite3
+import zlib
+from collections import OrderedDict
+
+from .basic import *
+from .config import config
+
+
+def source_hash(modules: Iterable, salt: str = '') -> str:
+    """Hash of `salt` and source files of modules, changed whenever the code is edited"""
+    sha1 = hashlib.sha1(salt.encode())
+    for module in dict.fromkeys(modules):
+        with open(module.__file__, 'rb') as fd:
+            sha1.update(fd.read())
+    return sha1.hexdigest()
+
+
+class PageCache:
+    """Content-addressed page cache.
+
+    Wikitext is saved as zlib compressed blob named by its sha1, an sqlite index maps title to
+    (revid, sha1). Pages sharing the same content share the same blob.
+    """
+
+    def __init__(self, folder: str = None):
+        self._folder = folder
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    @property
+    def folder(self):
+        return self._folder or config.paths.page_cache_folder
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.folder, 'index.db'), check_same_thread=False)
+                self._conn.execute('CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, revid INTEGER, '
+                                   'timestamp TEXT, sha1 TEXT, size INTEGER, fetched REAL, accessed REAL)')
+                # negative cache: titles known to be missing
+                self._conn.execute('CREATE TABLE IF NOT EXISTS missing (title TEXT PRIMARY KEY, checked REAL)')
+                self._conn.commit()
+                self.evict()
+            return self._conn
+
+    def _blob_fp(self, sha1: str):
+        return os.path.join(self.folder, 'blobs', sha1[:2], sha1)
+
+    def get_entry(self, title: str) -> Optional[Dict[str, Any]]:
+        """Index entry of title: {"revid", "timestamp", "sha1", "size", "fetched"}"""
+        with self._lock:
+            row = self.conn.execute('SELECT revid, timestamp, sha1, size, fetched FROM pages WHERE title=?',
+                                    (title,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('revid', 'timestamp', 'sha1', 'size', 'fetched'), row))
+
+    def get(self, title: str, revid: int = None, ttl: float = None) -> Optional[str]:
+        """Get cached wikitext.
+
+        :param title: page title.
+        :param revid: if provided, cached revision must be the same.
+        :param ttl: if provided, cached page must be fetched or validated within `ttl` seconds.
+        :return: wikitext or None if not cached or outdated.
+        """
+        entry = self.get_entry(title)
+        if entry is None:
+            return None
+        if revid is not None and entry['revid'] != revid:
+            return None
+        if ttl is not None and time.time() - entry['fetched'] > ttl:
+            return None
+        try:
+            with open(self._blob_fp(entry['sha1']), 'rb') as fd:
+                content = zlib.decompress(fd.read()).decode('utf8')
+        except (OSError, zlib.error):
+            logger.warning(f'broken page cache of "{title}", drop it')
+            self.remove(title)
+            return None
+        with self._lock:
+            self.conn.execute('UPDATE pages SET accessed=? WHERE title=?', (time.time(), title))
+            self.conn.commit()
+        return content
+
+    def put(self, title: str, content: str, revid: int = None, timestamp: str = None):
+        data = content.encode('utf8')
+        sha1 = hashlib.sha1(data).hexdigest()
+        fp = self._blob_fp(sha1)
+        # hold the lock from writing blob to indexing it, otherwise `evict` may delete the unreferenced blob
+        with self._lock:
+            conn = self.conn
+            if not os.path.exists(fp):
+                os.makedirs(os.path.dirname(fp), exist_ok=True)
+                temp_fp = f'{fp}.{threading.get_ident()}.tmp'
+                with open(temp_fp, 'wb') as fd:
+                    fd.write(zlib.compress(data))
+                os.replace(temp_fp, fp)
+            now = time.time()
+            conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (title, revid, timestamp, sha1, len(data), now, now))
+            conn.execute('DELETE FROM missing WHERE title=?', (title,))
+            conn.commit()
+
+    def is_missing(self, title: str, ttl: float = None) -> bool:
+        """Whether title is known to be missing within `ttl` seconds, default `config.missing_cache_ttl`"""
+        ttl = config.missing_cache_ttl if ttl is None else ttl
+        with self._lock:
+            row = self.conn.execute('SELECT checked FROM missing WHERE title=?', (title,)).fetchone()
+        return row is not None and time.time() - row[0] <= ttl
+
+    def mark_missing(self, title: str):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO missing VALUES (?, ?)', (title, time.time()))
+            self.conn.execute('DELETE FROM pages WHERE title=?', (title,))
+            self.conn.commit()
+
+    def touch(self, title: str):
+        """Mark cached page as validated now"""
+        now = time.time()
+        with self._lock:
+            self.conn.execute('UPDATE pages SET fetched=?, accessed=? WHERE title=?', (now, now, title))
+            self.conn.commit()
+
+    def remove(self, title: str):
+        with self._lock:
+            self.conn.execute('DELETE FROM pages WHERE title=?', (title,))
+            self.conn.commit()
+
+    def evict(self, max_age: float = None, max_size: int = None):
+        """Drop pages not validated within `max_age` seconds, then drop least recently accessed pages
+        until total size less than `max_size` bytes. Unreferenced blobs and expired missing titles are deleted.
+        """
+        max_age = config.page_cache_max_age if max_age is None else max_age
+        max_size = config.page_cache_size if max_size is None else max_size
+        with self._lock:
+            conn = self.conn
+            conn.execute('DELETE FROM pages WHERE fetched<?', (time.time() - max_age,))
+            conn.execute('DELETE FROM missing WHERE checked<?', (time.time() - config.missing_cache_ttl,))
+            total_size = 0
+            for title, size in conn.execute('SELECT title, size FROM pages ORDER BY accessed DESC').fetchall():
+                if total_size + size > max_size:
+                    conn.execute('DELETE FROM pages WHERE title=?', (title,))
+                else:
+                    total_size += size
+            conn.commit()
+            referenced = set(row[0] for row in conn.execute('SELECT DISTINCT sha1 FROM pages'))
+            blob_folder = os.path.join(self.folder, 'blobs')
+            removed = 0
+            if os.path.exists(blob_folder):
+                for sub_folder in os.listdir(blob_folder):
+                    for fn in os.listdir(os.path.join(blob_folder, sub_folder)):
+                        if fn not in referenced and not fn.endswith('.tmp'):
+                            os.remove(os.path.join(blob_folder, sub_folder, fn))
+                            removed += 1
+        if removed:
+            logger.debug(f'page cache: evicted {removed} blobs')
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM pages')
+            self.conn.execute('DELETE FROM missing')
+            self.conn.commit()
+        self.evict()
+
+
+class ParsedCache:
+    """Parsed results of wikitext records, valid while the hash of record and parser code is unchanged"""
+
+    def __init__(self, folder: str = None):
+        self._folder = folder
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    @property
+    def folder(self):
+        return self._folder or config.paths.parsed_cache_folder
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.folder, 'parsed.db'), check_same_thread=False)
+                self._conn.execute('CREATE TABLE IF NOT EXISTS parsed (parser TEXT, key TEXT, hash TEXT, '
+                                   'data BLOB, icons TEXT, PRIMARY KEY (parser, key))')
+                self._conn.commit()
+            return self._conn
+
+    def get(self, parser: str, key: Any, input_hash: str) -> Optional[Tuple[Dict, List[tuple]]]:
+        """:return: (json data, icons registered) or None if not cached or hash changed"""
+        with self._lock:
+            row = self.conn.execute('SELECT data, icons FROM parsed WHERE parser=? AND key=? AND hash=?',
+                                    (parser, str(key), input_hash)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0])), [tuple(x) for x in json.loads(row[1])]
+
+    def put_many(self, parser: str, entries: Iterable[Tuple[Any, str, Dict, List[tuple]]]):
+        """:param entries: list of (key, hash, json data, icons registered)"""
+        rows = [(parser, str(key), input_hash, zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf8')),
+                 json.dumps(icons, ensure_ascii=False)) for key, input_hash, data, icons in entries]
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+    def clear(self, parser: str = None):
+        with self._lock:
+            if parser is None:
+                self.conn.execute('DELETE FROM parsed')
+            else:
+                self.conn.execute('DELETE FROM parsed WHERE parser=?', (parser,))
+            self.conn.commit()
+
+
+class TemplateResultCache:
+    """Results of template extractors(`t_xxx` in `utils.templates`) as json, keyed by hash of template
+    params and extractor source code. Writes are buffered and flushed in batches, least recently used
+    entries are evicted if over `config.template_cache_size` entries.
+    """
+
+    def __init__(self, folder: str = None):
+        self._folder = folder
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._new: Dict[str, bytes] = {}
+        self._hits: set = set()
+
+    @property
+    def folder(self):
+        return self._folder or config.paths.template_cache_folder
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            # forked parser workers must not share the connection of parent process
+            if self._conn is None or self._pid != os.getpid():
+                os.makedirs(self.folder, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.folder, 'templates.db'), timeout=60,
+                                             check_same_thread=False)
+                self._pid = os.getpid()
+                self._conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data BLOB, '
+                                   'accessed REAL)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+                self._conn.commit()
+            return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """:return: json data or None if not cached"""
+        with self._lock:
+            blob = self._new.get(key)
+            if blob is None:
+                row = self.conn.execute('SELECT data FROM results WHERE key=?', (key,)).fetchone()
+                if row is None:
+                    return None
+                blob = row[0]
+                self._hits.add(key)
+        return json.loads(zlib.decompress(blob))
+
+    def put(self, key: str, data: Any):
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf8'))
+        with self._lock:
+            self._new[key] = blob
+            if len(self._new) >= 1000:
+                self.flush()
+
+    def flush(self):
+        """Write buffered results and access time of hits, then evict"""
+        with self._lock:
+            if not self._new and not self._hits:
+                return
+            now = time.time()
+            conn = self.conn
+            conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                             [(key, blob, now) for key, blob in self._new.items()])
+            conn.executemany('UPDATE results SET accessed=? WHERE key=?', [(now, key) for key in self._hits])
+            self._new.clear()
+            self._hits.clear()
+            over_num = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0] - config.template_cache_size
+            if over_num > 0:
+                conn.execute('DELETE FROM results WHERE key IN '
+                             '(SELECT key FROM results ORDER BY accessed LIMIT ?)', (over_num,))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._new.clear()
+            self._hits.clear()
+            self.conn.execute('DELETE FROM results')
+            self.conn.commit()
+
+
+class MemoCache:
+    """Bounded in-memory LRU cache of pure function results, with hit/miss counters"""
+
+    def __init__(self, name: str, maxsize: int = None):
+        """:param maxsize: max entries, default `config.memo_cache_size`, 0 to disable"""
+        self.name = name
+        self._maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        return config.memo_cache_size if self._maxsize is None else self._maxsize
+
+    def get_or_compute(self, key: Any, func: Callable[[], T]) -> T:
+        """Cached result of key, or call `func` and cache its result. Error is not cached."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = func()
+        if self.maxsize > 0:
+            with self._lock:
+                self._data[key] = value
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+PAGE_CACHE = PageCache()
+PARSED_CACHE = ParsedCache()
+TEMPLATE_RESULTS = TemplateResultCache()
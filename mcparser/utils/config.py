@@ -1,5 +1,7 @@
 import base64
 import os
+import threading
+from typing import Optional
 
 import mwclient
 
@@ -15,19 +17,71 @@ class Config:
 
     def __init__(self):
         self.domain = base64.urlsafe_b64decode('ZmdvLndpa2k=').decode('utf-8')
-        self.site = mwclient.Site(self.domain, path='/')
+        self._site: Optional[mwclient.Site] = None
+        self._site_lock = threading.Lock()
         self.url_svt = f'https://{self.domain}/w/%E8%8B%B1%E7%81%B5%E5%9B%BE%E9%89%B4'
         self.url_craft = f'https://{self.domain}/w/%E7%A4%BC%E8%A3%85%E5%9B%BE%E9%89%B4'
         self.url_cmd = f'https://{self.domain}/w/%E6%8C%87%E4%BB%A4%E7%BA%B9%E7%AB%A0%E5%9B%BE%E9%89%B4'
         self.paths = PathManager()
         self.default_workers = 40
         self.net_retry_times = 10
+        # request throttling shared by all downloaders, see `utils.throttle`
+        self.rate_limit = 20  # requests per second
+        self.rate_burst = 20
+        self.max_concurrency = 200  # upper bound of adaptive in-flight requests
+        self.retry_backoff = 1  # seconds, doubled every retry with full jitter
+        self.retry_backoff_max = 60
+        self.max_lag = 5  # API maxlag param, also the pause seconds when database lagged
+        # "thread" - thread pool, "async" - asyncio with pooled connections, see `utils.aio`
+        self.download_backend = 'thread'
+        self.async_workers = 200
+        # page cache: skip download if fetched within ttl, only read cache if offline
+        self.offline = False
+        self.page_cache_ttl = 3600
+        self.page_cache_max_age = 30 * 24 * 3600
+        self.page_cache_size = 512 * 1024 * 1024
+        # missing pages/files are not requested again within ttl
+        self.missing_cache_ttl = 24 * 3600
+        # max entries of on-disk template extractor results, 0 to disable, see `utils.templates.cached_template`
+        self.template_cache_size = 200000
+        # entries of every in-memory memo cache of parse results, see `utils.util.parse_wikitext`
+        self.memo_cache_size = 2048
+        # icon post-processing, see `utils.images`
+        self.image_workers: Optional[int] = None  # default cpu count
+        # (filename pattern, size budget in bytes or None, "png"/"jpeg"), the first matched is used
+        self.image_rules = [('卡背', 200000, 'jpeg'), ('', None, 'png')]
+        self.image_webp = False
+        self.image_thumbnail_sizes = []  # e.g. [64, 128]
+        # "live", "record" or "replay" http traffic, see `utils.replay`
+        self.net_mode = 'live'
+        self.replay_latency = 0.  # seconds injected into every replayed response
+        # "thread" or "process" pool to run `BaseParser.parse`, wikitext parsing is CPU bound
+        self.parse_backend = 'thread'
+        self.parse_workers: Optional[int] = None  # process pool size, default cpu count
+        # skip records whose inputs and parser code are unchanged since last run, see `BaseParser.parse`
+        self.parse_incremental = False
+
+    @property
+    def site(self) -> mwclient.Site:
+        """Connect to wiki site on first use"""
+        with self._site_lock:
+            if self._site is None:
+                from .replay import http_session  # replay depends on this module
+                from .throttle import database_lag_hook
+
+                session = http_session()
+                session.hooks['response'].append(database_lag_hook)
+                # retry is handled by `utils.throttle` rather than mwclient's linear sleeper
+                self._site = mwclient.Site(self.domain, path='/', max_retries=0, pool=session)
+            return self._site
 
 
 class PathManager:
     def __init__(self):
         self.wikitext_folder = 'output/wikitext'
         self.dataset_folder = 'output/dataset'
+        self.cache_folder = 'output/cache'
+        self.fixture_folder = 'output/fixtures'
 
         self.fn_svt = 'servants'
         self.fn_craft = 'crafts'
@@ -39,13 +93,37 @@ class PathManager:
         self.fn_glpk = 'glpk'
         self.fn_dataset = 'dataset.json'
 
+    @property
+    def page_cache_folder(self):
+        return os.path.join(self.cache_folder, 'pages')
+
+    @property
+    def parsed_cache_folder(self):
+        return os.path.join(self.cache_folder, 'parsed')
+
+    @property
+    def template_cache_folder(self):
+        return os.path.join(self.cache_folder, 'templates')
+
+    @property
+    def pipeline_state(self):
+        return os.path.join(self.cache_folder, 'pipeline.json')
+
+    @property
+    def icons_webp_folder(self):
+        return os.path.join(self.dataset_folder, 'icons_webp')
+
+    @property
+    def thumbnails_folder(self):
+        return os.path.join(self.dataset_folder, 'thumbnails')
+
     @property
     def dataset_des(self):
         return os.path.join(self.dataset_folder, self.fn_dataset)
 
     @property
     def svt_src(self):
-        return os.path.join(self.wikitext_folder, f'{self.fn_svt}_src.pkl')
+        return os.path.join(self.wikitext_folder, f'{self.fn_svt}_src.db')
 
     @property
     def svt_des(self):
@@ -53,7 +131,7 @@ class PathManager:
 
     @property
     def craft_src(self):
-        return os.path.join(self.wikitext_folder, f'{self.fn_craft}_src.pkl')
+        return os.path.join(self.wikitext_folder, f'{self.fn_craft}_src.db')
 
     @property
     def craft_des(self):
@@ -61,7 +139,7 @@ class PathManager:
 
     @property
     def cmd_src(self):
-        return os.path.join(self.wikitext_folder, f'{self.fn_cmd}_src.pkl')
+        return os.path.join(self.wikitext_folder, f'{self.fn_cmd}_src.db')
 
     @property
     def cmd_des(self):
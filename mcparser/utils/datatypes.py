@@ -109,6 +109,7 @@ class GameData(Jsonable):
         self.attributes_from_map(data, {'servants': Servant, 'crafts': CraftEssential, 'cmdCodes': CmdCode}, int)
         self.attributes_from_map(data, {'items': Item, 'icons': IconResource, 'freeQuests': Quest, 'svtQuests': Quest})
         super(GameData, self).from_json(data)
+        return self
 
 
 class Servant(Jsonable):
@@ -136,6 +137,7 @@ class Servant(Jsonable):
         self.attributes_from_list(data, {'treasureDevice': TreasureDevice, 'activeSkills': ActiveSkill,
                                          'passiveSkills': Skill, 'profiles': SvtProfileData, 'voices': VoiceTable})
         super(Servant, self).from_json(data)
+        return self
 
 
 class ServantBaseInfo(Jsonable):
@@ -208,6 +210,7 @@ class TreasureDevice(Jsonable):
     def from_json(self, data: Dict):
         self.attributes_from_list(data, {'effects': Effect})
         super(TreasureDevice, self).from_json(data)
+        return self
 
 
 class ActiveSkill(Jsonable):
@@ -222,6 +225,7 @@ class ActiveSkill(Jsonable):
     def from_json(self, data: Dict):
         self.attributes_from_list(data, {'skills': Skill})
         super().from_json(data)
+        return self
 
 
 class Skill(Jsonable):
@@ -244,6 +248,7 @@ class Skill(Jsonable):
     def from_json(self, data: Dict):
         self.attributes_from_list(data, {'effects': Effect})
         super(Skill, self).from_json(data)
+        return self
 
 
 class Effect(Jsonable):
@@ -267,6 +272,7 @@ class ItemCost(Jsonable):
 
     def from_json(self, data: Dict):
         super(ItemCost, self).from_json(data)
+        return self
 
 
 class SvtProfileData(Jsonable):
@@ -287,6 +293,7 @@ class VoiceTable(Jsonable):
     def from_json(self, data: Dict):
         self.attributes_from_list(data, {'table': VoiceRecord})
         super(VoiceTable, self).from_json(data)
+        return self
 
     def __repr__(self):
         return self._get_repr(self.section)
@@ -396,6 +403,11 @@ class Quest(Jsonable):
     def __repr__(self):
         return self._get_repr(self.name)
 
+    def from_json(self, data: Dict):
+        self.attributes_from_list(data, {'battles': Battle})
+        super(Quest, self).from_json(data)
+        return self
+
     def get_all_drop_items(self):
         result: Dict[str, int] = {}
         for battle in self.battles:
@@ -421,8 +433,11 @@ class Battle(Jsonable):
         return self._get_repr(self.place)
 
     def from_json(self, data: Dict):
-        self.enemies = [[Enemy().from_json(ee) for ee in e] for e in data.pop('enemies', [])]
+        # empty position of wave is None
+        self.enemies = [[Enemy().from_json(ee) if ee is not None else None for ee in e]
+                        for e in data.pop('enemies', [])]
         super().from_json(data)
+        return self
 
 
 class Enemy(Jsonable):
@@ -450,6 +465,12 @@ class IconResource(Jsonable):
         self.originName = ''
         self.url = ''
         self.save: bool = True
+        # image info of downloaded file
+        self.sha1 = ''
+        self.size = 0
+        self.timestamp = ''
+        # sha1 of local file after post-processing, differs from `sha1` if recompressed
+        self.localSha1 = ''
         super().__init__(**kwargs)
 
     def __repr__(self):
@@ -467,6 +488,7 @@ class Events(Jsonable):
         self.attributes_from_map(data, {'limitEvents': LimitEvent, 'mainRecords': MainRecord,
                                         'exchangeTickets': ExchangeTicket})
         super().from_json(data)
+        return self
 
 
 class EventBase(Jsonable):
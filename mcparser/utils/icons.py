@@ -1,8 +1,9 @@
-from urllib.request import urlretrieve
-
-from PIL import Image
+import hashlib
+from contextlib import contextmanager
 
+from .aio import *
 from .datatypes import *
+from .images import *
 from .util import *
 
 
@@ -18,22 +19,31 @@ class Icons:
     def __init__(self):
         self.data: Dict[str, IconResource] = {}
         self._initiated = False
+        # (filename, key, save, allow_none) to be resolved in `flush()`
+        self._pending: List[Tuple[str, Optional[str], bool, bool]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
     def add(self, filename: str, key: str = None, save: bool = True, allow_none=False):
-        """
+        """Register an icon, its file url is resolved later in batches by `flush()`.
+
         :param filename: full name with suffix, if no suffix, will try filename.jpg and filename.png
         :param key: override default key(filename) for FileResource
         :param save: whether to download icon in self.download_icons()
         :param allow_none: check icon exist
-        :return: dict key
+        :return: dict key if already resolved, the key of resolved suffix may differ if filename has no suffix.
+            None if not resolved yet, it is resolved(or reported missing) by `flush()`.
         """
         if not self._initiated:
             # icon data is commonly used
             logger.warning(f'load icons json data before using it, load default "{config.paths.icon_des}" if exist')
             self.load()
+        records = getattr(self._local, 'records', None)
+        if records is not None:
+            records.append((filename, key, save, allow_none))
         fn_split = re.split(r'[(（]有框[)）]', filename)
         if len(fn_split) > 1:
-            print(f'add a 无框 version of {"".join(fn_split)}')
+            logger.debug(f'add a 无框 version of {"".join(fn_split)}')
             self.add(''.join(fn_split))
         if key and key in self.data:
             icon = self.data[key]
@@ -43,22 +53,64 @@ class Icons:
             return key
         if filename in self.data:
             return filename
-        for fn in (filename, filename + '.png', filename + '.jpg'):
-            info = get_site_page(fn, True).imageinfo
-            if info != {}:
-                key = key or fn
-                icon = IconResource()
-                icon.name = key
-                icon.originName = fn
-                icon.url = info['url']
-                icon.save = save
-                self.data[key] = icon
-                logger.debug(f'add icon: {key}')
-                return key
-        if not allow_none:
-            logger.warning(f'Adding icon: "{filename}" not exist!')
+        if key is None:
+            for fn in (filename + '.png', filename + '.jpg'):
+                if fn in self.data:
+                    return fn
+        with self._lock:
+            self._pending.append((filename, key, save, allow_none))
         return None
 
+    @contextmanager
+    def recording(self):
+        """Record all icons added in current thread, the records can be passed to `extend_pending`"""
+        records: List[Tuple[str, Optional[str], bool, bool]] = []
+        self._local.records = records
+        try:
+            yield records
+        finally:
+            self._local.records = None
+
+    def pop_pending(self) -> List[Tuple[str, Optional[str], bool, bool]]:
+        """Take out icons added but not resolved yet, e.g. registrations in parser worker process"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def extend_pending(self, pending: Iterable[Tuple[str, Optional[str], bool, bool]]):
+        """Merge registrations returned by `pop_pending()` of worker process"""
+        with self._lock:
+            self._pending.extend(pending)
+
+    def flush(self, workers: int = None, backend: str = None):
+        """Resolve all pending icons, 50 files(all suffix variants) per API request"""
+        pending = self.pop_pending()
+        if not pending:
+            return
+        filenames = [fn for filename, *_ in pending for fn in (filename, filename + '.png', filename + '.jpg')]
+        infos = get_site_imageinfo(filenames, workers=workers, backend=backend)
+        for filename, key, save, allow_none in pending:
+            variants = (filename, filename + '.png', filename + '.jpg')
+            if key in self.data or (key is None and any(fn in self.data for fn in variants)):
+                # added by previous pending entry
+                continue
+            for fn in variants:
+                info = infos.get(fn)
+                if info:
+                    key = key or fn
+                    icon = IconResource()
+                    icon.name = key
+                    icon.originName = fn
+                    icon.url = info['url']
+                    icon.save = save
+                    self.data[key] = icon
+                    logger.debug(f'add icon: {key}')
+                    break
+            else:
+                if not allow_none:
+                    logger.warning(f'Adding icon: "{filename}" not exist!')
+        logger.info(f'resolved {len(pending)} icons')
+
     def add_common_icons(self):
         jpg_fn = [fn + '.jpg' for fn in ('QP', '圣杯', '传承结晶')]  # also have .png
         png_fn = [fn + '.png' for fn in ('圣杯传承结晶', 'Quick', 'Arts', 'Buster',
@@ -72,49 +124,120 @@ class Icons:
         self.add('Beast.png', '金卡Beast.png')
         self.add('Beast-gray.png', '铜卡Beast.png')
 
-    def download_icons(self, icon_dir: str = None, force=False, workers: int = None):
+    def download_icons(self, icon_dir: str = None, force=False, workers: int = None, backend: str = None):
+        """Download new icons and icons changed on wiki, compared by sha1 of image info.
+
+        :param force: check the hash of local files rather than the recorded sha1.
+        :param backend: "thread" or "async", default `config.download_backend`.
+        """
         icon_dir = icon_dir or config.paths.icons_folder
         logger.info(f'downloading icons to {icon_dir}')
         self.add_common_icons()
+        self.flush(workers, backend)
         os.makedirs(icon_dir, exist_ok=True)
 
+        # latest image info of all saved icons, 50 files per request
+        saved_keys = [k for k, icon in self.data.items() if icon.save]
+        infos = get_site_imageinfo([self.data[k].originName or self.data[k].name for k in saved_keys],
+                                   workers=workers, backend=backend)
+        download_infos: Dict[str, Dict] = {}
+        for key in saved_keys:
+            icon = self.data[key]
+            info = infos.get(icon.originName or icon.name)
+            if self._need_download(icon, os.path.join(icon_dir, icon.name), info, force):
+                download_infos[key] = info or {}
+        logger.info(f'{len(download_infos)}/{len(saved_keys)} icons are new or changed')
+        downloaded: List[str] = []
+
         @catch_exception
         def _down_icon(key):
             icon = self.data[key]
             icon_fp = os.path.join(icon_dir, icon.name)
-            if not icon.url:
-                # resolve exact file url
-                icon.url = get_site_page(icon.originName or icon.name, isfile=True).imageinfo.get('url', None)
-            if icon.save and icon.url and (force or not os.path.exists(icon_fp)):
-                urlretrieve(icon.url, icon_fp)
+            temp_fp = icon_fp + '.tmp'
+            download_url(icon.url, temp_fp)
+            os.replace(temp_fp, icon_fp)
+            logger.debug(f'downloaded {icon.name}')
+            self._set_image_info(icon, download_infos[key])
+            downloaded.append(key)
+
+        if (backend or config.download_backend) == 'async':
+            downloaded = AsyncFetcher.run(lambda fetcher: self._download_icons_async(fetcher, icon_dir, download_infos))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
+            tasks = [executor.submit(_down_icon, k) for k in download_infos.keys()]
+            finish_num, all_num = 0, len(tasks)
+            for _ in as_completed(tasks):
+                finish_num += 1
+                print(f'\rdownloaded icon {finish_num}/{all_num}...', end='\r')
+        # image post-processing in process pool
+        gray_copies = dict([(f'{s}强化.png', f'{s}未强化.png') for s in ('技能', '宝具')])
+        process_images(icon_dir, [self.data[k].name for k in downloaded], gray_copies)
+        for key in downloaded:
+            icon = self.data[key]
+            icon.localSha1 = self._file_sha1(os.path.join(icon_dir, icon.name))
+        for filename in gray_copies.values():
+            self.data[filename] = IconResource(name=filename, url=None, save=False)
+        logger.info(f'downloaded all icon files to "{icon_dir}"')
+
+    async def _download_icons_async(self, fetcher: AsyncFetcher, icon_dir: str,
+                                    download_infos: Dict[str, Dict]) -> List[str]:
+        """Return keys of downloaded icons"""
+        finish_num, all_num = 0, len(download_infos)
+        downloaded: List[str] = []
+
+        async def _down_icon(key):
+            nonlocal finish_num
+            icon = self.data[key]
+            if await fetcher.download(icon.url, os.path.join(icon_dir, icon.name)):
                 logger.debug(f'downloaded {icon.name}')
-            else:
-                # print(f'skip download {item["filename"]}')
-                pass
-            if '卡背' in key and os.stat(icon_fp).st_size > 200000:
-                Image.open(icon_fp).convert('RGB').save(icon_fp, format='jpeg')
-                logger.info(f'compress icon {key}')
-
-        executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
-        tasks = [executor.submit(_down_icon, k) for k in self.data.keys()]
-        finish_num, all_num = 0, len(tasks)
-        for _ in as_completed(tasks):
+                self._set_image_info(icon, download_infos[key])
+                downloaded.append(key)
             finish_num += 1
             print(f'\rdownloaded icon {finish_num}/{all_num}...', end='\r')
-        for s in ('技能', '宝具'):
-            img: Image.Image = Image.open(os.path.join(icon_dir, f'{s}强化.png'))
-            palette = img.getpalette()
-            for i in range(len(palette) // 3):
-                gray = (palette[3 * i] * 299 + palette[3 * i + 1] * 587 + palette[3 * i + 2] * 114) // 1000
-                palette[3 * i:3 * i + 3] = [gray, gray, gray]
-            img.putpalette(palette)
-            filename = f'{s}未强化.png'
-            img.save(os.path.join(icon_dir, filename), format="png")
-            self.data[filename] = IconResource(name=filename, url=None, save=False)
-        logger.info(f'downloaded all icon files to "{icon_dir}"')
+
+        await asyncio.gather(*[_down_icon(k) for k in download_infos.keys()])
+        return downloaded
+
+    @staticmethod
+    def _need_download(icon: IconResource, icon_fp: str, info: Optional[Dict], force=False) -> bool:
+        """
+        :param info: latest image info, None if unknown or file missing on wiki.
+        """
+        if info:
+            icon.url = info['url']
+        if not icon.url:
+            return False
+        if not os.path.exists(icon_fp):
+            return True
+        if not info:
+            # keep local file
+            return False
+        if icon.sha1 and not force:
+            return icon.sha1 != info['sha1']
+        # sha1 not recorded(downloaded by old version) or forced, check local file.
+        # local file is post-processed after downloading, compare it with the recorded hash of processed file
+        local_sha1 = Icons._file_sha1(icon_fp)
+        if local_sha1 != info['sha1'] and (icon.sha1 != info['sha1'] or icon.localSha1 != local_sha1):
+            return True
+        Icons._set_image_info(icon, info)
+        icon.localSha1 = local_sha1
+        return False
+
+    @staticmethod
+    def _file_sha1(fp: str) -> str:
+        with open(fp, 'rb') as fd:
+            return hashlib.sha1(fd.read()).hexdigest()
+
+    @staticmethod
+    def _set_image_info(icon: IconResource, info: Dict):
+        if info:
+            icon.sha1 = info['sha1']
+            icon.size = info['size']
+            icon.timestamp = info['timestamp']
 
     def dump(self, fp: str = None):
         """Call `download_icon()` before dump icons json"""
+        self.flush()
         fp = fp or config.paths.icon_des
         dump_json(self.data, fp, default=lambda o: o.to_json(), sort_keys=True)
         logger.info(f'dump icons data at "{fp}"')
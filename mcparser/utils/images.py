@@ -0,0 +1,169 @@
+"""Image post-processing of downloaded icons.
+
+Pillow transforms are CPU bound, so they run in a process pool rather than in download threads:
+- recompression: lossless optimize of png, lossy jpeg whose quality is lowered until fit the size budget
+- optional webp copies and multi-resolution thumbnails
+"""
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from .basic import *
+from .config import config
+
+# quality steps to fit jpeg into size budget
+kJpegQualities = (90, 85, 80, 75, 70, 60, 50)
+
+
+def match_image_rule(filename: str) -> Tuple[Optional[int], str]:
+    """The first rule of `config.image_rules` whose pattern matches filename.
+
+    :return: (max_bytes, fmt), `max_bytes` is the size budget or None, `fmt` is "png" or "jpeg".
+    """
+    for pattern, max_bytes, fmt in config.image_rules:
+        if re.search(pattern, filename):
+            return max_bytes, fmt
+    return None, 'png'
+
+
+def _encode(img: Image.Image, fmt: str, max_bytes: int = None) -> bytes:
+    if fmt == 'jpeg':
+        rgb_img = img.convert('RGB')
+        data = b''
+        for quality in kJpegQualities:
+            buffer = io.BytesIO()
+            rgb_img.save(buffer, format='jpeg', quality=quality, optimize=True)
+            data = buffer.getvalue()
+            if max_bytes is None or len(data) <= max_bytes:
+                break
+        return data
+    buffer = io.BytesIO()
+    img.save(buffer, format='png', optimize=True)
+    return buffer.getvalue()
+
+
+def _write_atomic(fp: str, data: bytes):
+    os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+    temp_fp = f'{fp}.{os.getpid()}.tmp'
+    with open(temp_fp, 'wb') as fd:
+        fd.write(data)
+    os.replace(temp_fp, fp)
+
+
+def process_image(fp: str, max_bytes: Optional[int], fmt: str, webp_fp: str = None,
+                  thumbnails: Sequence[Tuple[int, str]] = ()) -> Tuple[int, int]:
+    """Run in worker process, recompress image in place and write extra copies.
+
+    Image is only recompressed if the result is smaller. Lossy jpeg is used only if over budget,
+    file name is kept even if its format changed. Animated image is never recompressed since
+    only its first frame would be saved, its thumbnails are the first frame.
+
+    :param fp: image file path.
+    :param max_bytes: size budget.
+    :param fmt: "png" or "jpeg".
+    :param webp_fp: if provided, save a webp copy.
+    :param thumbnails: list of (size, fp) of thumbnails.
+    :return: (old size, new size) in bytes
+    """
+    old_size = os.stat(fp).st_size
+    data = None
+    # keep file open, frames of animated image are read when saving webp
+    with Image.open(fp) as img:
+        img.load()
+        animated = getattr(img, 'is_animated', False)
+        if animated:
+            logger.debug(f'skip recompressing animated image "{fp}"')
+        elif fmt == 'jpeg' and (max_bytes is None or old_size > max_bytes):
+            data = _encode(img, 'jpeg', max_bytes)
+        elif img.format == 'PNG':
+            data = _encode(img, 'png')
+        if webp_fp:
+            buffer = io.BytesIO()
+            img.save(buffer, format='webp', lossless=img.format == 'PNG', quality=80, method=6, save_all=animated)
+            _write_atomic(webp_fp, buffer.getvalue())
+        for size, thumb_fp in thumbnails:
+            thumb = img.copy()
+            thumb.thumbnail((size, size))
+            buffer = io.BytesIO()
+            thumb.save(buffer, format=img.format or 'png')
+            _write_atomic(thumb_fp, buffer.getvalue())
+    if data is not None and len(data) < old_size:
+        _write_atomic(fp, data)
+    return old_size, os.stat(fp).st_size
+
+
+def gray_palette(src_fp: str, dest_fp: str) -> Tuple[int, int]:
+    """Save a grayscale copy of palette image, return (size, size)"""
+    img: Image.Image = Image.open(src_fp)
+    palette = img.getpalette()
+    for i in range(len(palette) // 3):
+        gray = (palette[3 * i] * 299 + palette[3 * i + 1] * 587 + palette[3 * i + 2] * 114) // 1000
+        palette[3 * i:3 * i + 3] = [gray, gray, gray]
+    img.putpalette(palette)
+    img.save(dest_fp, format="png")
+    size = os.stat(dest_fp).st_size
+    return size, size
+
+
+@count_time
+def process_images(folder: str, filenames: Iterable[str], gray_copies: Dict[str, str] = None,
+                   workers: int = None):
+    """Post-process images in process pool.
+
+    Size budget of every image category is defined in `config.image_rules`, webp copies are saved in
+    `config.paths.icons_webp_folder` if `config.image_webp`, thumbnails of `config.image_thumbnail_sizes`
+    are saved in `config.paths.thumbnails_folder/{size}`.
+
+    :param folder: image folder.
+    :param filenames: images to process.
+    :param gray_copies: dict of src filename - dest filename, save grayscale copy of palette image
+        if src is in `filenames`(changed) or dest is missing.
+    :param workers: max processes, default `config.image_workers` or cpu count.
+        Threads are used instead if other pipeline stages are running, see `FORK_GUARD`.
+    """
+    filenames = list(filenames)
+    tasks = []
+    for filename in filenames:
+        fp = os.path.join(folder, filename)
+        if not os.path.exists(fp):
+            continue
+        webp_fp = None
+        if config.image_webp:
+            webp_fp = os.path.join(config.paths.icons_webp_folder, os.path.splitext(filename)[0] + '.webp')
+        thumbnails = [(size, os.path.join(config.paths.thumbnails_folder, str(size), filename))
+                      for size in config.image_thumbnail_sizes]
+        tasks.append((filename, process_image, (fp, *match_image_rule(filename), webp_fp, thumbnails)))
+    for src, dest in (gray_copies or {}).items():
+        src_fp, dest_fp = os.path.join(folder, src), os.path.join(folder, dest)
+        if os.path.exists(src_fp) and (src in filenames or not os.path.exists(dest_fp)):
+            tasks.append((dest, gray_palette, (src_fp, dest_fp)))
+    if not tasks:
+        return
+
+    max_workers = workers or config.image_workers or os.cpu_count()
+    with FORK_GUARD.forking() as safe:
+        if safe:
+            # workers are forked(default on linux) at the first submit
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            futures = dict([(executor.submit(func, *args), filename) for filename, func, args in tasks])
+    if not safe:
+        logger.warning('forking alongside other pipeline stages may deadlock, process images in threads instead')
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = dict([(executor.submit(func, *args), filename) for filename, func, args in tasks])
+    finish_num, all_num = 0, len(futures)
+    old_total, new_total = 0, 0
+    for future in as_completed(futures):
+        finish_num += 1
+        try:
+            old_size, new_size = future.result()
+        except Exception as e:
+            logger.error(f'failed to process image "{futures[future]}": {e!r}')
+            continue
+        old_total += old_size
+        new_total += new_size
+        if old_size and new_size < old_size:
+            logger.debug(f'compressed {futures[future]}: {old_size} -> {new_size} bytes')
+        print(f'\rprocessed image {finish_num}/{all_num}...', end='\r')
+    executor.shutdown()
+    logger.info(f'processed {all_num} images, {old_total} -> {new_total} bytes')
@@ -0,0 +1,138 @@
+"""Record and replay http traffic for offline and reproducible runs.
+
+`config.net_mode`:
+    - "live": default, nothing recorded
+    - "record": all responses are saved in fixture store at `config.paths.fixture_folder`
+    - "replay": responses are served from fixture store after `config.replay_latency` seconds, no network used
+
+mwclient site(`config.site`), `fetch_url`, `download_url` and `AsyncFetcher` are covered.
+Requests are matched by method, url and params, replay with the same download backend as recording.
+"""
+import hashlib
+import sqlite3
+import zlib
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .basic import *
+from .config import config
+
+# headers invalid after content decoded
+kDroppedHeaders = ('content-encoding', 'content-length', 'transfer-encoding')
+
+
+class FixtureMissing(requests.RequestException):
+    """Request is not recorded in fixture store"""
+
+
+def request_key(method: str, url: str, params: Dict = None, body: Union[str, bytes] = None) -> str:
+    """Hash of method, url without query and sorted query/form params"""
+    parts = urlsplit(url)
+    items = parse_qsl(parts.query, keep_blank_values=True)
+    items += [(str(k), str(v)) for k, v in (params or {}).items()]
+    if body:
+        if isinstance(body, bytes):
+            body = body.decode('utf8', errors='replace')
+        items += parse_qsl(body, keep_blank_values=True)
+    base_url = urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+    return hashlib.sha1(json.dumps([method.upper(), base_url, sorted(items)], ensure_ascii=False)
+                        .encode('utf8')).hexdigest()
+
+
+class FixtureStore:
+    """Recorded responses saved in sqlite, body is zlib compressed"""
+
+    def __init__(self, folder: str = None):
+        self._folder = folder
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    @property
+    def folder(self):
+        return self._folder or config.paths.fixture_folder
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.folder, 'fixtures.db'), check_same_thread=False)
+                self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, method TEXT, '
+                                   'url TEXT, status INTEGER, headers TEXT, body BLOB, recorded REAL)')
+                self._conn.commit()
+            return self._conn
+
+    def save(self, key: str, method: str, url: str, status: int, headers: Dict[str, str], body: bytes):
+        headers = dict([(k, v) for k, v in headers.items() if k.lower() not in kDroppedHeaders])
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (key, method, url, status, json.dumps(headers), zlib.compress(body), time.time()))
+            self.conn.commit()
+
+    def load(self, key: str) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+        """:return: (status, headers, body) or None if not recorded"""
+        with self._lock:
+            row = self.conn.execute('SELECT status, headers, body FROM responses WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), zlib.decompress(row[2])
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Transport adapter of requests session, record or replay responses by `config.net_mode`"""
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        key = request_key(request.method, request.url, body=request.body)
+        if config.net_mode == 'replay':
+            return self._replay(request, key)
+        response = super().send(request, **kwargs)
+        if config.net_mode == 'record':
+            FIXTURES.save(key, request.method, request.url, response.status_code, dict(response.headers),
+                          response.content)
+        return response
+
+    def _replay(self, request: requests.PreparedRequest, key: str) -> requests.Response:
+        record = FIXTURES.load(key)
+        if record is None:
+            raise FixtureMissing(f'{request.method} {request.url:.200s} not recorded', request=request)
+        time.sleep(config.replay_latency)
+        status, headers, body = record
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = 'Replayed'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+def http_session() -> requests.Session:
+    """New requests session with `ReplayAdapter` mounted"""
+    session = requests.Session()
+    adapter = ReplayAdapter(pool_connections=4, pool_maxsize=config.default_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_url(url: str, timeout: float = 120) -> bytes:
+    """GET url and return content, raise `requests.HTTPError` if failed"""
+    response = HTTP_SESSION.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def download_url(url: str, fp: str, timeout: float = 120):
+    content = fetch_url(url, timeout)
+    with open(fp, 'wb') as fd:
+        fd.write(content)
+
+
+FIXTURES = FixtureStore()
+HTTP_SESSION = http_session()
@@ -0,0 +1,121 @@
+"""Wikitext store of `WikiGetter` with per-record random access.
+
+Every record(row of DataFrame) is saved as zlib compressed json in sqlite, so parsers can fetch
+only the records they need. Legacy pickled DataFrame(.pkl) is still readable.
+"""
+import sqlite3
+import zlib
+
+from .basic import *
+
+kSqliteHeader = b'SQLite format 3\x00'
+
+
+class WikitextStore:
+    def __init__(self, fp: str):
+        """
+        :param fp: sqlite file written by `dump`, whatever its suffix. If it is a legacy pickled DataFrame
+            or not exist but "{fp_stem}.pkl" exists, read the pickled DataFrame.
+        """
+        self.fp = fp
+        self._df: Optional[pd.DataFrame] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        legacy_fp = os.path.splitext(fp)[0] + '.pkl'
+        # format is detected by file header rather than suffix, `dump` may write sqlite to a ".pkl" path
+        if os.path.exists(fp) and not self.is_sqlite(fp):
+            self._df = load_pickle(fp, pd.DataFrame())
+        elif not os.path.exists(fp) and os.path.exists(legacy_fp):
+            logger.info(f'load legacy wikitext pickle "{legacy_fp}"')
+            self._df = load_pickle(legacy_fp)
+        elif not os.path.exists(fp):
+            self._df = pd.DataFrame()
+        else:
+            self._conn = sqlite3.connect(fp, check_same_thread=False)
+
+    @staticmethod
+    def is_sqlite(fp: str) -> bool:
+        with open(fp, 'rb') as fd:
+            return fd.read(len(kSqliteHeader)) == kSqliteHeader
+
+    def _query(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def keys(self) -> List[int]:
+        if self._df is not None:
+            return list(self._df.index)
+        return [row[0] for row in self._query('SELECT id FROM records ORDER BY rowid')]
+
+    def columns(self) -> List[str]:
+        if self._df is not None:
+            return list(self._df.columns)
+        return json.loads(self._query("SELECT value FROM meta WHERE key='columns'")[0][0])
+
+    def name_links(self) -> Dict[int, str]:
+        """Dict of key - "name_link" column, without loading the whole records"""
+        if self._df is not None:
+            return self._df['name_link'].to_dict() if 'name_link' in self._df.columns else {}
+        return dict(self._query('SELECT id, name_link FROM records ORDER BY rowid'))
+
+    def get(self, key: int, default=None) -> Optional[Dict[str, Any]]:
+        """Record of key, dict of column - value"""
+        if self._df is not None:
+            return self._df.loc[key].to_dict() if key in self._df.index else default
+        rows = self._query('SELECT data FROM records WHERE id=?', (int(key),))
+        return json.loads(zlib.decompress(rows[0][0])) if rows else default
+
+    def __getitem__(self, key: int) -> Dict[str, Any]:
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __contains__(self, key: int):
+        return self.get(key) is not None
+
+    def __len__(self):
+        if self._df is not None:
+            return len(self._df.index)
+        return self._query('SELECT COUNT(*) FROM records')[0][0]
+
+    def items(self, keys: Iterable[int] = None) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        """Iterate records one by one"""
+        for key in (self.keys() if keys is None else keys):
+            record = self.get(key)
+            if record is not None:
+                yield key, record
+
+    def to_dataframe(self) -> pd.DataFrame:
+        if self._df is not None:
+            return self._df.copy()
+        keys, records = [], []
+        for key, record in self.items():
+            keys.append(key)
+            records.append(record)
+        return pd.DataFrame(records, index=pd.Index(keys, name='id'), columns=self.columns(), dtype=object)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+    @staticmethod
+    def dump(df: pd.DataFrame, fp: str):
+        """Save DataFrame to sqlite file, written to a temp file then renamed"""
+        os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+        temp_fp = fp + '.tmp'
+        if os.path.exists(temp_fp):
+            os.remove(temp_fp)
+        conn = sqlite3.connect(temp_fp)
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE records (id INTEGER PRIMARY KEY, name_link TEXT, data BLOB)')
+        conn.execute("INSERT INTO meta VALUES ('columns', ?)", (json.dumps(list(df.columns), ensure_ascii=False),))
+        has_link = 'name_link' in df.columns
+        conn.executemany('INSERT INTO records VALUES (?, ?, ?)', [
+            (int(key), record['name_link'] if has_link else None,
+             zlib.compress(json.dumps(record, ensure_ascii=False).encode('utf8')))
+            for key, record in zip(df.index, df.to_dict('records'))
+        ])
+        conn.commit()
+        conn.close()
+        os.replace(temp_fp, fp)
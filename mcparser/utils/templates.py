@@ -1,4 +1,7 @@
 """Parse templates parameters to instance"""
+import functools
+import hashlib
+
 from .datatypes import *
 from .util import *
 
@@ -27,9 +30,14 @@ def p_items(code: Wikitext):
 
 def p_quest_reward_drop(code: Wikicode, skip_free_drop=True):
     """Parse rewards nd drops of multiple quests"""
+    quests = [t_quest(parse_template(template)) for template in code.filter_templates(matches='^{{关卡配置')]
+    return sum_quest_reward_drop(quests, skip_free_drop)
+
+
+def sum_quest_reward_drop(quests: Iterable[Quest], skip_free_drop=True):
+    """Total rewards and drops of parsed quests"""
     drops, rewards = {}, {}  # type:Dict[str,int]
-    for template in code.filter_templates(matches='^{{关卡配置'):
-        quest = t_quest(parse_template(template))
+    for quest in quests:
         add_dict(rewards, quest.rewards)
         if not quest.isFree or not skip_free_drop:  # hard quest - like free
             for battle in quest.battles:
@@ -57,6 +65,86 @@ def p_event_shop(code: Wikicode):
     return result
 
 
+# %% declarative field specs
+class Field:
+    def __init__(self, attr: str, keys: Union[str, Sequence[str]], default=None, cast: Callable = None,
+                 tags: Union[bool, Sequence[str]] = None):
+        """Attribute `attr` is set to the value of the first present key.
+
+        :param keys: one key or candidate keys in priority.
+        :param default: used if no key is present or cast failed.
+        """
+        self.attr = attr
+        self.keys = (keys,) if isinstance(keys, str) else tuple(keys)
+        self.default = default
+        self.cast = cast
+        self.tags = tags
+
+
+class ListField(Field):
+    def __init__(self, attr: str, keys: Sequence[str], tags: Union[bool, Sequence[str]] = None):
+        """Values of all present keys are appended to list attribute `attr` in order, empty value is skipped"""
+        super().__init__(attr, keys, tags=tags)
+
+
+class TemplateSpec:
+    """Fields of one template, only present keys are read and their tags are removed on first access.
+
+    Fields need custom logic are still handled in `t_*` function after `extract`.
+    """
+
+    def __init__(self, *fields: Field):
+        self.fields = fields
+
+    def extract(self, params: Params, instance: T) -> T:
+        for field in self.fields:
+            keys = [key for key in field.keys if key in params]
+            if isinstance(field, ListField):
+                values = getattr(instance, field.attr)
+                for key in keys:
+                    list_append(values, params.get(key, tags=field.tags))
+            elif keys:
+                setattr(instance, field.attr, params.get(keys[0], field.default, field.cast, field.tags))
+            else:
+                setattr(instance, field.attr, field.default)
+        return instance
+
+
+# %% persistent cache of extractor results
+def _template_version() -> str:
+    """Hash of source code that extractor results depend on"""
+    if 'template_version' not in G:
+        G['template_version'] = source_hash([sys.modules[__name__], sys.modules[Jsonable.__module__],
+                                             sys.modules[Params.__module__]])
+    return G['template_version']
+
+
+def cached_template(value_type: Type[Jsonable]):
+    """Decorator of `t_xxx(params, instance=None)` whose result only depends on params.
+
+    New instance is looked up in `TEMPLATE_RESULTS` by params and `_template_version()` first, and
+    is saved as json after parsed. Calls filling an existing instance are not cached.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def cached_template_wrapper(params: Params, instance=None):
+            if instance is not None or config.template_cache_size <= 0:
+                return func(params, instance)
+            key = hashlib.sha1(json.dumps([func.__name__, _template_version(), list(params.items())],
+                                          ensure_ascii=False, default=str).encode('utf8')).hexdigest()
+            data = TEMPLATE_RESULTS.get(key)
+            if data is not None:
+                return value_type().from_json(data)
+            instance = func(params)
+            TEMPLATE_RESULTS.put(key, instance.to_json(False, 'json'))
+            return instance
+
+        return cached_template_wrapper
+
+    return decorator
+
+
 # %% common used
 def t_one_item(params: Params) -> Tuple[str, int]:
     """{{道具}}{{材料消耗}}{{素材}}"""
@@ -73,42 +161,45 @@ def t_one_item(params: Params) -> Tuple[str, int]:
 kUnavailableSvt = (83, 149, 151, 152, 168, 240)
 
 
+kNameSuffixes = ['战斗名', '卡面名'] + [f'名{i}' for i in range(2, 11)]
+kBaseInfoSpec = TemplateSpec(
+    Field('no', '序号', cast=int),
+    Field('rarity', '稀有度', cast=int),
+    Field('obtain', '获取途径', '无法召唤'),
+    Field('name', ('中文名', '姓名')),
+    Field('nameJp', '日文名'),
+    Field('nameEn', '英文名'),
+    ListField('namesOther', [f'中文{s}' for s in kNameSuffixes] + ['简称'], tags=True),
+    ListField('namesJpOther', [f'日文{s}' for s in kNameSuffixes] + ['日文简称'], tags=True),
+    ListField('namesEnOther', [f'英文{s}' for s in kNameSuffixes] + ['英文简称'], tags=True),
+    ListField('cv', ['声优', '声优2', '声优3', '声优新'], tags=True),
+    Field('illustrator', '画师'),
+    ListField('alignments', ['属性1', '属性12', '属性2', '属性22']),
+    Field('gender', '性别', ''),
+    Field('height', '身高', ''),
+    Field('weight', '体重', ''),
+    Field('attribute', '隐藏属性'),
+    Field('className', '职阶'),
+    Field('atkMin', '基础ATK', -1, int),
+    Field('atkMax', '满级ATK', -1, int),
+    Field('atk90', '90级ATK', -1, int),
+    Field('atk100', '100级ATK', -1, int),
+    Field('hpMin', '基础HP', -1, int),
+    Field('hpMax', '满级HP', -1, int),
+    Field('hp90', '90级HP', -1, int),
+    Field('hp100', '100级HP', -1, int),
+    ListField('traits', ['特性'] + [f'特性{i}' for i in range(1, 14)]),
+)
+
+
 def t_base_info(params: Params, instance: ServantBaseInfo = None):
     """{{基础数值}}"""
     if instance is None:
         instance = ServantBaseInfo()
-    instance.no = params.get('序号', cast=int)
-    instance.rarity = params.get('稀有度', cast=int)
+    kBaseInfoSpec.extract(params, instance)
     instance.rarity2 = {1: 3, 107: 2}.get(instance.no, instance.rarity)  # for 玛修&小安
-    instance.obtain = params.get('获取途径', '无法召唤')
-
-    instance.name = params.get('中文名', default=params.get('姓名'))
-    instance.nameJp = params.get('日文名')
-    instance.nameEn = params.get('英文名')
-    for i in range(11):
-        suffix = '战斗名' if i == 0 else '卡面名' if i == 1 else f'名{i}'
-        list_append(instance.namesOther, params.get('中文' + suffix, tags=True))
-        list_append(instance.namesJpOther, params.get('日文' + suffix, tags=True))
-        list_append(instance.namesEnOther, params.get('英文' + suffix, tags=True))
-    list_append(instance.namesOther, params.get('简称', tags=True))
-    list_append(instance.namesJpOther, params.get('日文简称', tags=True))
-    list_append(instance.namesEnOther, params.get('英文简称', tags=True))
-
     list_extend(instance.nicknames, re.split(r'[,，\s]', params.get('昵称', '', tags=True)))
-
-    for suffix in ('', '2', '3', '新'):
-        list_append(instance.cv, params.get('声优' + suffix, tags=True))
-    instance.illustrator = params.get('画师')
-
-    for suffix in (1, 12, 2, 22):
-        list_append(instance.alignments, params.get(f'属性{suffix}'))
     instance.alignments.extend([trim(i) for i in params.get('属性', '').split('·') if trim(i)])
-
-    instance.gender = params.get('性别', '')
-    instance.height = params.get('身高', '')
-    instance.weight = params.get('体重', '')
-    instance.attribute = params.get('隐藏属性')
-    instance.className = params.get('职阶')
     instance.ability = {
         'strength': params.get('筋力', ''),
         'endurance': params.get('耐久', ''),
@@ -117,16 +208,6 @@ def t_base_info(params: Params, instance: ServantBaseInfo = None):
         'luck': params.get('幸运', ''),
         'np': params.get('宝具', '')
     }
-    instance.atkMin = params.get('基础ATK', -1, int)
-    instance.atkMax = params.get('满级ATK', -1, int)
-    instance.atk90 = params.get('90级ATK', -1, int)
-    instance.atk100 = params.get('100级ATK', -1, int)
-    instance.hpMin = params.get('基础HP', -1, int)
-    instance.hpMax = params.get('满级HP', -1, int)
-    instance.hp90 = params.get('90级HP', -1, int)
-    instance.hp100 = params.get('100级HP', -1, int)
-    for i in range(14):
-        list_append(instance.traits, params.get('特性' if i == 0 else f'特性{i}'))
     instance.isHumanoid = params.get('人型') in ('是', '1')
     instance.isWeakToEA = params.get('被EA特攻') in ('是', '1')
     instance.isTDNS = params.get('天地拟似') in ('是', '1')
@@ -159,18 +240,24 @@ def t_base_info(params: Params, instance: ServantBaseInfo = None):
     return instance
 
 
+kTreasureDeviceSpec = TemplateSpec(
+    Field('name', '中文名'),
+    Field('nameJp', '日文名', ''),
+    Field('upperName', '国服上标', ''),
+    Field('upperNameJp', '日服上标', ''),
+    Field('color', '卡色'),
+    Field('category', '类型'),
+    Field('rank', '阶级', ''),
+    Field('typeText', '种类', ''),
+)
+
+
+@cached_template(TreasureDevice)
 def t_treasure_device(params: Params, instance: TreasureDevice = None):
     """{{宝具}}"""
     if instance is None:
         instance = TreasureDevice()
-    instance.name = params.get('中文名')
-    instance.nameJp = params.get('日文名', '')
-    instance.upperName = params.get('国服上标', '')
-    instance.upperNameJp = params.get('日服上标', '')
-    instance.color = params.get('卡色')
-    instance.category = params.get('类型')
-    instance.rank = params.get('阶级', '')
-    instance.typeText = params.get('种类', '')
+    kTreasureDeviceSpec.extract(params, instance)
     assert instance.color in ('Quick', 'Arts', 'Buster') and instance.category in ('辅助', '单体', '全体'), instance
     for i in 'ABCDEFGH':
         effect = Effect()
@@ -187,6 +274,7 @@ def t_treasure_device(params: Params, instance: TreasureDevice = None):
     return instance
 
 
+@cached_template(Skill)
 def t_active_skill(params: Params, instance: Skill = None):
     """{{持有技能}}"""
     # {{持有技能|技能图标|技能名称|技能名称(日文)|充能时间（a → b）
@@ -374,20 +462,23 @@ def t_voice_table(params: Params, instance: VoiceTable = None):
 
 
 # %% craft essential & command code
+kCraftEssentialSpec = TemplateSpec(
+    Field('rarity', '稀有度', cast=int),
+    Field('no', '礼装id', cast=int),
+    Field('name', '名称'),
+    Field('nameJp', '日文名称'),
+    Field('mcLink', '链接名'),
+    ListField('illustrators', ['画师'] + [f'画师{i}' for i in range(2, 9)]),
+    Field('cost', 'cost', cast=int),
+)
+
+
 def t_craft_essential(params: Params, instance: CraftEssential = None):
     """{{概念礼装}}"""
     if instance is None:
         instance = CraftEssential()
-    instance.rarity = params.get('稀有度', cast=int)
-    instance.no = params.get('礼装id', cast=int)
-    instance.name = params.get('名称')
-    instance.nameJp = params.get('日文名称')
-    instance.mcLink = params.get('链接名')
+    kCraftEssentialSpec.extract(params, instance)
     instance.illustration = params.get('图片名', instance.name) + '.png'
-    for i in range(1, 9):
-        key = '画师' if i == 1 else f'画师{i}'
-        list_append(instance.illustrators, params.get(key))
-    instance.cost = params.get('cost', cast=int)
     hp = params.get('HP')
     if '/' in hp:
         instance.hpMin, instance.hpMax = map(int, hp.split('/'))
@@ -443,33 +534,56 @@ def t_craft_essential(params: Params, instance: CraftEssential = None):
     return instance
 
 
+kCmdCodeSpec = TemplateSpec(
+    Field('rarity', '稀有度', cast=int),
+    Field('no', '纹章id', cast=int),
+    Field('name', '名称'),
+    Field('nameJp', '日文名称'),
+    Field('mcLink', '链接名'),
+    ListField('illustrators', ['画师'] + [f'画师{i}' for i in range(2, 9)]),
+    Field('skill', '持有技能', tags=True),
+    Field('description', '解说', tags=True),
+    Field('descriptionJp', '日文解说', tags=True),
+    Field('categoryText', '纹章分类'),
+    ListField('characters', ['出场角色'] + [str(i) for i in range(1, 26)]),
+)
+
+
 def t_cmd_code(params: Params, instance: CmdCode = None):
     """{{指令纹章}}"""
     if instance is None:
         instance = CmdCode()
-    instance.rarity = params.get('稀有度', cast=int)
-    instance.no = params.get('纹章id', cast=int)
-    instance.name = params.get('名称')
-    instance.nameJp = params.get('日文名称')
-    instance.mcLink = params.get('链接名')
+    instance.characters = []
+    kCmdCodeSpec.extract(params, instance)
     instance.illustration = params.get('图片名', instance.name) + '.png'
-    for i in range(1, 9):
-        key = '画师' if i == 1 else f'画师{i}'
-        list_append(instance.illustrators, params.get(key))
-
     instance.skillIcon = params.get('图标') + '.png'
-    instance.skill = params.get('持有技能', tags=True)
-    instance.description = params.get('解说', tags=True)
-    instance.descriptionJp = params.get('日文解说', tags=True)
-    instance.categoryText = params.get('纹章分类')
-    instance.characters = []
-    list_append(instance.characters, params.get('出场角色'))
-    for i in range(1, 26):
-        list_append(instance.characters, params.get(str(i)))
     return instance
 
 
 # %% event, quest
+# keys of battle {i} in {{关卡配置}}: "{i}AP", "{i}地点cn", "{i}{wave}敌人{No.}", "{i}战利品"...
+kQuestBattleNo = '一二三四五六七八'
+kQuestKeyPattern = re.compile(r'([一二三四五六七八])(?:([1-7])敌人([1-9]|1\d|2[01])|(AP|地点cn|地点jp|地点|战利品))')
+
+
+def _split_quest_params(params: Params) -> Dict[str, Dict[int, Dict[int, str]]]:
+    """Group enemy params by battle and wave in one pass of present keys.
+
+    :return: dict of battle No.(一-八) - dict of wave - dict of enemy No. - enemy text,
+        battle with any key is included even if it has no enemy.
+    """
+    battles: Dict[str, Dict[int, Dict[int, str]]] = {}
+    for key, value in params.items():
+        match = kQuestKeyPattern.fullmatch(key)
+        if match is None:
+            continue
+        waves = battles.setdefault(match.group(1), {})
+        if match.group(2):
+            waves.setdefault(int(match.group(2)), {})[int(match.group(3))] = value
+    return battles
+
+
+@cached_template(Quest)
 def t_quest(params: Params, instance: Quest = None):
     """{{关卡配置}}"""
     # at most 8 battles 7 waves 21 enemies
@@ -484,7 +598,10 @@ def t_quest(params: Params, instance: Quest = None):
     instance.qp = params.get('QP', 0, int)
     instance.isFree = params.get('可重复', 0, int) in (1, 3)
     instance.hasChoice = '{{分支关卡' in ''.join(params.values())
-    for i in '一二三四五六七八':
+    battles = _split_quest_params(params)
+    for i in kQuestBattleNo:
+        if i not in battles:
+            continue
         ap = params.get(f'{i}AP', -1, int)
         if ap < 0:
             continue
@@ -493,12 +610,10 @@ def t_quest(params: Params, instance: Quest = None):
         battle.place = params.get(f'{i}地点cn') or params.get(f'{i}地点')
         battle.placeJp = params.get(f'{i}地点jp')
 
-        for j in range(7):
+        waves = battles[i]
+        for j in range(1, max(waves, default=0) + 1):
             wave: List[Enemy] = []
-            for k in range(21):
-                enemy_text = params.get(f'{i}{j + 1}敌人{k + 1}')
-                if not enemy_text:
-                    continue
+            for k, enemy_text in sorted(waves.get(j, {}).items()):
                 if '关卡分支' in enemy_text:
                     branch_param = parse_template(enemy_text, '^{{关卡分支')
                     enemy_text = branch_param.get('1', None) or branch_param.get('default')
@@ -519,6 +634,7 @@ def t_quest(params: Params, instance: Quest = None):
     return instance
 
 
+@cached_template(Enemy)
 def t_enemy(params: Params, instance: Enemy = None):
     """{{敌人123}}"""
     # {{敌人1|种类|显示名|职阶|Lv|HP|敌人3|种类2|显示名2|职阶2|Lv2|HP2}}
@@ -547,7 +663,7 @@ def t_event_info(params: Params, event: EventBase):
     event.startTimeCn = params.get('开始时间cn') or params.get('时间预估cn')
     event.endTimeCn = params.get('结束时间cn') or params.get('结束预估cn')
     banner_image = get_site_page(params.get('标题图文件名cn') or params.get('标题图文件名jp'), True)
-    if banner_image.imageinfo != {}:
+    if banner_image and banner_image.imageinfo != {}:
         event.bannerUrl = banner_image.imageinfo['url']
     event.grail = params.get('圣杯', 0, int)
     event.grail2crystal = params.get('圣杯转结晶', 0, int)
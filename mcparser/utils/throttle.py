@@ -0,0 +1,229 @@
+"""Request throttling shared by all download threads and coroutines.
+
+- token bucket: at most `config.rate_limit` requests per second, with bursts of `config.rate_burst`
+- adaptive concurrency(AIMD): in-flight requests limit is halved on failure and grows by one
+  after a full window of successful requests
+- jittered exponential backoff for retry, server side Retry-After/maxlag pauses all requests
+"""
+import asyncio
+import random
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Deque
+
+import requests
+from mwclient.errors import APIError, InvalidPageTitle, MaximumRetriesExceeded
+
+from .basic import *
+from .config import config
+from .replay import FixtureMissing
+
+
+class RateLimiter:
+    def __init__(self, rate: float = None, burst: int = None, max_concurrency: int = None):
+        """Arguments default to config values at the time of use"""
+        self._rate = rate
+        self._burst = burst
+        self._max_concurrency = max_concurrency
+        self._concurrency: Optional[int] = None
+        self._tokens: Optional[float] = None
+        self._last = time.monotonic()
+        self._pause_until = 0.
+        self._active = 0
+        self._successes = 0
+        self._last_decrease = 0.
+        self._cond = threading.Condition()
+        # (event loop, future) of coroutines waiting for a slot, woken by `release` in order
+        self._async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    @property
+    def rate(self) -> float:
+        return self._rate or config.rate_limit
+
+    @property
+    def burst(self) -> int:
+        return self._burst or config.rate_burst
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency or config.max_concurrency
+
+    @property
+    def concurrency(self) -> int:
+        """Current limit of in-flight requests"""
+        if self._concurrency is None:
+            return self.max_concurrency
+        return min(self._concurrency, self.max_concurrency)
+
+    def reserve(self) -> float:
+        """Take one token, return seconds to wait before sending the request"""
+        with self._cond:
+            now = time.monotonic()
+            if self._tokens is None:
+                self._tokens = float(self.burst)
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # negative tokens are reserved by waiting requests
+            self._tokens -= 1
+            wait = 0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._pause_until - now)
+
+    def _try_enter(self) -> bool:
+        if self._active < self.concurrency:
+            self._active += 1
+            return True
+        return False
+
+    def acquire(self):
+        """Wait for a free concurrency slot and a token"""
+        with self._cond:
+            self._cond.wait_for(self._try_enter)
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        """Coroutine version of `acquire`, don't block the event loop.
+
+        Waiting coroutine is woken by `release` which hands over the slot, no polling.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            waiter = None if self._try_enter() else (loop, loop.create_future())
+            if waiter:
+                self._async_waiters.append(waiter)
+        if waiter:
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    elif not waiter[1].cancelled():
+                        # slot already handed over
+                        self._exit()
+                raise
+        await asyncio.sleep(self.reserve())
+
+    def _handover(self, future: asyncio.Future):
+        """Run in event loop of waiter, give the slot back if the waiter is cancelled"""
+        if future.done():
+            with self._cond:
+                self._exit()
+        else:
+            future.set_result(None)
+
+    def _exit(self):
+        """Free one slot and wake waiters, call with `_cond` held"""
+        self._active -= 1
+        while self._async_waiters and self._active < self.concurrency:
+            loop, future = self._async_waiters.popleft()
+            if future.done():
+                continue
+            self._active += 1
+            try:
+                loop.call_soon_threadsafe(self._handover, future)
+            except RuntimeError:  # loop closed
+                self._active -= 1
+        self._cond.notify_all()
+
+    def release(self, success: bool):
+        """Release the slot and adjust concurrency by request result"""
+        with self._cond:
+            if success:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self._successes = 0
+                    self._concurrency = self.concurrency + 1
+            else:
+                self._successes = 0
+                now = time.monotonic()
+                # failures of the same burst only count once
+                if now - self._last_decrease > 1 and self.concurrency > 1:
+                    self._last_decrease = now
+                    self._concurrency = max(1, self.concurrency // 2)
+                    logger.debug(f'request failed, concurrency decreased to {self.concurrency}')
+            self._exit()
+
+    def pause(self, seconds: float):
+        """Hold all requests for `seconds`, e.g. server asks to retry after"""
+        with self._cond:
+            self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+        logger.warning(f'server busy, pause requests for {seconds:.1f}s')
+
+
+def backoff_delay(retry_no: int, base: float = None, cap: float = None) -> float:
+    """Full jitter exponential backoff: random in [0, min(cap, base*2^retry_no)]"""
+    base = config.retry_backoff if base is None else base
+    cap = config.retry_backoff_max if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** retry_no))
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Retry-After header, either delay seconds or http date"""
+    if not value:
+        return 0
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+# Retry-After of the last API response of current thread if database lagged, else 0
+_lag_local = threading.local()
+
+
+def database_lag_hook(response: requests.Response, *args, **kwargs):
+    """Response hook of mwclient session, `MaximumRetriesExceeded` doesn't tell whether it is caused by maxlag"""
+    if response.headers.get('X-Database-Lag'):
+        _lag_local.retry_after = parse_retry_after(response.headers.get('Retry-After')) or config.max_lag
+    else:
+        _lag_local.retry_after = 0
+
+
+def retry_after_of(error: Exception) -> float:
+    """Seconds the server asks to wait by Retry-After or maxlag, 0 if not specified"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return parse_retry_after(error.response.headers.get('Retry-After'))
+    # database lag exceeds maxlag, mwclient doesn't retry since its max_retries is 0.
+    # it is also raised for repeated 5xx by some mwclient versions, which is not a pause request
+    if isinstance(error, MaximumRetriesExceeded):
+        return getattr(_lag_local, 'retry_after', 0)
+    if isinstance(error, APIError) and error.code == 'maxlag':
+        return config.max_lag
+    return 0
+
+
+def call_with_retry(func: Callable[[], T], n: int = None) -> T:
+    """Call `func` throttled by `RATE_LIMITER`, retry with backoff.
+
+    :param func: function without arguments sending request.
+    :param n: retry times.
+    :return: result of func, raise the last error if failed after `n` retry.
+        `InvalidPageTitle` and `FixtureMissing` are not transient and raised without retry.
+    """
+    if n is None:
+        n = config.net_retry_times
+    for retry_no in range(n):
+        RATE_LIMITER.acquire()
+        try:
+            result = func()
+        except (InvalidPageTitle, FixtureMissing):
+            RATE_LIMITER.release(True)
+            raise
+        except Exception as e:
+            RATE_LIMITER.release(False)
+            if retry_no == n - 1:
+                raise
+            retry_after = retry_after_of(e)
+            if retry_after > 0:
+                RATE_LIMITER.pause(retry_after)
+            time.sleep(max(retry_after, backoff_delay(retry_no)))
+        else:
+            RATE_LIMITER.release(True)
+            return result
+
+
+RATE_LIMITER = RateLimiter()
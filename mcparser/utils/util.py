@@ -1,14 +1,24 @@
 """Wikitext basic utils"""
+import hashlib
+
 from .basic import *
+from .cache import *
 from .config import *
+from .replay import *
+from .store import *
+from .throttle import *
 
 # warning: nowiki affect wikitext parsing
 kAllTags = ('ref', 'br', 'comment', 'del', 'sup', 'include', 'heimu', 'trja', 'nowiki',
             'texing', 'link', 'ruby', 'bold')
 kSafeTags = ('ref', 'br', 'comment', 'del', 'sup', 'include', 'heimu', 'ruby', 'trja')
+# max length of text memoized in memo caches, see `_memoize`
+kMaxMemoTextLength = 20000
 
 
 class Params(dict):
+    """Template params, tags are removed lazily on first access"""
+
     def get(self, k, default=None, cast=None, tags=None):
         """
         :param k: dict key.
@@ -23,7 +33,7 @@ class Params(dict):
             tags = kAllTags
         v = super(Params, self).get(k)
         if isinstance(v, str) and tags is not None:
-            v = remove_tag(v, tags)
+            v = self._clean(k, v, tuple(tags))
         if cast is not None:
             try:
                 # ,分隔符
@@ -34,15 +44,57 @@ class Params(dict):
                 v = default
         return v
 
+    def _clean(self, k, v: str, tags: Tuple[str, ...]) -> str:
+        # raw value is part of key, in case it is changed after cleaned
+        memo: Dict[tuple, str] = self.__dict__.setdefault('_cleaned', {})
+        key = (k, v, tags)
+        if key not in memo:
+            memo[key] = remove_tag(v, tags)
+        return memo[key]
+
+
+def _memoize(cache: MemoCache, text: str, args: tuple, func: Callable[[], T]) -> T:
+    """Result of `func` memoized in cache by sha1 of text and args.
+
+    Text longer than `kMaxMemoTextLength`(e.g. whole page) is not cached, so memory is bounded.
+    """
+    if len(text) > kMaxMemoTextLength:
+        return func()
+    key = hashlib.sha1(text.encode('utf8') + repr(args).encode('utf8')).hexdigest()
+    return cache.get_or_compute(key, func)
+
+
+def parse_wikitext(text: str) -> Wikicode:
+    """`mwp.parse` memoized in `PARSE_CACHE`.
+
+    Returned Wikicode is shared by all callers, DON'T modify it, use `mwp.parse` instead if needed.
+    """
+    return _memoize(PARSE_CACHE, text, (), lambda: mwp.parse(text))
+
+
+def _filter_template_params(code: Wikicode, match_pattern: str = None) -> Params:
+    templates = code.filter_templates(matches=match_pattern)
+    return _template_params(templates[0]) if templates else Params()
+
 
 def parse_template(template: Wikitext, match_pattern: str = None) -> Params:
-    if not isinstance(template, Template):
-        templates = mwp.parse(template).filter_templates(matches=match_pattern)
-        if len(templates) == 0:
-            return Params()
-        tmpl: Template = templates[0]
-    else:
-        tmpl = template
+    if isinstance(template, Template):
+        return _template_params(template)
+    if not isinstance(template, str):
+        # already parsed
+        return _filter_template_params(template, match_pattern)
+
+    def _parse():
+        params = _scan_template(template, match_pattern)
+        if params is not None:
+            return params
+        return _filter_template_params(parse_wikitext(template), match_pattern)
+
+    # result is copied since Params may be modified by caller
+    return Params(_memoize(TEMPLATE_CACHE, template, (match_pattern,), _parse))
+
+
+def _template_params(tmpl: Template) -> Params:
     params = Params()
     for p in tmpl.params:  # type:Parameter
         value = trim(p.value)
@@ -51,99 +103,527 @@ def parse_template(template: Wikitext, match_pattern: str = None) -> Params:
     return params
 
 
+# markups which may hide or change templates, leave them to mwparserfromhell
+kAmbiguousMarkups = ('<!--', '<nowiki', '<pre', '<math', '<source', '<syntaxhighlight', '{{{')
+kTemplateTokenPattern = re.compile(r'\{\{|\}\}|\[\[|\]\]|<br\s*/?>|[|=<]', re.I)
+# bold/italic and heading lines change how "|" and "=" split params
+kAmbiguousLinePattern = re.compile(r"''|^=", re.M)
+kTemplateNamePattern = re.compile(r'[^{}\[\]<>|=\n]+')
+kLinkTitlePattern = re.compile(r'[^{}\[\]<>|\n]+')
+
+
+def _scan_template(text: str, match_pattern: str = None) -> Optional[Params]:
+    """Find the first matched template by brace matching, without building parse tree.
+
+    Same as `filter_templates(matches=match_pattern)[0]` of mwparserfromhell.
+
+    :return: params of template, empty if not found,
+        None if wikitext is ambiguous(e.g. html tag or comment), then parse it by mwparserfromhell.
+    """
+    if '{{' not in text:
+        return Params()
+    if any([markup in text for markup in kAmbiguousMarkups]):
+        return None
+    flags = re.IGNORECASE | re.DOTALL  # same as mwparserfromhell
+    # "^{{name" without top level alternation: check name at "{{" before extracting template
+    prefix = None
+    if match_pattern and match_pattern.startswith('^{{') and '|' not in re.sub(r'\([^()]*\)', '', match_pattern):
+        prefix = re.compile(match_pattern[3:], flags)
+    start = text.find('{{')
+    while start >= 0:
+        if prefix is None or prefix.match(text, start + 2):
+            span = _split_template(text, start)
+            if span is None:
+                return None
+            end, params = span
+            if match_pattern is None or re.search(match_pattern, text[start:end], flags):
+                return None if kAmbiguousLinePattern.search(text, start, end) else params
+        start = text.find('{{', start + 2)
+    return Params()
+
+
+def _valid_nested_name(text: str, item: List, end: int) -> bool:
+    """Check name of nested template or title of link once, mwparserfromhell treats it as text if invalid"""
+    if item[1] < 0:
+        return True
+    name, item[1] = text[item[1]:end], -1
+    pattern = kTemplateNamePattern if item[0] == '{{' else kLinkTitlePattern
+    return pattern.fullmatch(name.strip()) is not None
+
+
+def _split_template(text: str, start: int) -> Optional[Tuple[int, Params]]:
+    """Split template starting at `start` by top level "|" and "=".
+
+    :return: (end position, params), None if ambiguous.
+    """
+    stack: List[List] = []  # [token, begin of nested template name/link title or -1 if checked]
+    pieces: List[List[int]] = []  # [begin, end, position of "=" or -1] of name and params
+    for m in kTemplateTokenPattern.finditer(text, start):
+        token = m.group()
+        if token == '{{' or token == '[[':
+            # name of outermost template is checked at last
+            stack.append([token, m.end() if stack else -1])
+            if len(stack) == 1:
+                pieces.append([m.end(), -1, -1])
+        elif token == ']]':
+            if stack[-1][0] == '[[':
+                if not _valid_nested_name(text, stack[-1], m.start()):
+                    return None
+                stack.pop()
+        elif token == '}}':
+            if stack[-1][0] != '{{' or not _valid_nested_name(text, stack[-1], m.start()):
+                return None
+            stack.pop()
+            if not stack:
+                pieces[-1][1] = m.start()
+                break
+        elif token == '<':
+            return None
+        elif token == '|' and len(stack) > 1:
+            if not _valid_nested_name(text, stack[-1], m.start()):
+                return None
+        elif len(stack) == 1 and token == '|':
+            pieces[-1][1] = m.start()
+            pieces.append([m.end(), -1, -1])
+        elif len(stack) == 1 and token == '=' and pieces[-1][2] < 0:
+            pieces[-1][2] = m.start()
+    else:
+        return None
+    name_begin, name_end, _ = pieces[0]
+    if not kTemplateNamePattern.fullmatch(text[name_begin:name_end].strip()):
+        return None
+    params = Params()
+    index = 0
+    for begin, end, eq in pieces[1:]:
+        if eq >= 0:
+            key, value = text[begin:eq], text[eq + 1:end]
+        else:
+            index += 1
+            key, value = str(index), text[begin:end]
+        value = trim(value)
+        if value not in ('-', '—', ''):
+            params[trim(key)] = value
+    return pieces[-1][1] + 2, params
+
+
+PARSE_CACHE = MemoCache('parse')
+REMOVE_TAG_CACHE = MemoCache('remove_tag')
+TEMPLATE_CACHE = MemoCache('parse_template')
+
+
+def memo_cache_info() -> Dict[str, Dict[str, int]]:
+    """Hit/miss counters of memo caches of current process"""
+    return dict([(cache.name, cache.info()) for cache in (PARSE_CACHE, REMOVE_TAG_CACHE, TEMPLATE_CACHE)])
+
+
 # %% site related
 def get_site_page(name: str, isfile: bool = False, n: int = None):
-    retry_no = 0
-    if n is None:
-        n = config.net_retry_times
-    while retry_no < n:
-        try:
-            if isfile:
-                result = config.site.images[name]
-            else:
-                result = config.site.pages[name].text()
-            return result
-        except:  # noqas
-            retry_no += 1
-            time.sleep(2)
-    logger.error(f'Error download page "{name}" after {n} retry.')
-    return None
+    """Get page wikitext or image info, page wikitext is served from `PAGE_CACHE` if possible.
+
+    Cached page fetched within `config.page_cache_ttl` is returned directly, older one is validated
+    by revision id. If `config.offline`, only cached page is returned.
+    Missing page(return "") or file(return None) is recorded in negative cache and not requested again
+    within `config.missing_cache_ttl`.
+    """
+    missing_result = None if isfile else ''
+    cache_title = 'File:' + name if isfile else name
+    if not isfile:
+        cached = PAGE_CACHE.get(name, ttl=None if config.offline else config.page_cache_ttl)
+        if cached is not None:
+            return cached
+    if PAGE_CACHE.is_missing(cache_title):
+        return missing_result
+    if config.offline:
+        logger.warning(f'offline: {"file" if isfile else "page"} "{name}" not in cache')
+        return None
+
+    def _fetch():
+        if isfile:
+            image = config.site.images[name]
+            if not image.exists:
+                PAGE_CACHE.mark_missing(cache_title)
+                return missing_result
+            return image
+        page = config.site.pages[name]
+        if not page.exists:
+            PAGE_CACHE.mark_missing(cache_title)
+            return missing_result
+        cached_text = PAGE_CACHE.get(name, revid=page.revision)
+        if cached_text is not None:
+            PAGE_CACHE.touch(name)
+            return cached_text
+        text = page.text()
+        PAGE_CACHE.put(name, text, page.revision)
+        return text
+
+    try:
+        return call_with_retry(_fetch, n)
+    except InvalidPageTitle:
+        logger.warning(f'invalid title "{name}"')
+        PAGE_CACHE.mark_missing(cache_title)
+        return missing_result
+    except Exception as e:
+        logger.error(f'Error download page "{name}": {e!r}')
+        return None
+
+
+def _query_site(n: int = None, **kwargs) -> Optional[Dict]:
+    """Call API action=query with throttling and retry, return None if failed after `n` retry."""
+    kwargs.setdefault('maxlag', config.max_lag)
+    try:
+        return call_with_retry(lambda: config.site.get('query', **kwargs), n)
+    except Exception as e:
+        logger.error(f'Error query {str(kwargs):.200s}: {e!r}')
+        return None
+
+
+def query_site_pages(titles: Sequence[str], n: int = None, **kwargs) -> Dict[str, Optional[Dict]]:
+    """Query multiple pages in one API request, at most 50 titles for anonymous user.
+
+    :param titles: page titles.
+    :param n: retry times.
+    :param kwargs: API query params, e.g. prop='revisions', rvprop='content'.
+    :return: dict of requested title - page info, None if page is missing or invalid.
+        Titles are not included if request failed.
+    """
+    kwargs['titles'] = '|'.join(titles)
+    pages: Dict[str, Dict] = {}
+    aliases: Dict[str, str] = {}
+    while True:
+        response = _query_site(n, **kwargs)
+        if response is None:
+            return {}
+        merge_query_response(response, pages, aliases)
+        if 'continue' not in response:
+            break
+        kwargs.update(response['continue'])
+    return map_query_titles(titles, pages, aliases)
+
+
+def merge_query_response(response: Dict, pages: Dict[str, Dict], aliases: Dict[str, str]):
+    """Merge pages and title normalization/redirects of one (continued) query response"""
+    query = response.get('query', {})
+    for entry in query.get('normalized', []) + query.get('redirects', []):
+        aliases[entry['from']] = entry['to']
+    for page in query.get('pages', {}).values():
+        # revisions of large result are returned in continued queries
+        revisions = pages.setdefault(page['title'], page).setdefault('revisions', [])
+        if pages[page['title']] is not page:
+            revisions.extend(page.get('revisions', []))
+
+
+def map_query_titles(titles: Sequence[str], pages: Dict[str, Dict], aliases: Dict[str, str]):
+    """Map requested titles to merged pages, None if page is missing or invalid"""
+    result = {}
+    for title in titles:
+        name, visited = title, {title}
+        while name in aliases and aliases[name] not in visited:
+            name = aliases[name]
+            visited.add(name)
+        page = pages.get(name)
+        result[title] = None if page is None or 'missing' in page or 'invalid' in page else page
+    return result
+
+
+def _query_in_batches(titles: Iterable[str], workers: int = None, batch_size: int = 50, backend: str = None,
+                      **kwargs) -> Dict[str, Optional[Dict]]:
+    """Run `query_site_pages` for every `batch_size` titles in thread pool or asyncio event loop"""
+    titles = list(dict.fromkeys(t for t in titles if t))
+    batches = [titles[i:i + batch_size] for i in range(0, len(titles), batch_size)]
+    if (backend or config.download_backend) == 'async' and batches:
+        from .aio import AsyncFetcher  # aio depends on this module
+        return AsyncFetcher.run(lambda fetcher: fetcher.query_in_batches(batches, **kwargs))
+    if len(batches) <= 1:
+        return query_site_pages(batches[0], **kwargs) if batches else {}
+    executor = ThreadPoolExecutor(max_workers=workers or config.default_workers)
+    tasks = [executor.submit(query_site_pages, batch, **kwargs) for batch in batches]
+    result: Dict[str, Optional[Dict]] = {}
+    for future in as_completed(tasks):
+        result.update(future.result())
+    executor.shutdown()
+    logger.debug(f'queried {len(result)}/{len(titles)} pages in {len(batches)} batches')
+    return result
+
+
+def get_site_pages(titles: Iterable[str], workers: int = None, batch_size: int = 50,
+                   backend: str = None) -> Dict[str, Optional[str]]:
+    """Download wikitext of multiple pages, `batch_size` titles per API request.
+
+    :return: dict of title - wikitext, None if page is missing. Titles of failed requests are not included.
+    """
+    revisions = get_site_revisions(titles, content=True, workers=workers, batch_size=batch_size, backend=backend)
+    return dict([(title, None if rev is None else rev['content']) for title, rev in revisions.items()])
+
+
+def get_site_revisions(titles: Iterable[str], content=False, workers: int = None, batch_size: int = 50,
+                       backend: str = None, **kwargs) -> Dict[str, Optional[Dict]]:
+    """Query latest revision of multiple pages, `batch_size` titles per API request.
+
+    :param content: whether to download wikitext content too.
+    :param workers: max threads of thread backend, async backend use `config.async_workers`.
+    :param backend: "thread" or "async", default `config.download_backend`.
+    :param kwargs: extra API params, e.g. redirects=1.
+    :return: dict of title - {"revid", "timestamp", "content"}, None if page is missing(cached in negative
+        cache). Titles of failed requests are not included.
+    """
+    titles = list(dict.fromkeys(t for t in titles if t))
+    result: Dict[str, Optional[Dict]] = {}
+    if content and 'redirects' not in kwargs:
+        # serve from page cache
+        ttl = None if config.offline else config.page_cache_ttl
+        for title in titles:
+            entry = PAGE_CACHE.get_entry(title)
+            cached = PAGE_CACHE.get(title, ttl=ttl) if entry else None
+            if cached is not None:
+                result[title] = {'revid': entry['revid'], 'timestamp': entry['timestamp'], 'content': cached}
+    if config.offline:
+        for title in titles:
+            entry = PAGE_CACHE.get_entry(title)
+            if title not in result and entry:
+                result[title] = {'revid': entry['revid'], 'timestamp': entry['timestamp'], 'content': None}
+        logger.debug(f'offline: {len(result)}/{len(titles)} pages in cache')
+        return result
+    for title in titles:
+        if title not in result and PAGE_CACHE.is_missing(title):
+            result[title] = None
+    rvprop = 'ids|timestamp|content' if content else 'ids|timestamp'
+    pages = _query_in_batches([t for t in titles if t not in result], workers, batch_size, backend,
+                              prop='revisions', rvprop=rvprop, rvslots='main', **kwargs)
+    for title, page in pages.items():
+        if page is None:
+            PAGE_CACHE.mark_missing(title)
+        revision = result[title] = None if page is None else page_revision(page)
+        if content and 'redirects' not in kwargs and revision and revision['content'] is not None:
+            PAGE_CACHE.put(title, revision['content'], revision['revid'], revision['timestamp'])
+    return result
+
+
+def get_site_imageinfo(filenames: Iterable[str], workers: int = None, batch_size: int = 50,
+                       backend: str = None) -> Dict[str, Optional[Dict]]:
+    """Query image info of multiple files, `batch_size` files per API request.
+
+    :param filenames: file names without "File:" namespace.
+    :return: dict of filename - imageinfo {"url", "sha1", "size", "timestamp"}, None if file is missing(cached in negative cache).
+        Files of failed requests are not included.
+    """
+    if config.offline:
+        logger.warning(f'offline: cannot get image info of files')
+        return {}
+    filenames = list(dict.fromkeys(fn for fn in filenames if fn))
+    result: Dict[str, Optional[Dict]] = dict((fn, None) for fn in filenames if PAGE_CACHE.is_missing('File:' + fn))
+    pages = _query_in_batches(['File:' + fn for fn in filenames if fn not in result], workers, batch_size, backend,
+                              prop='imageinfo', iiprop='url|sha1|size|timestamp')
+    for fn in filenames:
+        if 'File:' + fn in pages:
+            page = pages['File:' + fn]
+            result[fn] = (page.get('imageinfo') or [None])[0] if page else None
+            if result[fn] is None:
+                PAGE_CACHE.mark_missing('File:' + fn)
+    return result
+
+
+class RedirectMap:
+    """Redirect targets of page titles, resolved by server in batches and shared in one run"""
+
+    def __init__(self):
+        self._targets: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, titles: Iterable[str], workers: int = None, backend: str = None) -> Dict[str, Optional[str]]:
+        """Resolve titles not resolved yet, 50 titles per API request.
+
+        :return: dict of title - target title(itself if not redirected), None if page is missing.
+            Title of failed request or in offline mode is mapped to itself.
+        """
+        titles = list(dict.fromkeys(t for t in titles if t))
+        unknown = [t for t in titles if t not in self._targets]
+        if unknown and not config.offline:
+            pages = _query_in_batches(unknown, workers, backend=backend, redirects=1)
+            with self._lock:
+                for title, page in pages.items():
+                    self._targets[title] = page['title'] if page else None
+            redirected = [t for t in unknown if self._targets.get(t, t) not in (t, None)]
+            logger.debug(f'resolved {len(pages)} titles, {len(redirected)} redirected: {redirected}')
+        return dict([(t, self.get(t)) for t in titles])
+
+    def get(self, title: str) -> Optional[str]:
+        """Resolved target, title itself if not resolved"""
+        return self._targets.get(title, title)
+
+
+REDIRECTS = RedirectMap()
+
+
+def page_revision(page: Dict) -> Dict[str, Any]:
+    """Extract {"revid", "timestamp", "content"} of the latest revision from API page info"""
+    revisions = page.get('revisions') or [{}]
+    revision = revisions[0]
+    # MediaWiki 1.32+ put content in slots
+    content = revision.get('slots', {}).get('main', revision).get('*')
+    return {'revid': revision.get('revid'), 'timestamp': revision.get('timestamp'), 'content': content}
 
 
 # %% common used wikitext edit functions
+class _TagRemover:
+    """Walk the parse tree once and emit cleaned text, see `remove_tag`"""
+    kBrPattern = re.compile(r'<br[\s/]*>')
+    kIncludePattern = re.compile(r'<[\s/]*(include|onlyinclude|includeonly|noinclude)[\s/]*>')
+    kNowikiPattern = re.compile(r'<[\s/]*nowiki[\s/]*>')
+    kFilePattern = re.compile(r'(文件|File):')
+    kFileLinkPattern = re.compile(r'\[\[(文件|File):([^\[\]]*?)]]')
+    kBoldPattern = re.compile(r"'''([^']*?)'''")
+
+    def __init__(self, tags: Sequence[str]):
+        self.tags = set(tags)
+
+    def walk(self, code: Optional[Wikicode]) -> str:
+        if code is None:
+            return ''
+        return ''.join([self.node(node) for node in code.nodes])
+
+    def node(self, node) -> str:
+        if isinstance(node, mwp.nodes.Text):
+            return self.text(node.value)
+        if isinstance(node, mwp.nodes.Comment):
+            return '' if 'comment' in self.tags else str(node)
+        if isinstance(node, Tag):
+            return self.tag(node)
+        if isinstance(node, Template):
+            return self.template(node)
+        if isinstance(node, mwp.nodes.Wikilink):
+            return self.wikilink(node)
+        if isinstance(node, mwp.nodes.Heading):
+            return '=' * node.level + self.walk(node.title) + '=' * node.level
+        if isinstance(node, mwp.nodes.ExternalLink):
+            return self.external_link(node)
+        if isinstance(node, mwp.nodes.Argument):
+            default = '' if node.default is None else '|' + self.walk(node.default)
+            return '{{{' + self.walk(node.name) + default + '}}}'
+        return str(node)
+
+    def external_link(self, link: mwp.nodes.ExternalLink) -> str:
+        url = self.walk(link.url)
+        if not link.brackets:
+            return url
+        if link.title is None:
+            return f'[{url}]'
+        return f"[{url}{'' if link.suppress_space is True else ' '}{self.walk(link.title)}]"
+
+    def text(self, text: str) -> str:
+        # tags not parsed as node, e.g. unclosed
+        if '<' in text:
+            if 'br' in self.tags:
+                text = self.kBrPattern.sub('\n', text)
+            if 'include' in self.tags:
+                text = self.kIncludePattern.sub('', text)
+            if 'nowiki' in self.tags:
+                text = self.kNowikiPattern.sub('', text)
+        return text
+
+    def raw(self, text: str) -> str:
+        """Text whose markup is not parsed(contents of <nowiki>), only the rules on plain string apply"""
+        text = self.text(text)
+        if 'link' in self.tags:
+            text = self.kFileLinkPattern.sub('', text)
+        if 'bold' in self.tags:
+            text = self.kBoldPattern.sub(r'\1', text)
+        return text.replace('{{jin}}', 'jin')
+
+    def tag(self, tag: Tag) -> str:
+        name = str(tag.tag).strip().lower()
+        # bold/italic markup is kept, bold is removed from the whole string at last like plain text
+        if not tag.wiki_markup:
+            if name.startswith('ref') and 'ref' in self.tags:
+                return ''
+            if name == 'br' and 'br' in self.tags:
+                return '\n'
+            if (name.startswith('del') or name.startswith('sup')) and name[:3] in self.tags:
+                return self.walk(tag.contents)
+            if name == 'nowiki':
+                contents = self.raw(str(tag.contents or ''))
+                return contents if 'nowiki' in self.tags else f'<nowiki>{contents}</nowiki>'
+            if name in ('include', 'onlyinclude', 'includeonly', 'noinclude') and 'include' in self.tags:
+                return self.walk(tag.contents)
+        # keep tag itself, clean its contents
+        string = str(tag)
+        if tag.self_closing or tag.contents is None:
+            return string
+        contents = str(tag.contents)
+        close = (tag.closing_wiki_markup or '') if tag.wiki_markup else f'</{tag.closing_tag}>'
+        if not string.endswith(contents + close):
+            return string
+        return string[:len(string) - len(close) - len(contents)] + self.walk(tag.contents) + close
+
+    def arg(self, template: Template, key: str) -> Optional[str]:
+        """Cleaned argument like `parse_template(template).get(key)`"""
+        value = None
+        for param in template.params:
+            if trim(str(param.name)) == key:
+                value = param.value
+        if value is None or trim(str(value)) in ('-', '—', ''):
+            return None
+        return trim(self.walk(value))
+
+    def template(self, template: Template) -> str:
+        name = str(template.name)
+        if 'heimu' in self.tags:
+            if re.match(r'(黑幕|heimu|模糊|修正)', name, re.I):
+                return self.arg(template, '1') or ''
+            if re.match(r'color', name, re.I):
+                return self.arg(template, '2') or ''
+        if 'texing' in self.tags and re.match(r'特性', name):
+            return f"〔{(self.arg(template, '2') or self.arg(template, '1') or '').strip('〔〕')}〕"
+        if 'ruby' in self.tags and re.match(r'ruby', name, re.I):
+            return f"{self.arg(template, '1')}[{self.arg(template, '2')}]"
+        if 'trja' in self.tags and re.match(r'trja', name, re.I):
+            return self.arg(template, '1') or self.arg(template, '2') or ''
+        # Okita Souji Alter
+        if name == 'jin' and not template.params:
+            return 'jin'
+        string = '{{' + self.walk(template.name)
+        for param in template.params:
+            string += '|' + (self.walk(param.name) + '=' if param.showkey else '') + self.walk(param.value)
+        return string + '}}'
+
+    def wikilink(self, wiki_link: mwp.nodes.Wikilink) -> str:
+        title = str(wiki_link.title)
+        if 'link' not in self.tags:
+            text = '' if wiki_link.text is None else '|' + self.walk(wiki_link.text)
+            return '[[' + self.walk(wiki_link.title) + text + ']]'
+        # remove [[File:a.jpg|b|c]] - it show img
+        if self.kFilePattern.match(title):
+            return ''
+        # [[语音关联从者::somebody]]
+        shown_text = self.walk(wiki_link.text).split('|', maxsplit=1)[0] if wiki_link.text else ''
+        return shown_text or re.split(r':+', title)[-1]
+
+
+def _remove_tag(string: str, tags: Sequence[str]) -> str:
+    remover = _TagRemover(tags)
+    string = remover.walk(parse_wikitext(string))
+    # bold is removed by regex rather than parse tree, nested or unbalanced bold/italic are kept as is
+    if 'bold' in tags and "'''" in string:
+        string = remover.kBoldPattern.sub(r'\1', string)
+    # tags left by unbalanced or nested markup
+    if '<' in string and ('nowiki' in tags or 'include' in tags):
+        string = remover.text(string)
+    return string
+
+
 def remove_tag(string: str, tags: Sequence[str] = kAllTags, console=False):
+    """Remove or replace wiki/html tags in one pass of the parse tree.
+
+    String without any markup("<", "{{", "[[", "'''") is returned without parsing,
+    others are memoized in `REMOVE_TAG_CACHE` unless too long.
+    """
     string = string.strip()
-    code = mwp.parse(string)
-
-    # html tags
-    # REMOVE - ref/comment
-    for tag_name in ('ref',):
-        if tag_name in tags:
-            for tag in code.filter_tags(matches=r'^<' + tag_name):
-                string = string.replace(str(tag), '')
-    if 'comment' in tags:
-        for comment in code.filter_comments():
-            string = string.replace(str(comment), '')
-    if 'br' in tags:
-        string = re.sub(r'<br[\s/]*>', '\n', string)
-    # Replace with contents - sup/del/noinclude
-    for tag_name in ('del', 'sup'):
-        if tag_name in tags:
-            for tag in code.filter_tags(matches=r'^<' + tag_name):  # type:mwp.nodes.tag.Tag
-                string = string.replace(str(tag), str(tag.contents))
-
-    if 'nowiki' in tags:
-        string = re.sub(r'<[\s/]*nowiki[\s/]*>', '', string)
-    if 'include' in tags:
-        # may nested
-        string = re.sub(r'<[\s/]*(include|onlyinclude|includeonly|noinclude)[\s/]*>', '', string)
-
-    # wiki templates
-    # just keep 1st
-    if 'heimu' in tags:
-        for template in code.filter_templates(matches=r'^{{(黑幕|heimu|模糊|修正)'):
-            params = parse_template(template)
-            string = string.replace(str(template), params.get('1', ''))
-        for template in code.filter_templates(matches=r'^{{color'):
-            params = parse_template(template)
-            string = string.replace(str(template), params.get('2', ''))
-
-    # replace
-    if 'texing' in tags:
-        for template in code.filter_templates(matches=r'^{{特性'):
-            params = parse_template(template)
-            replace = params.get('2', params.get('1')).strip('〔〕')
-            string = string.replace(str(template), f'〔{replace}〕')
-    if 'ruby' in tags:
-        for template in code.filter_templates(matches=r'^{{ruby'):
-            params = parse_template(template)
-            string = string.replace(str(template), f"{params.get('1')}[{params.get('2')}]")
-    if 'link' in tags:
-        # remove [[File:a.jpg|b|c]] - it show img
-        string = re.sub(r'\[\[(文件|File):([^\[\]]*?)]]', '', string)
-        for wiki_link in code.filter_wikilinks():  # type:mwp.nodes.wikilink.Wikilink
-            # [[语音关联从者::somebody]]
-            link = re.split(r':+', str(wiki_link.title))[-1]
-            shown_text = wiki_link.text
-            if shown_text:
-                shown_text = str(shown_text).split('|', maxsplit=1)[0]
-            string = string.replace(str(wiki_link), shown_text or link)
-    if 'trja' in tags:
-        for template in code.filter_templates(matches=r'^{{trja'):
-            params = parse_template(template)
-            string = string.replace(str(template), params.get('1') or params.get('2') or '')
-
-    # special
-    if 'bold' in tags:
-        string = re.sub(r"'''([^']*?)'''", r'\1', string)
-    # Okita Souji Alter
-    string = string.replace('{{jin}}', 'jin')
-
-    # final check
-    old_string = str(code)
-    if string != old_string and console:
-        logger.info(f'remove tags: from {len(old_string)}->{len(string)}\n'
-                    f'Old string:{old_string}\n\nNew string: {string}')
+    if '<' in string or '{{' in string or '[[' in string or "'''" in string:
+        old_string = string
+        tags = tuple(tags)
+        string = _memoize(REMOVE_TAG_CACHE, string, tags, lambda: _remove_tag(old_string, tags))
+        if string != old_string and console:
+            logger.info(f'remove tags: from {len(old_string)}->{len(string)}\n'
+                        f'Old string:{old_string}\n\nNew string: {string}')
     if string in ('-', '—', ''):
         return ''
     return string
@@ -160,7 +640,7 @@ def redirect_page(code, default=None):
 
 def split_tabber(code: Wikitext, default: str = '') -> List[Tuple[str, str]]:
     if isinstance(code, str):
-        code: Wikicode = mwp.parse(code)
+        code: Wikicode = parse_wikitext(code)
     tags: List[Tag] = code.filter_tags(recursive=False, matches='tabber')
     if len(tags) == 0:
         return [(default, trim(str(code)))]
@@ -181,6 +661,66 @@ def split_file_link(code: str):
         return None
 
 
+class PageIndex:
+    """Section spans and templates of one page, built in one traversal of the parse tree.
+
+    Queries give the same results as `get_sections(matches=...)` and `filter_templates(matches='^{{name')`
+    of the whole page, without traversing the page again. Section is represented by span
+    (start, end) of top level nodes, `code_of(span)` returns its Wikicode.
+    """
+    kFlags = re.IGNORECASE | re.DOTALL  # same as mwparserfromhell
+
+    def __init__(self, code: Wikitext):
+        self.code: Wikicode = mwp.parse(code) if isinstance(code, str) else code
+        self._headings: List[Tuple[str, int, int]] = []  # (title, start, end)
+        # raw name - [(order, top level node index, template)]
+        self._templates: Dict[str, List[Tuple[int, int, Template]]] = {}
+        nodes = self.code.nodes
+        open_headings: List[Tuple[int, int]] = []  # (level, index of self._headings), level increasing
+        order = 0
+        for i, node in enumerate(nodes):
+            if isinstance(node, mwp.nodes.Text):
+                continue
+            if isinstance(node, mwp.nodes.Heading):
+                while open_headings and node.level <= open_headings[-1][0]:
+                    self._close_heading(open_headings.pop()[1], i)
+                open_headings.append((node.level, len(self._headings)))
+                self._headings.append((str(node.title), i, len(nodes)))
+            for template in Wikicode([node]).filter_templates():
+                self._templates.setdefault(str(template.name), []).append((order, i, template))
+                order += 1
+
+    def _close_heading(self, heading_index: int, end: int):
+        title, start, _ = self._headings[heading_index]
+        self._headings[heading_index] = (title, start, end)
+
+    def sections(self, matches: str, within: Tuple[int, int] = None) -> List[Tuple[int, int]]:
+        """Spans of sections whose heading title matches, optionally inside span `within`"""
+        spans = []
+        for title, start, end in self._headings:
+            if within and not within[0] <= start < within[1]:
+                continue
+            if re.search(matches, title, self.kFlags):
+                spans.append((start, min(end, within[1]) if within else end))
+        return spans
+
+    def code_of(self, span: Tuple[int, int]) -> Wikicode:
+        return Wikicode(self.code.nodes[span[0]:span[1]])
+
+    def templates(self, name_pattern: str, within: Tuple[int, int] = None) -> List[Template]:
+        """Templates whose name matches `name_pattern` from start, optionally inside span `within`"""
+        matched = []
+        for name, items in self._templates.items():
+            if re.match(name_pattern, name, self.kFlags):
+                matched.extend([x for x in items if not within or within[0] <= x[1] < within[1]])
+        return [template for _, _, template in sorted(matched, key=lambda x: x[0])]
+
+    def template_params(self, name_pattern: str, within: Tuple[int, int] = None) -> Params:
+        """Params of the first template whose name matches, empty if not found"""
+        templates = self.templates(name_pattern, within)
+        return parse_template(templates[0]) if templates else Params()
+
+
 # %%
 def _find_effect_target(description: str, last=None):
     """
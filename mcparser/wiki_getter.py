@@ -1,6 +1,5 @@
 from io import StringIO
 from urllib.parse import urlencode
-from urllib.request import urlopen
 
 from .utils.util import *
 
@@ -8,16 +7,23 @@ from .utils.util import *
 class WikiGetter:
     """Download html code to get csv str then parse it"""
 
-    def __init__(self, pkl_fn: str = None):
-        if pkl_fn and os.path.exists(pkl_fn):
-            self.data = load_pickle(pkl_fn)
+    def __init__(self, fp: str = None):
+        """
+        :param fp: wikitext store of previous run, see `WikitextStore`.
+        """
+        if fp:
+            store = WikitextStore(fp)
+            self.data = store.to_dataframe()
+            store.close()
         else:
             self.data = pd.DataFrame()
 
-    def dump(self, fp: str):
-        dump_pickle(self.data, fp)
-        self.data.to_json(open(fp + '.json', 'w', encoding='utf8'), orient='index', force_ascii=False, indent=2)
-        logger.info(f'dump pickle and json data at "{fp}[.json]"')
+    def dump(self, fp: str, with_json=False):
+        """Save records to `WikitextStore`, and an indented json copy for debug if `with_json`"""
+        WikitextStore.dump(self.data, fp)
+        if with_json:
+            self.data.to_json(open(fp + '.json', 'w', encoding='utf8'), orient='index', force_ascii=False, indent=2)
+        logger.info(f'dump wikitext data at "{fp}"')
 
     def parse_csv(self, url, remain_cols: List[str] = None, replace_cols: Dict[str, str] = None,
                   override: pd.DataFrame = None):
@@ -40,45 +46,27 @@ class WikiGetter:
         """
         if replace_cols is None:
             replace_cols = {}
-        page = urlopen(url)
-        html_code = page.read().decode('utf-8')
+        html_code = fetch_url(url).decode('utf-8')
         csv_str = re.findall(r'var raw_str = "(.*?)";', html_code)[0]
         csv_str = csv_str.replace('\\n', '\n')
         # cmd_code page error src code
         csv_str = csv_str.replace('id,star,icon,icon_eff,stars_marker', 'id,star,icon,icon_eff,stars_marker,nothing')
         df: pd.DataFrame = pd.read_csv(StringIO(csv_str), sep=',', index_col='id', dtype='object')
         if override is not None:
-            for i in override.index:
-                # only override if index not in csv
-                if i not in df.index:
-                    for j in override.columns:
-                        if not pd.isna(override.loc[i, j]):
-                            df.loc[i, j] = override.loc[i, j]
+            # only override if index not in csv, NaN cells are ignored
+            extra = override[~override.index.isin(df.index)].dropna(how='all').dropna(axis=1, how='all')
+            df = pd.concat([df, extra.astype(object)])
         df = df.fillna('')
 
         # override_data
-        override_data_str: str = re.findall(r'override_data = "(.*?)";', html_code)[0]
-        override_data_str = override_data_str.replace('\\n', '\n')
-        override_list = override_data_str.split('\n\n')
-        for override_record in override_list:
-            if 'id' in override_record:
-                override_map = {}
-                for row in override_record.split('\n'):
-                    k, v = row.split('=', maxsplit=1)
-                    k, v = trim(k), trim(v)
-                    if v != '':
-                        override_map[k] = v
-                item_id = int(override_map['id'])
-                for key, value in override_map.items():
-                    if key != 'id':
-                        if key not in df.columns:
-                            df.loc[item_id, key] = ''  # set dtype to object rather float
-                        df.loc[item_id, key] = value
-                # logger.info(f'override map: {override_map}')
-        df = df.fillna('')
-        for col in list(remain_cols) + list(replace_cols.values()):
-            if col not in df.columns:
-                df.loc[1, col] = ''
+        updates = self._parse_override_data(re.findall(r'override_data = "(.*?)";', html_code)[0])
+        new_rows = updates.index.difference(df.index, sort=False)
+        new_cols = updates.columns.difference(df.columns, sort=False)
+        df = df.reindex(index=df.index.append(new_rows), columns=df.columns.append(new_cols), fill_value='')
+        df.update(updates)
+        missing_cols = [col for col in list(remain_cols or []) + list(replace_cols.values())
+                        if col not in df.columns]
+        df = df.reindex(columns=list(df.columns) + missing_cols, fill_value='')
         self.data = self.data.reindex(df.index)
         logger.info(f'records number = {len(self.data.index)}')
 
@@ -92,57 +80,155 @@ class WikiGetter:
         self.data[remain_cols] = df[remain_cols]
         self.data[list(replace_cols.values())] = df[list(replace_cols.keys())]
 
+    @staticmethod
+    def _parse_override_data(override_data_str: str) -> pd.DataFrame:
+        """Parse override records into a DataFrame indexed by id, later record overrides former one.
+
+        Records are separated by empty line, every row is "key=value", NaN if key absent or value empty.
+        """
+        override_data_str = override_data_str.replace('\\n', '\n')
+        records = []
+        for override_record in override_data_str.split('\n\n'):
+            if 'id' in override_record:
+                override_map = {}
+                for row in override_record.split('\n'):
+                    k, v = row.split('=', maxsplit=1)
+                    k, v = trim(k), trim(v)
+                    if v != '':
+                        override_map[k] = v
+                override_map['id'] = int(override_map['id'])
+                records.append(override_map)
+        if not records:
+            return pd.DataFrame(dtype=object)
+        updates = pd.DataFrame.from_records(records, index='id').astype(object)
+        # last non-NaN value of every column per id
+        return updates.groupby(level=0, sort=False).last()
+
     @count_time
-    def down_all_wikitext(self, _range: Iterable = None, workers: int = None, sub_pages: Dict[str, str] = None):
+    def down_all_wikitext(self, _range: Iterable = None, workers: int = None, sub_pages: Dict[str, str] = None,
+                          incremental=False, backend: str = None):
+        """
+        :param incremental: only download records whose page revision changed since last download.
+        :param backend: download backend, see `get_site_revisions`.
+        """
         if _range is None:
             _range = self.data.index
         executor = ThreadPoolExecutor(max_workers=workers)
         all_keys, success_keys, error_keys = [i for i in self.data.index if i in _range], [], []
+        if incremental:
+            outdated_keys = self._outdated_keys(all_keys, sub_pages, workers, backend)
+            logger.info(f'incremental: {len(outdated_keys)}/{len(all_keys)} records changed: {outdated_keys}')
+            all_keys = outdated_keys
         finish_num, all_num = 0, len(all_keys)
-        tasks = [executor.submit(self._download_wikitext, index, sub_pages) for index in all_keys]
+        for key in ['wikitext'] + list((sub_pages or {}).keys()):
+            for col in (key, key + '_revid', key + '_timestamp'):
+                if col not in self.data.columns:
+                    self.data[col] = ''  # set dtype to object rather float
+        # resolve redirects and download wikitext in batches rather than one request per page
+        titles = [link for index in all_keys for link in self._page_links(index, sub_pages).values()]
+        targets = REDIRECTS.resolve(titles, workers=workers, backend=backend)
+        prefetched = get_site_revisions([t for t in targets.values() if t], content=True, workers=workers,
+                                        backend=backend)
+        logger.info(f'prefetched {len(prefetched)}/{len(titles)} pages')
+        tasks = [executor.submit(self._download_wikitext, index, sub_pages, prefetched) for index in all_keys]
+        # workers only read self.data, results are applied in bulk on main thread
+        results: Dict[int, Dict[str, str]] = {}
         for future in as_completed(tasks):
             finish_num += 1
-            index = future.result()
-            if index is None:
+            result = future.result()
+            if result is None:
                 logger.warning(f'======= download wikitext {finish_num}/{all_num} FAILED ========')
             else:
+                index, results[index] = result
                 success_keys.append(index)
                 logger.debug(f'======= download wikitext {finish_num}/{all_num} success:'
-                             f' No.{index} {self.data.loc[index, "name_link"]}')
+                             f' No.{index} {results[index].get("name_link") or self.data.loc[index, "name_link"]}')
+        if results:
+            self.data.update(pd.DataFrame.from_dict(results, orient='index', dtype=object))
         self.data[pd.isna(self.data)] = ''
         error_keys = [k for k in all_keys if k not in success_keys]
         logger.info(f'All {all_num} wikitext downloaded. {len(error_keys)} errors: {error_keys}',
                     extra=color_extra('red') if error_keys else None)
 
-    @catch_exception
-    def _download_wikitext(self, index: int, sub_pages: Dict[str, str]) -> int:
+    def _page_links(self, index: int, sub_pages: Dict[str, str] = None) -> Dict[str, str]:
+        """Map of column - page title of one record"""
         name_link = self.data.loc[index, 'name_link']
-        if threading.current_thread() != threading.main_thread():
-            threading.current_thread().setName(f'No.{index}-{name_link}')
         pages = {'wikitext': name_link}
         if sub_pages:
             for key, sublink in sub_pages.items():
                 pages[key] = name_link + '/' + sublink
+        return pages
+
+    def _outdated_keys(self, keys: List[int], sub_pages: Dict[str, str] = None, workers: int = None,
+                       backend: str = None) -> List[int]:
+        """Compare stored revision ids with the latest revisions, return keys of changed records"""
+        links = dict([(index, self._page_links(index, sub_pages)) for index in keys])
+        targets = REDIRECTS.resolve([link for pages in links.values() for link in pages.values()],
+                                    workers=workers, backend=backend)
+        target_revisions = get_site_revisions([t for t in targets.values() if t], workers=workers, backend=backend)
+        revisions = dict([(link, target_revisions.get(target)) for link, target in targets.items()
+                          if target is None or target in target_revisions])
+        outdated_keys = []
+        for index, pages in links.items():
+            for key, page_link in pages.items():
+                old_revid = self.data.loc[index, key + '_revid'] if key + '_revid' in self.data.columns else None
+                old_revid = None if pd.isna(old_revid) or old_revid == '' else int(old_revid)
+                if page_link not in revisions or key not in self.data.columns:
+                    # request failed or new column
+                    changed = True
+                else:
+                    revision = revisions[page_link]
+                    changed = old_revid != (revision['revid'] if revision else None)
+                if changed:
+                    outdated_keys.append(index)
+                    break
+        return outdated_keys
+
+    @catch_exception
+    def _download_wikitext(self, index: int, sub_pages: Dict[str, str],
+                           prefetched: Dict[str, Optional[Dict]] = None) -> MapEntry[int, Dict[str, str]]:
+        """Return (index, dict of column - new value), including "name_link" if redirected.
+
+        Redirects are resolved by `REDIRECTS` in `down_all_wikitext` before downloading.
+        """
+        name_link = self.data.loc[index, 'name_link']
+        if threading.current_thread() != threading.main_thread():
+            threading.current_thread().setName(f'No.{index}-{name_link}')
+        pages = self._page_links(index, sub_pages)
+        updates: Dict[str, str] = {}
 
         for key, page_link in pages.items():
-            wikitext = get_site_page(page_link)
+            target = REDIRECTS.get(page_link)
+            if target and target != page_link and key == 'wikitext':
+                logger.warning(f'redirect No.{index}-{name_link} to {target}')
+                updates['name_link'] = target
+            if prefetched is not None and target in prefetched:
+                revision = prefetched[target]
+            else:
+                revision = get_site_revisions([target], content=True).get(target) if target else None
+            wikitext = revision['content'] if revision else None
             if not wikitext:
                 if key == 'wikitext':
                     logger.warning(f'No.{index}-{page_link} wikitext is null!')
+                updates[key + '_revid'] = ''
                 continue
             redirect_link = redirect_page(wikitext)
             if redirect_link:
+                # redirect not resolved by `REDIRECTS`
                 logger.warning(f'redirect No.{index}-{name_link} to {redirect_link}')
-                self.data.loc[index, 'name_link'] = redirect_link
-                wikitext = get_site_page(redirect_link)
+                updates['name_link'] = redirect_link
+                revision = get_site_revisions([redirect_link], content=True).get(redirect_link) or {}
+                wikitext = revision.get('content') or ''
             # assert redirect_link is None, (redirect_link, wikitext)
             wikitext = remove_tag(wikitext, ('ref', 'br', 'comment', 'del', 'sup', 'include', 'heimu', 'ruby'))
             if key in self.data.keys():
                 old_text = str(self.data.loc[index, key])
                 if old_text != wikitext:
                     logger.info(f'No.{index:<3d}-{page_link}: wikitext changed: len {len(old_text)}->{len(wikitext)}')
-            self.data.loc[index, key] = wikitext
-        return index
+            updates[key] = wikitext
+            updates[key + '_revid'] = str(revision.get('revid') or '')
+            updates[key + '_timestamp'] = revision.get('timestamp') or ''
+        return index, updates
 
     @staticmethod
     def get_servant_data(fp: str = None, **kwargs):
@@ -154,7 +240,9 @@ class WikiGetter:
                              override=kwargs.pop('override', None))
         svt_spider.down_all_wikitext(_range=kwargs.pop('_range', None),
                                      workers=kwargs.pop('workers', config.default_workers),
-                                     sub_pages={'wikitext_voice': '语音', 'wikitext_quest': '从者任务'})
+                                     sub_pages={'wikitext_voice': '语音', 'wikitext_quest': '从者任务'},
+                                     incremental=kwargs.pop('incremental', False),
+                                     backend=kwargs.pop('backend', None))
         svt_spider.dump(fp)
         return svt_spider
 
@@ -171,7 +259,9 @@ class WikiGetter:
             craft_spider.data.loc[index, 'des'] = remove_tag(craft_spider.data.loc[index, 'des'])
             craft_spider.data.loc[index, 'des_max'] = remove_tag(craft_spider.data.loc[index, 'des_max'])
         craft_spider.down_all_wikitext(_range=kwargs.pop('_range', None),
-                                       workers=kwargs.pop('workers', config.default_workers))
+                                       workers=kwargs.pop('workers', config.default_workers),
+                                       incremental=kwargs.pop('incremental', False),
+                                       backend=kwargs.pop('backend', None))
         craft_spider.dump(fp)
         return craft_spider
 
@@ -185,7 +275,9 @@ class WikiGetter:
                              replace_cols={},
                              override=kwargs.pop('override', None))
         cmd_spider.down_all_wikitext(_range=kwargs.pop('_range', None),
-                                     workers=kwargs.pop('workers', config.default_workers))
+                                     workers=kwargs.pop('workers', config.default_workers),
+                                     incremental=kwargs.pop('incremental', False),
+                                     backend=kwargs.pop('backend', None))
         cmd_spider.dump(fp)
         return cmd_spider
 
@@ -201,15 +293,22 @@ class EventWikiGetter:
         dump_json(self.data, fp)
         logger.info(f'dump event json wikitext data at "{fp}"')
 
-    def ask_event_list(self, event_types: List[str] = None, workers: int = None, start_from=None):
+    def ask_event_list(self, event_types: List[str] = None, workers: int = None, start_from=None, incremental=False,
+                       backend: str = None):
+        """
+        :param incremental: only download events whose page revisions changed since last download.
+        :param backend: download backend, see `get_site_revisions`.
+        """
         executor = ThreadPoolExecutor(max_workers=workers)
         # add daily first
         daily_key = '迦勒底之门/每日任务'
+        daily_revision = get_site_revisions([daily_key], content=True).get(daily_key) or {}
         self.data['DailyQuest'] = {
             'name': daily_key,
             'event_page': '',
-            'quest_page': remove_tag(get_site_page(daily_key), tags=kSafeTags),
-            'sub_pages': {}
+            'quest_page': remove_tag(daily_revision.get('content') or '', tags=kSafeTags),
+            'sub_pages': {},
+            'revisions': {daily_key: daily_revision.get('revid')}
         }
 
         if event_types is None:
@@ -222,8 +321,8 @@ class EventWikiGetter:
                 "api_version": "2",  # 2-dict, 3-list
                 "utf8": 1
             }
-            response = urlopen(f'https://{config.domain}/api.php?{urlencode(param)}')
-            event_query_result: Dict = json.load(response)['query']['results']
+            response = fetch_url(f'https://{config.domain}/api.php?{urlencode(param)}')
+            event_query_result: Dict = json.loads(response)['query']['results']
             events = self.data.setdefault(_event_type, {})
 
             start_key, start_index = (start_from or {}).get(_event_type), 0
@@ -234,8 +333,14 @@ class EventWikiGetter:
                     break
             all_keys = list(event_query_result.keys())
             down_keys, success_keys, error_keys = all_keys[start_index:], [], []
+            if incremental:
+                down_keys = self._outdated_keys(events, down_keys, workers, backend)
+                logger.info(f'incremental: {len(down_keys)}/{len(all_keys) - start_index} {_event_type} changed')
+            # download pages of all events in batches
+            titles = [link for k in down_keys for link in self._event_page_links(k).values()]
+            prefetched = get_site_revisions(titles, content=True, workers=workers, backend=backend)
             finish_num, all_num = 0, len(down_keys)
-            tasks = [executor.submit(self._down_wikitext, event_query_result[k]) for k in down_keys]
+            tasks = [executor.submit(self._down_wikitext, event_query_result[k], prefetched) for k in down_keys]
 
             # drop renamed event in previous `events` dict
             for e in [k for k in events.keys() if k not in all_keys]:
@@ -258,12 +363,28 @@ class EventWikiGetter:
             self.data[_event_type] = sort_dict(events, lambda x: all_keys.index(x))
 
     @staticmethod
-    @catch_exception
-    def _down_wikitext(event_info: Dict[str, Any]) -> MapEntry[str, Dict]:
-        name = event_info['fulltext']
-        sub_pages = {}
-        sub_page_titles = []
+    def _outdated_keys(events: Dict[str, Dict], keys: List[str], workers: int = None,
+                       backend: str = None) -> List[str]:
+        """Compare stored revision ids of event pages with the latest revisions, return keys of changed events"""
+        titles = [title for key in keys for title in events.get(key, {}).get('revisions', {})]
+        revisions = get_site_revisions(titles, workers=workers, backend=backend)
+        outdated_keys = []
+        for key in keys:
+            old_revisions: Dict[str, int] = events.get(key, {}).get('revisions')
+            if not old_revisions:
+                outdated_keys.append(key)
+                continue
+            for title, old_revid in old_revisions.items():
+                if title not in revisions or old_revid != (revisions[title] or {}).get('revid'):
+                    outdated_keys.append(key)
+                    break
+        return outdated_keys
 
+    @staticmethod
+    def _event_page_links(name: str) -> Dict[str, str]:
+        """Map of event_page/quest_page/sub page title - page link"""
+        links = {'event_page': name, 'quest_page': name + '/关卡配置'}
+        sub_page_titles = []
         if '亚马逊' in name:
             sub_page_titles = ['亚马逊仓库', '阿耳忒弥斯神殿塔', '极·阿耳忒弥斯神殿塔']
         elif '百重塔' in name:
@@ -271,12 +392,30 @@ class EventWikiGetter:
         elif '大奥' in name:
             sub_page_titles = [f'第{i}层' for i in '一二三四五']
         for title in sub_page_titles:
-            sub_pages[title] = remove_tag(get_site_page(f'{name}/关卡配置/{title}'), tags=kSafeTags)
+            links[title] = f'{name}/关卡配置/{title}'
+        return links
+
+    @staticmethod
+    @catch_exception
+    def _down_wikitext(event_info: Dict[str, Any], prefetched: Dict[str, Optional[Dict]] = None) -> MapEntry[str, Dict]:
+        name = event_info['fulltext']
+        links = EventWikiGetter._event_page_links(name)
+        if prefetched is not None and all([link in prefetched for link in links.values()]):
+            revisions = dict([(link, prefetched[link]) for link in links.values()])
+        else:
+            # all pages of one event in one request
+            revisions = get_site_revisions(links.values(), content=True)
+        assert name in revisions, f'failed to download pages of event "{name}"'
+
+        def _get_text(link):
+            return remove_tag((revisions.get(link) or {}).get('content') or '', tags=kSafeTags)
+
         result = {
             'name': name,
-            'event_page': remove_tag(get_site_page(name), tags=kSafeTags),
-            'quest_page': remove_tag(get_site_page(name + '/关卡配置'), tags=kSafeTags),
-            'sub_pages': sub_pages
+            'event_page': _get_text(links.pop('event_page')),
+            'quest_page': _get_text(links.pop('quest_page')),
+            'sub_pages': dict([(title, _get_text(link)) for title, link in links.items()]),
+            'revisions': dict([(link, (revision or {}).get('revid')) for link, revision in revisions.items()])
         }
         return name, result
 
@@ -286,5 +425,7 @@ class EventWikiGetter:
         event_spider = EventWikiGetter(fp)
         event_spider.ask_event_list(event_types=kwargs.pop('event_types', None),
                                     workers=kwargs.pop('workers', config.default_workers),
-                                    start_from=kwargs.pop('start_from', None))
+                                    start_from=kwargs.pop('start_from', None),
+                                    incremental=kwargs.pop('incremental', False),
+                                    backend=kwargs.pop('backend', None))
         event_spider.dump(fp)
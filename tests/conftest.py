@@ -0,0 +1,9 @@
+import pytest
+
+from mcparser.utils.config import config
+
+
+@pytest.fixture(autouse=True, scope='session')
+def cache_folder(tmp_path_factory):
+    """Keep sqlite caches written by tests out of the working tree"""
+    config.paths.cache_folder = str(tmp_path_factory.mktemp('cache'))
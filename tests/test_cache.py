@@ -0,0 +1,179 @@
+import json
+import os
+import time
+from typing import Any, Dict
+
+from mcparser import base_parser
+from mcparser.base_parser import BaseParser
+from mcparser.utils.basic import MapEntry, catch_exception
+from mcparser.utils import templates
+from mcparser.utils.cache import PageCache, ParsedCache, TemplateResultCache
+from mcparser.utils.config import config
+from mcparser.utils.datatypes import Battle, Quest
+from mcparser.utils.templates import parse_template, t_quest
+
+kQuest = '{{关卡配置|名称cn=Q|可重复=1|一AP=10|一地点=P|一战利品={{道具|凶骨}}x2}}'
+
+
+def test_page_cache_get_put(tmp_path):
+    cache = PageCache(str(tmp_path))
+    assert cache.get('A') is None
+    cache.put('A', '{{道具|凶骨}}', revid=1)
+    cache.put('B', '{{道具|凶骨}}', revid=2)
+    assert cache.get('A') == '{{道具|凶骨}}'
+    assert cache.get('A', revid=1) == '{{道具|凶骨}}'
+    assert cache.get('A', revid=2) is None
+    # pages with the same content share one blob
+    assert cache.get_entry('A')['sha1'] == cache.get_entry('B')['sha1']
+    assert len(os.listdir(tmp_path / 'blobs')) == 1
+    # reopened from disk
+    assert PageCache(str(tmp_path)).get('B', revid=2) == '{{道具|凶骨}}'
+
+
+def test_page_cache_ttl(tmp_path):
+    cache = PageCache(str(tmp_path))
+    cache.put('A', 'text')
+    cache.conn.execute('UPDATE pages SET fetched=?', (time.time() - 100,))
+    assert cache.get('A', ttl=10) is None
+    assert cache.get('A', ttl=1000) == 'text'
+    cache.touch('A')
+    assert cache.get('A', ttl=10) == 'text'
+
+
+def test_page_cache_broken_blob(tmp_path):
+    cache = PageCache(str(tmp_path))
+    cache.put('A', 'text')
+    with open(cache._blob_fp(cache.get_entry('A')['sha1']), 'wb') as fd:
+        fd.write(b'broken')
+    assert cache.get('A') is None
+    assert cache.get_entry('A') is None
+
+
+def test_page_cache_missing(tmp_path):
+    cache = PageCache(str(tmp_path))
+    cache.put('A', 'text')
+    cache.mark_missing('A')
+    assert cache.is_missing('A') and cache.get('A') is None
+    assert not cache.is_missing('A', ttl=-1)
+    cache.put('A', 'text')
+    assert not cache.is_missing('A')
+
+
+def test_page_cache_evict(tmp_path):
+    cache = PageCache(str(tmp_path))
+    cache.put('old', 'a' * 10)
+    cache.put('small', 'b' * 10)
+    cache.put('large', 'c' * 100)
+    cache.conn.execute('UPDATE pages SET fetched=? WHERE title=?', (time.time() - 100, 'old'))
+    cache.conn.execute('UPDATE pages SET accessed=? WHERE title=?', (time.time() - 50, 'large'))
+    cache.evict(max_age=10, max_size=50)
+    assert cache.get_entry('old') is None
+    assert cache.get_entry('large') is None
+    assert cache.get('small') == 'b' * 10
+    blobs = [fn for sub in os.listdir(tmp_path / 'blobs') for fn in os.listdir(tmp_path / 'blobs' / sub)]
+    assert blobs == [cache.get_entry('small')['sha1']]
+    cache.clear()
+    assert cache.get('small') is None
+
+
+def test_parsed_cache(tmp_path):
+    cache = ParsedCache(str(tmp_path))
+    assert cache.get('P', 1, 'h1') is None
+    cache.put_many('P', [(1, 'h1', {'name': 'a'}, [('a.png', None)]), (2, 'h2', {'name': 'b'}, [])])
+    assert cache.get('P', 1, 'h1') == ({'name': 'a'}, [('a.png', None)])
+    # changed record or parser
+    assert cache.get('P', 1, 'h2') is None
+    assert cache.get('Q', 1, 'h1') is None
+    cache.clear('Q')
+    assert ParsedCache(str(tmp_path)).get('P', 2, 'h2') == ({'name': 'b'}, [])
+    cache.clear('P')
+    assert cache.get('P', 2, 'h2') is None
+
+
+def test_quest_json_round_trip():
+    quest = t_quest(parse_template(kQuest))
+    data = quest.to_json(False, 'json')
+    restored = Quest().from_json(json.loads(json.dumps(data)))
+    assert isinstance(restored.battles[0], Battle)
+    assert restored.to_json(False, 'json') == data
+    assert restored.get_all_drop_items() == quest.get_all_drop_items()
+
+
+class QuestParser(BaseParser):
+    value_type = Quest
+
+    def __init__(self, records: Dict[int, Dict[str, Any]]):
+        super().__init__()
+        self.records = records
+        self.parsed = []
+
+    def get_keys(self):
+        return list(self.records)
+
+    def get_record(self, key: Any) -> Dict[str, Any]:
+        return self.records[key]
+
+    @catch_exception
+    def _parse_one(self, key: Any, record: Dict[str, Any]) -> MapEntry:
+        self.parsed.append(key)
+        return key, t_quest(parse_template(record['wikitext']))
+
+
+def test_incremental_parse(tmp_path, monkeypatch):
+    monkeypatch.setattr(base_parser, 'PARSED_CACHE', ParsedCache(str(tmp_path)))
+    records = {1: {'wikitext': kQuest}, 2: {'wikitext': kQuest.replace('x2', 'x3')}}
+    parser = QuestParser(records)
+    parser.parse(incremental=True)
+    assert sorted(parser.parsed) == [1, 2]
+    expected = {k: v.to_json(False, 'json') for k, v in parser.data.items()}
+
+    parser = QuestParser(records)
+    parser.parse(incremental=True)
+    assert parser.parsed == []
+    assert {k: v.to_json(False, 'json') for k, v in parser.data.items()} == expected
+
+    records[2] = {'wikitext': kQuest.replace('x2', 'x4')}
+    parser = QuestParser(records)
+    parser.parse(incremental=True)
+    assert parser.parsed == [2]
+    assert parser.data[2].get_all_drop_items() == {'凶骨': 4}
+
+
+def test_template_result_cache(tmp_path, monkeypatch):
+    cache = TemplateResultCache(str(tmp_path))
+    assert cache.get('a') is None
+    cache.put('a', {'v': 1})
+    # buffered result is visible before flushed
+    assert cache.get('a') == {'v': 1}
+    assert TemplateResultCache(str(tmp_path)).get('a') is None
+    cache.flush()
+    assert TemplateResultCache(str(tmp_path)).get('a') == {'v': 1}
+
+    monkeypatch.setattr(config, 'template_cache_size', 2)
+    cache.put('b', 2)
+    cache.flush()
+    cache.conn.execute('UPDATE results SET accessed=0 WHERE key=?', ('b',))
+    cache.put('c', 3)
+    cache.flush()
+    # least recently used is evicted
+    assert cache.get('b') is None and cache.get('a') == {'v': 1} and cache.get('c') == 3
+    cache.clear()
+    assert cache.get('a') is None
+
+
+def test_cached_template(tmp_path, monkeypatch):
+    cache = TemplateResultCache(str(tmp_path))
+    monkeypatch.setattr(templates, 'TEMPLATE_RESULTS', cache)
+    assert t_quest.__name__ == 't_quest'
+    params = parse_template(kQuest)
+    quest = t_quest(params)
+    assert len(cache._new) == 1
+    cached = t_quest(params)
+    assert cached is not quest
+    assert cached.to_json(False, 'json') == quest.to_json(False, 'json')
+    assert len(cache._new) == 1
+    t_quest(parse_template(kQuest.replace('x2', 'x3')))
+    assert len(cache._new) == 2
+    # filling an existing instance is not cached
+    t_quest(parse_template(kQuest.replace('x2', 'x4')), Quest())
+    assert len(cache._new) == 2
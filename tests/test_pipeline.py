@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from mcparser.pipeline import Pipeline, Stage
+from mcparser.utils.basic import FORK_GUARD
+from mcparser.utils.util import dump_json, load_json
+
+
+class Recorder:
+    def __init__(self):
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str, secs=0.02, **kwargs) -> Stage:
+        def _func(results):
+            t0 = time.time()
+            with FORK_GUARD.forking() as safe:
+                pass
+            time.sleep(secs)
+            with self._lock:
+                self.spans[name] = (t0, time.time(), safe)
+            return name
+
+        return Stage(name, _func, **kwargs)
+
+    def overlapped(self, a: str, b: str) -> bool:
+        return self.spans[a][0] < self.spans[b][1] and self.spans[b][0] < self.spans[a][1]
+
+
+def test_order_and_deps(tmp_path):
+    rec = Recorder()
+    pipeline = Pipeline([rec.stage('c', deps=['a', 'b']), rec.stage('a'), rec.stage('b')],
+                        state_fp=str(tmp_path / 'state.json'))
+    assert pipeline.order == ['a', 'b', 'c']
+    assert pipeline.run() == {'a': 'a', 'b': 'b', 'c': 'c'}
+    # independent stages overlap, dependent stage waits
+    assert rec.overlapped('a', 'b')
+    assert rec.spans['c'][0] >= max(rec.spans['a'][1], rec.spans['b'][1])
+
+
+def test_bad_stages():
+    with pytest.raises(AssertionError):
+        Pipeline([Stage('a', lambda r: 1, deps=['b']), Stage('b', lambda r: 1, deps=['a'])])
+    with pytest.raises(AssertionError):
+        Pipeline([Stage('a', lambda r: 1, deps=['x'])])
+
+
+def test_exclusive_runs_alone(tmp_path):
+    rec = Recorder()
+    pipeline = Pipeline([rec.stage('a'), rec.stage('b'), rec.stage('x', exclusive=True), rec.stage('c')],
+                        state_fp=str(tmp_path / 'state.json'))
+    pipeline.run()
+    for name in 'abc':
+        assert not rec.overlapped('x', name)
+    assert rec.spans['x'][2] is True
+    assert rec.spans['a'][2] is False or rec.spans['b'][2] is False
+    assert FORK_GUARD._running_num == 0
+
+
+def test_failed_dependency(tmp_path):
+    def _fail(results):
+        raise ValueError('failed')
+
+    called = []
+    pipeline = Pipeline([Stage('a', _fail), Stage('b', lambda r: called.append(1), deps=['a'])],
+                        state_fp=str(tmp_path / 'state.json'))
+    results = pipeline.run()
+    assert not called and 'a' not in results and 'b' not in results
+    assert FORK_GUARD._running_num == 0
+
+
+def test_skip_unchanged_inputs(tmp_path):
+    src, out, state_fp = tmp_path / 'src.json', tmp_path / 'out.json', str(tmp_path / 'state.json')
+    calls = []
+
+    def _build(results):
+        calls.append(1)
+        data = load_json(str(src))
+        dump_json(data, str(out))
+        return data
+
+    def _stages():
+        return [Stage('build', _build, inputs=[str(src)], outputs=[str(out)], load=lambda r: load_json(str(out))),
+                Stage('use', lambda r: r['build']['v'], deps=['build'])]
+
+    dump_json({'v': 1}, str(src))
+    assert Pipeline(_stages(), state_fp).run()['use'] == 1
+    # unchanged input: skipped and restored by load
+    assert Pipeline(_stages(), state_fp).run()['use'] == 1
+    assert len(calls) == 1
+    Pipeline(_stages(), state_fp).run(force=True)
+    assert len(calls) == 2
+    dump_json({'v': 2}, str(src))
+    assert Pipeline(_stages(), state_fp).run()['use'] == 2
+    assert len(calls) == 3
+    # missing output
+    out.unlink()
+    assert Pipeline(_stages(), state_fp).run()['use'] == 2
+    assert len(calls) == 4
+    # not selected: restored by load
+    assert Pipeline(_stages(), state_fp).run(stages=['use'])['use'] == 2
+    assert len(calls) == 4
@@ -0,0 +1,32 @@
+import mwparserfromhell as mwp
+import pytest
+
+from mcparser.quest_pages import QuestPage
+from mcparser.utils.templates import parse_template, sum_quest_reward_drop, t_quest
+
+kQuest = '{{关卡配置|名称cn=Q%d|可重复=0|一AP=10|一地点=P|一战利品={{道具|凶骨}}x%d|通关奖励={{道具|圣晶石}}}}'
+# raise KeyError, branch without default
+kBadQuest = '{{关卡配置|名称cn=B|一AP=1|一战利品={{关卡分支}}}}'
+kPage = f'==主线关卡==\n{kQuest % (1, 2)}\n{kQuest % (2, 3)}\n==高难度关卡==\n{kQuest % (3, 1)}\n==其他==\n{kBadQuest}'
+
+
+def _reference_sum(text: str):
+    quests = [t_quest(parse_template(t)) for t in mwp.parse(text).filter_templates(matches='^{{关卡配置')]
+    return sum_quest_reward_drop(quests)
+
+
+def test_quests_of_section_same_as_t_quest():
+    page = QuestPage(mwp.parse(kPage))
+    main = page.sections('主线关卡')[0]
+    hard = page.sections('高难度关卡')[0]
+    assert sum_quest_reward_drop(page.quests(main)) == _reference_sum(kQuest % (1, 2) + kQuest % (2, 3))
+    assert [q.name for q in page.quests(hard)] == ['Q3']
+    # quests are shared by queries
+    assert page.quests(main)[0] is page.quests(main)[0]
+
+
+def test_bad_quest_only_fails_its_section():
+    page = QuestPage(mwp.parse(kPage))
+    assert [q.name for q in page.quests(page.sections('主线关卡')[0])] == ['Q1', 'Q2']
+    with pytest.raises(KeyError):
+        page.quests(page.sections('其他')[0])
@@ -0,0 +1,40 @@
+import pickle
+
+import pandas as pd
+import pytest
+
+from mcparser.utils.store import WikitextStore
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({'name_link': ['a', 'b'], 'wikitext': ['{{x|1}}', '{{y|2}}']},
+                        index=pd.Index([1, 2], name='id'))
+
+
+@pytest.mark.parametrize('filename', ['x_src.db', 'x_src.pkl'])
+def test_dump_round_trip(tmp_path, df, filename):
+    fp = str(tmp_path / filename)
+    WikitextStore.dump(df, fp)
+    store = WikitextStore(fp)
+    assert store.keys() == [1, 2]
+    assert store.columns() == ['name_link', 'wikitext']
+    assert store.name_links() == {1: 'a', 2: 'b'}
+    assert store[2] == {'name_link': 'b', 'wikitext': '{{y|2}}'}
+    assert 3 not in store
+    assert store.to_dataframe().to_dict('index') == df.to_dict('index')
+    store.close()
+
+
+def test_legacy_pickle(tmp_path, df):
+    pickle.dump(df, open(tmp_path / 'x_src.pkl', 'wb'))
+    for fp in (tmp_path / 'x_src.pkl', tmp_path / 'x_src.db'):
+        store = WikitextStore(str(fp))
+        assert store.keys() == [1, 2]
+        assert store[1] == {'name_link': 'a', 'wikitext': '{{x|1}}'}
+        assert len(store) == 2
+
+
+def test_missing_file(tmp_path):
+    store = WikitextStore(str(tmp_path / 'none.db'))
+    assert len(store) == 0 and store.get(1) is None
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+from mwclient.errors import APIError, InvalidPageTitle, MaximumRetriesExceeded
+
+from mcparser.utils import throttle
+from mcparser.utils.config import config
+from mcparser.utils.throttle import RateLimiter, backoff_delay, call_with_retry, parse_retry_after, retry_after_of
+
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setattr(config, 'retry_backoff', 0.001)
+    monkeypatch.setattr(config, 'retry_backoff_max', 0.001)
+    monkeypatch.setattr(throttle, 'RATE_LIMITER', RateLimiter(rate=1000, burst=1000, max_concurrency=4))
+
+
+def test_backoff_delay():
+    for retry_no in range(8):
+        assert 0 <= backoff_delay(retry_no, base=1, cap=10) <= min(10, 2 ** retry_no)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) == 0
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('-1') == 0
+    assert parse_retry_after('soon') == 0
+    assert 8 < parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+
+
+def test_retry_after_of():
+    response = requests.Response()
+    response.headers['Retry-After'] = '2'
+    assert retry_after_of(requests.HTTPError(response=response)) == 2
+    assert retry_after_of(requests.HTTPError(response=requests.Response())) == 0
+    assert retry_after_of(APIError('maxlag', 'lagged', {})) == config.max_lag
+    # repeated 5xx is not a pause request, only maxlag response recorded by hook is
+    lagged = requests.Response()
+    lagged.headers.update({'X-Database-Lag': '7', 'Retry-After': '4'})
+    throttle.database_lag_hook(requests.Response())
+    assert retry_after_of(MaximumRetriesExceeded()) == 0
+    throttle.database_lag_hook(lagged)
+    assert retry_after_of(MaximumRetriesExceeded()) == 4
+    assert retry_after_of(ValueError()) == 0
+
+
+def test_rate_limiter_tokens():
+    limiter = RateLimiter(rate=10, burst=2, max_concurrency=4)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+    limiter.pause(1)
+    assert limiter.reserve() > 0.9
+
+
+def test_rate_limiter_concurrency():
+    limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=4)
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(False)
+    # failures of the same burst only halve once
+    assert limiter.concurrency == 2
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release(True)
+    assert limiter.concurrency == 3
+
+
+def test_rate_limiter_blocks_threads():
+    limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=2)
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def _job():
+        limiter.acquire()
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.005)
+        with lock:
+            active[0] -= 1
+        limiter.release(True)
+
+    threads = [threading.Thread(target=_job) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+
+
+def test_rate_limiter_async_handover():
+    limiter = RateLimiter(rate=10000, burst=10000, max_concurrency=5)
+    active, peak = [0], [0]
+
+    async def _job():
+        await limiter.acquire_async()
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.005)
+        active[0] -= 1
+        limiter.release(True)
+
+    async def _main():
+        await asyncio.gather(*[_job() for _ in range(100)])
+
+    t0 = time.time()
+    asyncio.run(_main())
+    # 20 rounds of 5ms, polling every 50ms would take much longer
+    assert time.time() - t0 < 0.5
+    assert peak[0] == 5
+    assert limiter._active == 0 and not limiter._async_waiters
+
+
+def test_rate_limiter_async_cancel():
+    limiter = RateLimiter(rate=10000, burst=10000, max_concurrency=1)
+
+    async def _main():
+        await limiter.acquire_async()
+        waiters = [asyncio.ensure_future(limiter.acquire_async()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        limiter.release(True)
+        waiters[2].cancel()
+        await asyncio.sleep(0.01)
+        assert [w.cancelled() for w in waiters] == [True, False, True]
+        assert limiter._active == 1
+        limiter.release(True)
+
+    asyncio.run(_main())
+    assert limiter._active == 0 and not limiter._async_waiters
+
+
+def test_call_with_retry(fast_retry):
+    calls = []
+
+    def _flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise requests.ConnectionError()
+        return 'ok'
+
+    assert call_with_retry(_flaky, 5) == 'ok'
+    assert len(calls) == 3
+    with pytest.raises(requests.ConnectionError):
+        call_with_retry(lambda: _raise(requests.ConnectionError()), 2)
+    calls.clear()
+    with pytest.raises(InvalidPageTitle):
+        call_with_retry(lambda: calls.append(1) or _raise(InvalidPageTitle()), 5)
+    assert len(calls) == 1
+    assert throttle.RATE_LIMITER._active == 0
+
+
+def _raise(error: Exception):
+    raise error
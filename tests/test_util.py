@@ -0,0 +1,63 @@
+import mwparserfromhell as mwp
+import pytest
+
+from mcparser.utils.util import _scan_template, _template_params, parse_template, remove_tag
+
+
+def _reference_params(text: str, match_pattern: str = None):
+    templates = mwp.parse(text).filter_templates(matches=match_pattern)
+    return dict(_template_params(templates[0])) if templates else {}
+
+
+@pytest.mark.parametrize('text', [
+    "{{x|'''a=b'''}}",
+    "{{x|a='''b|c'''}}",
+    "{{x|a=''b|c''}}",
+    '{{基础数值|\n==h==\n}}',
+    '{{x|\n=a}}',
+    "'''t''' {{x|a=b|c}}",
+    '==h==\n{{x|a=b}}',
+    '{{x|a={{y|b=c}}|[[d|e]]}}',
+])
+def test_parse_template_same_as_mwparserfromhell(text):
+    assert dict(parse_template(text)) == _reference_params(text)
+
+
+@pytest.mark.parametrize('text', ["{{x|'''a=b'''}}", "{{x|a='''b|c'''}}", '{{基础数值|\n==h==\n}}'])
+def test_scan_template_falls_back_on_ambiguous_body(text):
+    assert _scan_template(text) is None
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('[https://a.b/c 链接<ref>r</ref>]', '[https://a.b/c 链接]'),
+    ('[http://x a<br>b]', '[http://x a\nb]'),
+    ('[http://x {{color|red|t}}]', '[http://x t]'),
+    ('http://x.y/<sup>z</sup>', 'http://x.y/z'),
+    ('[http://x]', '[http://x]'),
+    ('{{{1|{{黑幕|x}}}}}', '{{{1|x}}}'),
+    ('{{{a|<del>d</del>e}}}', '{{{a|de}}}'),
+    ('{{{1}}}', '{{{1}}}'),
+])
+def test_remove_tag_inside_external_link_and_argument(text, expected):
+    assert remove_tag(text) == expected
+
+
+@pytest.mark.parametrize('text,expected', [
+    # markup inside <nowiki> is cleaned like plain string
+    ('<nowiki>{{jin}}<br>[[File:a.png]]<noinclude>x</nowiki>', 'jin\nx'),
+    ("<nowiki>'''b'''</nowiki>", 'b'),
+    # unbalanced nowiki
+    ('<nowiki><nowiki>x</nowiki>', 'x'),
+    # bold is removed only if its contents have no quote
+    ("'''a''b''c'''", "'''a''b''c'''"),
+    ("''''''a'''", "a'''"),
+    ("'''[[Link]]'''", 'Link'),
+    ("多行'''粗\n体'''", '多行粗\n体'),
+])
+def test_remove_tag_nowiki_and_bold(text, expected):
+    assert remove_tag(text) == expected
+
+
+def test_remove_tag_keeps_template_inside_nowiki():
+    # intended difference: the string replacement of old implementation also replaced the same template inside nowiki
+    assert remove_tag('<nowiki>{{黑幕|h}}</nowiki>{{黑幕|h}}') == '{{黑幕|h}}h'